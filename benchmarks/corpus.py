@@ -0,0 +1,137 @@
+import os
+import json
+import string
+import numpy as np
+from config import *
+
+# Scales of the synthetic corpus, each query has `candidates` scoreddocs like the MS MARCO top 100
+SCALES = {
+    'tiny': {'docs': 1000, 'dev_queries': 50, 'train_queries': 100, 'eval_queries': 20, 'candidates': 20, 'body_words': 150},
+    'small': {'docs': 10000, 'dev_queries': 200, 'train_queries': 1000, 'eval_queries': 100, 'candidates': 100, 'body_words': 300},
+    'medium': {'docs': 100000, 'dev_queries': 1000, 'train_queries': 10000, 'eval_queries': 500, 'candidates': 100, 'body_words': 400},
+}
+VOCABULARY_SIZE = 30000
+# Share of the documents with anchor text, and of the queries whose relevant document is a candidate
+ANCHOR_FRAC = 0.4
+RECALL = 0.9
+DOCUMENT_FIELDS_LENGTHS = ['url', 'title', 'body', 'anchor_text', 'whole_document']
+
+
+def get_dataset_path(workdir, path):
+    "Location of a `config` path inside `workdir`, the paths are relative to `src`"
+    return os.path.normpath(os.path.join(workdir, 'src', path))
+
+
+def get_vocabulary(size, rng):
+    "Pronounceable pseudo words, so the analyzer sees realistic tokens"
+    consonants = [c for c in string.ascii_lowercase if c not in 'aeiou']
+    syllables = [c + v for c in consonants for v in 'aeiou']
+    words = set()
+    while len(words) < size:
+        n_syllables = rng.integers(1, 4)
+        words.add(''.join(syllables[i] for i in rng.integers(0, len(syllables), n_syllables)))
+    return np.array(sorted(words, key=len))
+
+
+def get_zipf_probabilities(size, exponent=1.1):
+    ranks = np.arange(1, size + 1)
+    weights = 1 / (ranks + 2.7) ** exponent
+    return weights / weights.sum()
+
+
+def write_jsonl(path, docs):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        for doc in docs:
+            f.write(json.dumps(doc) + '\n')
+
+
+def count_tokens(text):
+    return len(text.split()) if text else 0
+
+
+def generate_corpus(workdir, docs, dev_queries, train_queries, eval_queries, candidates, body_words, seed=SAMPLE_SEED):
+    """Writes an MS MARCO shaped corpus to the `config` paths of `workdir`: documents,
+    anchor text, the queries, scoreddocs and qrels of each split, plus the
+    `document_features_v2` documents the dataset stage reads from mongo.
+    Returns the number of records of each file"""
+    rng = np.random.default_rng(seed)
+    vocabulary = get_vocabulary(VOCABULARY_SIZE, rng)
+    probabilities = get_zipf_probabilities(len(vocabulary))
+
+    def sample_text(n_words):
+        return ' '.join(vocabulary[rng.choice(len(vocabulary), n_words, p=probabilities)])
+
+    # Sparse ids like the MS MARCO `D1555982`
+    doc_numbers = np.sort(rng.choice(docs * 4, docs, replace=False))
+    doc_ids = [f'D{number}' for number in doc_numbers]
+    lengths = np.maximum(rng.lognormal(np.log(body_words), 0.5, docs).astype(int), 10)
+
+    documents, anchors, document_features = [], [], []
+    for doc_id, length in zip(doc_ids, lengths):
+        words = vocabulary[rng.integers(0, len(vocabulary), 4)]
+        doc = {
+            'doc_id': doc_id,
+            'url': f'http://www.{words[0]}{words[1]}.com/{words[2]}/{words[3]}',
+            'title': sample_text(int(rng.integers(3, 12))),
+            'body': sample_text(int(length)),
+        }
+        documents.append(doc)
+        anchor_text = ''
+        if rng.random() < ANCHOR_FRAC:
+            anchor_text = sample_text(int(rng.integers(2, 20)))
+            anchors.append({'doc_id': doc_id, 'text': anchor_text})
+        whole_document = ' '.join([doc['url'], doc['title'], doc['body'], anchor_text])
+        fields = {'url': doc['url'], 'title': doc['title'], 'body': doc['body'], 'anchor_text': anchor_text, 'whole_document': whole_document}
+        document_features.append({
+            'doc_id': doc_id,
+            **{f'{field}_doc_length': count_tokens(fields[field]) for field in DOCUMENT_FIELDS_LENGTHS},
+            'url_length': len(doc['url']),
+        })
+
+    write_jsonl(get_dataset_path(workdir, MSMARCO_DOCS_PATH), documents)
+    write_jsonl(get_dataset_path(workdir, MSMARCO_ANCHORS_PATH), anchors)
+    write_jsonl(get_dataset_path(workdir, '../datasets/document_features.jsonl'), document_features)
+    counts = {'documents': len(documents), 'anchors': len(anchors)}
+
+    splits = [
+        ('dev', dev_queries, DEV_QUERIES_PATH, DEV_SCOREDDOCS_PATH, DEV_QRELS_PATH),
+        ('train', train_queries, TRAIN_QUERIES_PATH, TRAIN_SCOREDDOCS_PATH, TRAIN_QRELS_PATH),
+        ('eval', eval_queries, EVAL_QUERIES_PATH, EVAL_SCOREDDOCS_PATH, None),
+    ]
+    query_numbers = rng.choice(2_000_000, dev_queries + train_queries + eval_queries, replace=False)
+    offset = 0
+    for split, n_queries, queries_path, scoreddocs_path, qrels_path in splits:
+        queries, scoreddocs, qrels = [], [], []
+        for number in query_numbers[offset:offset + n_queries]:
+            query_id = str(number)
+            relevant = int(rng.integers(0, docs))
+            # Words of the relevant document, with some noise
+            source = (documents[relevant]['title'] + ' ' + documents[relevant]['body']).split()
+            n_words = int(rng.integers(2, 7))
+            words = [source[i] for i in rng.integers(0, len(source), n_words)] + [sample_text(1)]
+            queries.append({'query_id': query_id, 'text': ' '.join(words)})
+            qrels.append({'query_id': query_id, 'doc_id': doc_ids[relevant], 'relevance': 1, 'iteration': '0'})
+
+            candidates_docs = list(rng.choice(docs, min(candidates, docs), replace=False))
+            if rng.random() < RECALL and relevant not in candidates_docs:
+                candidates_docs[int(rng.integers(0, len(candidates_docs)))] = relevant
+            scores = np.sort(rng.normal(15, 3, len(candidates_docs)))[::-1]
+            for doc, score in zip(candidates_docs, scores):
+                scoreddocs.append({'query_id': query_id, 'doc_id': doc_ids[doc], 'score': round(float(score), 4)})
+        offset += n_queries
+
+        write_jsonl(get_dataset_path(workdir, queries_path), queries)
+        write_jsonl(get_dataset_path(workdir, scoreddocs_path), scoreddocs)
+        counts[f'{split}_queries'] = len(queries)
+        counts[f'{split}_scoreddocs'] = len(scoreddocs)
+        if qrels_path:
+            write_jsonl(get_dataset_path(workdir, qrels_path), qrels)
+            counts[f'{split}_qrels'] = len(qrels)
+    return counts
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
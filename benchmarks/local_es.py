@@ -0,0 +1,612 @@
+import json
+import math
+import uuid
+import bisect
+import threading
+import itertools
+from collections import Counter, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from config import *
+from utils import analyze
+
+# Version reported to the client, which checks the product before its first request
+ES_VERSION = "7.17.2"
+
+
+class SearchError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class Index:
+    """In memory index of the sources of an ES index.
+
+    Every string field is indexed both as analyzed tokens (text) and as its
+    raw value (keyword), like the dynamic mapping does for `field.keyword`.
+    Multi-fields `{field}.{subfield}` share the postings of `field` and are
+    only scored with the similarity of the subfield"""
+
+    def __init__(self, name, body=None):
+        body = body or {}
+        self.name = name
+        self.uuid = uuid.uuid4().hex[:22]
+        self.settings = {
+            'index.number_of_shards': '1',
+            'index.number_of_replicas': '1',
+            'index.refresh_interval': None,
+        }
+        for key, value in flatten_settings(body.get('settings', {})).items():
+            if not key.startswith('index.similarity'):
+                self.settings[key if key.startswith('index.') else f'index.{key}'] = str(value)
+        self.similarities = get_similarities(body)
+        self.ids = {}
+        self.doc_ids = []
+        self.sources = []
+        # field -> term -> {doc: tf}
+        self.postings = defaultdict(lambda: defaultdict(dict))
+        self.ttf = defaultdict(Counter)
+        self.lengths = defaultdict(dict)
+        self.total_lengths = Counter()
+        self.sum_doc_freq = Counter()
+        # field -> value -> docs, sorted values are built lazily for the ranges
+        self.keywords = defaultdict(lambda: defaultdict(set))
+        self.sorted_keywords = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def put(self, doc_id, source):
+        if doc_id in self.ids:
+            self.remove(doc_id)
+        doc = len(self.sources)
+        self.ids[doc_id] = doc
+        self.doc_ids.append(doc_id)
+        self.sources.append(source)
+        for field, value in source.items():
+            if not isinstance(value, str):
+                continue
+            self.keywords[field][value].add(doc)
+            self.sorted_keywords.pop(field, None)
+            terms = Counter(analyze(value))
+            for term, tf in terms.items():
+                self.postings[field][term][doc] = tf
+                self.ttf[field][term] += tf
+            self.lengths[field][doc] = sum(terms.values())
+            self.total_lengths[field] += sum(terms.values())
+            self.sum_doc_freq[field] += len(terms)
+
+    def remove(self, doc_id):
+        doc = self.ids.pop(doc_id)
+        for field, value in self.sources[doc].items():
+            if not isinstance(value, str):
+                continue
+            self.keywords[field][value].discard(doc)
+            self.sorted_keywords.pop(field, None)
+            for term in set(analyze(value)):
+                self.ttf[field][term] -= self.postings[field][term].pop(doc, 0)
+                self.sum_doc_freq[field] -= 1
+            self.total_lengths[field] -= self.lengths[field].pop(doc, 0)
+
+    def get(self, doc_id):
+        doc = self.ids.get(doc_id)
+        return None if doc is None else self.sources[doc]
+
+    def all_docs(self):
+        return set(self.ids.values())
+
+    def keyword_values(self, field):
+        if field not in self.sorted_keywords:
+            self.sorted_keywords[field] = sorted(value for value, docs in self.keywords[field].items() if docs)
+        return self.sorted_keywords[field]
+
+    def field_statistics(self, field):
+        return {
+            'doc_count': len(self.lengths[field]),
+            'sum_doc_freq': self.sum_doc_freq[field],
+            'sum_ttf': self.total_lengths[field],
+        }
+
+
+def flatten_settings(settings, prefix=''):
+    flat = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            flat.update(flatten_settings(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def get_similarities(body):
+    "Similarity of each `{field}.{subfield}` of the mapping, the other fields use BM25"
+    definitions = body.get('settings', {}).get('index', {}).get('similarity', {})
+    similarities = {}
+    for field, mapping in body.get('mappings', {}).get('properties', {}).items():
+        for subfield, submapping in mapping.get('fields', {}).items():
+            similarity = submapping.get('similarity')
+            if similarity in definitions:
+                similarities[f'{field}.{subfield}'] = definitions[similarity]
+    return similarities
+
+
+def split_field(field):
+    "Source field and keyword flag of a queried field, `query_id.keyword` -> (`query_id`, True)"
+    if field.endswith('.keyword'):
+        return field[:-len('.keyword')], True
+    return field.split('.', 1)[0], False
+
+
+def score_term(similarity, tf, df, n_docs, length, avg_length, collection_probability):
+    "Score of a single term, with the formulas of the Lucene similarities"
+    kind = similarity.get('type', 'BM25')
+    if kind == 'LMDirichlet':
+        mu = float(similarity.get('mu', 2000))
+        score = math.log(1 + tf / (mu * collection_probability)) + math.log(mu / (length + mu))
+        return max(score, 0.)
+    if kind == 'LMJelinekMercer':
+        lambda_ = float(similarity.get('lambda', 0.1))
+        return math.log(1 + ((1 - lambda_) * tf / length) / (lambda_ * collection_probability))
+    k1, b = float(similarity.get('k1', 1.2)), float(similarity.get('b', 0.75))
+    idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+    return idf * tf / (tf + k1 * (1 - b + b * length / avg_length))
+
+
+def match_scores(index, field, text, candidates=None):
+    "`{doc: score}` of a `match` query and the weight of each (doc, term) for the explanations"
+    source_field, _ = split_field(field)
+    similarity = index.similarities.get(field, {})
+    postings = index.postings[source_field]
+    lengths = index.lengths[source_field]
+    n_docs = max(len(lengths), 1)
+    total_length = max(index.total_lengths[source_field], 1)
+    avg_length = total_length / n_docs
+
+    scores, weights = defaultdict(float), defaultdict(list)
+    for term in analyze(text):
+        docs = postings.get(term)
+        if not docs:
+            continue
+        collection_probability = index.ttf[source_field][term] / total_length
+        if candidates is not None and len(candidates) < len(docs):
+            matches = [(doc, docs[doc]) for doc in candidates if doc in docs]
+        else:
+            matches = [(doc, tf) for doc, tf in docs.items() if candidates is None or doc in candidates]
+        for doc, tf in matches:
+            weight = score_term(similarity, tf, len(docs), n_docs, max(lengths[doc], 1), avg_length, collection_probability)
+            scores[doc] += weight
+            weights[doc].append((term, weight))
+    return scores, weights
+
+
+def as_list(clauses):
+    if clauses is None:
+        return []
+    return clauses if isinstance(clauses, list) else [clauses]
+
+
+def evaluate_query(index, query, candidates=None, explain=False):
+    """Matching docs of a query as `{doc: (score, explanation details)}`, restricted
+    to `candidates` when given. Only the queries sent by the pipeline are supported"""
+    if not query or 'match_all' in query:
+        docs = index.all_docs() if candidates is None else candidates
+        return {doc: (1., []) for doc in docs}
+
+    kind, params = next(iter(query.items()))
+    if kind == 'terms':
+        field, values = next(iter(params.items()))
+        source_field, _ = split_field(field)
+        docs = set().union(*[index.keywords[source_field].get(str(value), set()) for value in values]) if values else set()
+        if candidates is not None:
+            docs &= candidates
+        return {doc: (1., []) for doc in docs}
+
+    if kind == 'term':
+        field, value = next(iter(params.items()))
+        value = value['value'] if isinstance(value, dict) else value
+        docs = set(index.keywords[split_field(field)[0]].get(str(value), set()))
+        if candidates is not None:
+            docs &= candidates
+        return {doc: (1., []) for doc in docs}
+
+    if kind == 'ids':
+        docs = {index.ids[doc_id] for doc_id in params['values'] if doc_id in index.ids}
+        if candidates is not None:
+            docs &= candidates
+        return {doc: (1., []) for doc in docs}
+
+    if kind == 'range':
+        field, bounds = next(iter(params.items()))
+        values = index.keyword_values(split_field(field)[0])
+        start, end = 0, len(values)
+        if 'gt' in bounds:
+            start = bisect.bisect_right(values, str(bounds['gt']))
+        if 'gte' in bounds:
+            start = bisect.bisect_left(values, str(bounds['gte']))
+        if 'lt' in bounds:
+            end = bisect.bisect_left(values, str(bounds['lt']))
+        if 'lte' in bounds:
+            end = bisect.bisect_right(values, str(bounds['lte']))
+        keywords = index.keywords[split_field(field)[0]]
+        docs = set().union(*[keywords[value] for value in values[start:end]]) if end > start else set()
+        if candidates is not None:
+            docs &= candidates
+        return {doc: (1., []) for doc in docs}
+
+    if kind == 'match':
+        field, text = next(iter(params.items()))
+        text = text['query'] if isinstance(text, dict) else text
+        scores, weights = match_scores(index, field, str(text), candidates)
+        return {
+            doc: (score, [
+                {'value': weight, 'description': f'weight({field}:{term} in {doc}) [PerFieldSimilarity], result of:', 'details': []}
+                for term, weight in weights[doc]
+            ] if explain else [])
+            for doc, score in scores.items()
+        }
+
+    if kind == 'bool':
+        required = bool(as_list(params.get('filter')) or as_list(params.get('must')))
+        for clause in as_list(params.get('filter')):
+            candidates = set(evaluate_query(index, clause, candidates))
+        must = []
+        for clause in as_list(params.get('must')):
+            must.append(evaluate_query(index, clause, candidates, explain))
+            candidates = set(must[-1])
+        if candidates is None:
+            candidates = index.all_docs()
+        results = {doc: [0., []] for doc in candidates} if required else {}
+
+        for matched in must:
+            for doc in candidates:
+                score, details = matched[doc]
+                results[doc][0] += score
+                results[doc][1].append({'value': score, 'description': 'sum of:', 'details': details})
+
+        should = as_list(params.get('should'))
+        for clause in should:
+            for doc, (score, details) in evaluate_query(index, clause, candidates, explain).items():
+                # Without required clauses a doc must match one of the optional ones
+                result = results.setdefault(doc, [0., []])
+                result[0] += score
+                result[1].append({'value': score, 'description': 'sum of:', 'details': details})
+
+        for clause in as_list(params.get('must_not')):
+            for doc in evaluate_query(index, clause, candidates):
+                results.pop(doc, None)
+        return {doc: (score, details) for doc, (score, details) in results.items()}
+
+    raise SearchError(400, f"query `{kind}` is not supported by the local ES")
+
+
+def get_sort_key(index, sort):
+    "Sort key of the docs for a `sort` clause, string fields are compared as keywords"
+    fields = []
+    for clause in sort:
+        field, order = (clause, 'asc') if isinstance(clause, str) else next(iter(clause.items()))
+        order = order['order'] if isinstance(order, dict) else order
+        if order != 'asc':
+            raise SearchError(400, "only ascending sorts are supported by the local ES")
+        fields.append(split_field(field)[0] if field != '_doc' else None)
+
+    def key(doc):
+        source = index.sources[doc]
+        return tuple(doc if field is None else str(source.get(field, '')) for field in fields)
+    return key
+
+
+def filter_source(source, includes):
+    if includes is False:
+        return None
+    if includes is True or includes is None:
+        return source
+    includes = [includes] if isinstance(includes, str) else includes
+    return {field: source[field] for field in includes if field in source}
+
+
+class LocalElasticsearch:
+    """Stand-in for the ES endpoints used by the pipeline, served over HTTP from
+    threads of the benchmark process so the pool workers of the stages reach it
+    like a cluster. Counts the requests of each API"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.indices = {}
+        self.scrolls = {}
+        self.lock = threading.RLock()
+        self.requests = Counter()
+        self.scroll_ids = itertools.count()
+        handler = type('Handler', (RequestHandler,), {'es': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_index(self, name):
+        if name not in self.indices:
+            raise SearchError(404, f"no such index [{name}]")
+        return self.indices[name]
+
+    def search(self, index_name, body, params):
+        index = self.get_index(index_name)
+        body = body or {}
+        size = int(params.get('size', body.get('size', 10)))
+        candidates = None
+        if 'slice' in body:
+            slice_id, n_slices = body['slice']['id'], body['slice']['max']
+            candidates = {doc for doc in index.all_docs() if doc % n_slices == slice_id}
+        explain = body.get('explain', False)
+        matched = evaluate_query(index, body.get('query'), candidates, explain)
+
+        if 'sort' in body:
+            docs = sorted(matched, key=get_sort_key(index, body['sort']))
+        else:
+            docs = sorted(matched, key=lambda doc: (-matched[doc][0], doc))
+        hits = [self.to_hit(index, doc, matched[doc], body, explain) for doc in docs]
+
+        response = {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {
+                'total': {'value': len(hits), 'relation': 'eq'},
+                'max_score': max([hit['_score'] or 0. for hit in hits], default=None),
+                'hits': hits[:size],
+            },
+        }
+        if 'scroll' in params:
+            scroll_id = f"scroll-{next(self.scroll_ids)}"
+            self.scrolls[scroll_id] = (hits[size:], size)
+            response['_scroll_id'] = scroll_id
+        return response
+
+    def to_hit(self, index, doc, match, body, explain):
+        score, details = match
+        doc_id = index.doc_ids[doc]
+        hit = {'_index': index.name, '_type': '_doc', '_id': doc_id, '_score': None if 'sort' in body else score}
+        source = filter_source(index.sources[doc], body.get('_source'))
+        if source is not None:
+            hit['_source'] = source
+        if explain:
+            hit['_explanation'] = {'value': score, 'description': 'sum of:', 'details': details}
+        return hit
+
+    def scroll(self, scroll_id):
+        if scroll_id not in self.scrolls:
+            raise SearchError(404, f"No search context found for id [{scroll_id}]")
+        hits, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits[size:], size)
+        return {
+            '_scroll_id': scroll_id,
+            'took': 1,
+            'timed_out': False,
+            'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'hits': hits[:size]},
+        }
+
+    def count(self, index_name, body):
+        index = self.get_index(index_name)
+        return {'count': len(evaluate_query(index, (body or {}).get('query'))), '_shards': {'total': 1}}
+
+    def termvectors(self, index_name, doc_id, params):
+        index = self.get_index(index_name)
+        response = {'_index': index_name, '_type': '_doc', '_id': doc_id, '_version': 1, 'took': 1}
+        source = index.get(doc_id)
+        if source is None:
+            response['found'] = False
+            return response
+        doc = index.ids[doc_id]
+        fields = params.get('fields', ','.join(field for field, value in source.items() if isinstance(value, str)))
+        term_vectors = {}
+        for field in fields.split(','):
+            if not isinstance(source.get(field), str):
+                continue
+            postings = index.postings[field]
+            terms = {}
+            for term in sorted(set(analyze(source[field]))):
+                docs = postings[term]
+                terms[term] = {'term_freq': docs[doc], 'doc_freq': len(docs), 'ttf': index.ttf[field][term]}
+            term_vectors[field] = {'field_statistics': index.field_statistics(field), 'terms': terms}
+        response['found'] = True
+        response['term_vectors'] = term_vectors
+        return response
+
+    def bulk(self, lines, default_index):
+        items, errors = [], False
+        lines = iter(lines)
+        for line in lines:
+            action = json.loads(line)
+            op_type, meta = next(iter(action.items()))
+            index_name = meta.get('_index', default_index)
+            doc_id = meta.get('_id') or uuid.uuid4().hex
+            source = json.loads(next(lines)) if op_type != 'delete' else None
+            if index_name not in self.indices:
+                self.indices[index_name] = Index(index_name)
+            index = self.indices[index_name]
+            item = {'_index': index_name, '_type': '_doc', '_id': doc_id}
+            if op_type in ('index', 'create'):
+                if op_type == 'create' and doc_id in index.ids:
+                    item.update(status=409, error={'type': 'version_conflict_engine_exception', 'reason': 'document already exists'})
+                else:
+                    item.update(status=200 if doc_id in index.ids else 201, result='updated' if doc_id in index.ids else 'created')
+                    index.put(doc_id, source)
+            elif op_type == 'update':
+                current = index.get(doc_id)
+                if current is None:
+                    item.update(status=404, error={'type': 'document_missing_exception', 'reason': f'[_doc][{doc_id}]: document missing'})
+                else:
+                    index.put(doc_id, {**current, **source.get('doc', {})})
+                    item.update(status=200, result='updated')
+            elif op_type == 'delete':
+                if doc_id in index.ids:
+                    index.remove(doc_id)
+                    item.update(status=200, result='deleted')
+                else:
+                    item.update(status=404, result='not_found')
+            errors = errors or 'error' in item
+            items.append({op_type: item})
+        return {'took': 1, 'errors': errors, 'items': items}
+
+    def get_settings(self, index_name, flat):
+        index = self.get_index(index_name)
+        settings = {key: value for key, value in index.settings.items() if value is not None}
+        settings['index.uuid'] = index.uuid
+        settings['index.provided_name'] = index_name
+        if flat:
+            return {index_name: {'settings': settings}}
+        nested = {}
+        for key, value in settings.items():
+            node = nested
+            *parents, leaf = key.split('.')
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[leaf] = value
+        return {index_name: {'settings': nested}}
+
+    def put_settings(self, index_name, body):
+        index = self.get_index(index_name)
+        for key, value in flatten_settings(body).items():
+            key = key if key.startswith('index.') else f'index.{key}'
+            index.settings[key] = None if value is None else str(value)
+        return {'acknowledged': True}
+
+    def handle(self, method, path, params, body):
+        "Routes a request, returns `(status, response)`"
+        parts = [part for part in path.split('/') if part]
+        api = next((part for part in parts if part.startswith('_')), None)
+        self.requests[api[1:] if api else 'index' if parts else 'info'] += 1
+
+        if not parts:
+            return 200, {
+                'name': 'local', 'cluster_name': 'local', 'cluster_uuid': 'local',
+                'version': {'number': ES_VERSION, 'build_flavor': 'default', 'lucene_version': '8.11.1'},
+                'tagline': 'You Know, for Search',
+            }
+        if parts[:2] == ['_cluster', 'health']:
+            return 200, {'cluster_name': 'local', 'status': 'green', 'number_of_nodes': 1}
+        if parts[:2] == ['_search', 'scroll']:
+            if method == 'DELETE':
+                return 200, {'succeeded': True, 'num_freed': 1}
+            scroll_id = (parse_json(body) or {}).get('scroll_id') or params.get('scroll_id')
+            return 200, self.scroll(scroll_id)
+        if parts[0] == '_msearch' or (len(parts) > 1 and parts[1] == '_msearch'):
+            return 200, self.msearch(body, parts[0] if parts[0] != '_msearch' else None)
+        if parts[0] == '_bulk' or (len(parts) > 1 and parts[1] == '_bulk'):
+            return 200, self.bulk(ndjson_lines(body), parts[0] if parts[0] != '_bulk' else None)
+
+        index_name = parts[0]
+        if len(parts) == 1:
+            if method == 'HEAD':
+                return (200 if index_name in self.indices else 404), None
+            if method == 'PUT':
+                if index_name in self.indices:
+                    raise SearchError(400, f"index [{index_name}] already exists")
+                self.indices[index_name] = Index(index_name, parse_json(body))
+                return 200, {'acknowledged': True, 'index': index_name}
+            if method == 'DELETE':
+                self.get_index(index_name)
+                del self.indices[index_name]
+                return 200, {'acknowledged': True}
+        api = parts[1]
+        if api == '_search':
+            return 200, self.search(index_name, parse_json(body), params)
+        if api == '_count':
+            return 200, self.count(index_name, parse_json(body))
+        if api == '_refresh':
+            self.get_index(index_name)
+            return 200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+        if api == '_settings':
+            if method == 'PUT':
+                return 200, self.put_settings(index_name, parse_json(body))
+            return 200, self.get_settings(index_name, params.get('flat_settings') == 'true')
+        if api == '_termvectors':
+            return 200, self.termvectors(index_name, parts[2], params)
+        if api == '_mtermvectors':
+            ids = parse_json(body)['ids']
+            return 200, {'docs': [self.termvectors(index_name, doc_id, params) for doc_id in ids]}
+        if api == '_doc' and method == 'GET':
+            source = self.get_index(index_name).get(parts[2])
+            if source is None:
+                return 404, {'_index': index_name, '_id': parts[2], 'found': False}
+            return 200, {'_index': index_name, '_id': parts[2], 'found': True, '_source': source}
+        raise SearchError(400, f"`{method} {path}` is not supported by the local ES")
+
+    def msearch(self, body, default_index):
+        lines = ndjson_lines(body)
+        responses = []
+        for header, search_body in zip(lines[::2], lines[1::2]):
+            header = json.loads(header)
+            try:
+                response = self.search(header.get('index', default_index), json.loads(search_body), {})
+                response['status'] = 200
+            except SearchError as e:
+                response = {'error': {'type': 'search_exception', 'reason': e.reason}, 'status': e.status}
+            responses.append(response)
+        return {'took': 1, 'responses': responses}
+
+
+def parse_json(body):
+    return json.loads(body) if body else None
+
+
+def ndjson_lines(body):
+    return [line for line in body.decode().split('\n') if line.strip()]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are sent in separate writes, which Nagle delays by ~40ms
+    disable_nagle_algorithm = True
+    es = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self, method):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        try:
+            with self.es.lock:
+                status, response = self.es.handle(method, url.path, params, body)
+        except SearchError as e:
+            status, response = e.status, {'error': {'type': 'exception', 'reason': e.reason}, 'status': e.status}
+        except Exception as e:
+            status, response = 500, {'error': {'type': type(e).__name__, 'reason': str(e)}, 'status': 500}
+
+        data = b'' if response is None else json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
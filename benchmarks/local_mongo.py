@@ -0,0 +1,480 @@
+import struct
+import datetime
+import threading
+import itertools
+import socketserver
+from collections import Counter
+import bson
+from bson import ObjectId, Int64
+
+OP_REPLY = 1
+OP_QUERY = 2004
+OP_MSG = 2013
+MORE_TO_COME = 1 << 1
+
+DUPLICATE_KEY_ERROR = 11000
+# Wire version of MongoDB 7.0
+MAX_WIRE_VERSION = 21
+# Default size of the first batch of a cursor, and the max bytes of any batch
+FIRST_BATCH_SIZE = 101
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+
+class CommandError(Exception):
+    def __init__(self, message, code=2):
+        super().__init__(message)
+        self.code = code
+
+
+def get_path(doc, path):
+    "Value of a dotted path, with a sentinel when it is missing"
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+_MISSING = object()
+
+_OPERATORS = {
+    '$eq': lambda value, arg: value == arg,
+    '$ne': lambda value, arg: value != arg,
+    '$gt': lambda value, arg: value is not _MISSING and value > arg,
+    '$gte': lambda value, arg: value is not _MISSING and value >= arg,
+    '$lt': lambda value, arg: value is not _MISSING and value < arg,
+    '$lte': lambda value, arg: value is not _MISSING and value <= arg,
+    '$in': lambda value, arg: value in arg,
+    '$nin': lambda value, arg: value not in arg,
+    '$exists': lambda value, arg: (value is not _MISSING) == bool(arg),
+}
+
+
+def matches(doc, query):
+    "Whether `doc` matches a find filter, with the operators used by the pipeline"
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+            continue
+        if key == '$or':
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+            continue
+        value = get_path(doc, key)
+        if isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition):
+            for op, arg in condition.items():
+                if op not in _OPERATORS:
+                    raise CommandError(f"unknown operator: {op}", code=2)
+                if not _OPERATORS[op](value, arg):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def include_path(projected, doc, path):
+    "Copies the value of a dotted path into `projected`, rebuilding the sub-documents above it"
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if not isinstance(doc, dict) or part not in doc:
+            return
+        doc = doc[part]
+        if isinstance(doc, list):
+            raise CommandError(f"projection of `{path}` through an array is not supported by the local mongo")
+        projected = projected.setdefault(part, {})
+    if isinstance(doc, dict) and parts[-1] in doc:
+        projected[parts[-1]] = doc[parts[-1]]
+
+
+def project(doc, projection):
+    "Inclusion or exclusion projection, the inclusions can be dotted paths of sub-documents"
+    if not projection:
+        return doc
+    for field, flag in projection.items():
+        if isinstance(flag, dict) or field.startswith('$'):
+            raise CommandError(f"projection `{field}: {flag}` is not supported by the local mongo")
+    included = [field for field, flag in projection.items() if flag and field != '_id']
+    if included:
+        projected = {}
+        if projection.get('_id', 1) and '_id' in doc:
+            projected['_id'] = doc['_id']
+        for field in included:
+            include_path(projected, doc, field)
+        return projected
+    if any('.' in field for field in projection):
+        raise CommandError("dotted exclusion projections are not supported by the local mongo")
+    return {field: value for field, value in doc.items() if projection.get(field, 1)}
+
+
+def sort_documents(docs, sort):
+    "Sorts by every key of `sort`, applied from the last one since `sorted` is stable"
+    for field, direction in reversed(list(sort.items())):
+        present = [doc for doc in docs if get_path(doc, field) is not _MISSING]
+        missing = [doc for doc in docs if get_path(doc, field) is _MISSING]
+        present.sort(key=lambda doc: get_path(doc, field), reverse=direction < 0)
+        # Missing values sort first, like null
+        docs = missing + present if direction > 0 else present + missing
+    return docs
+
+
+class Collection:
+    def __init__(self):
+        self.docs = {}
+        # Unique indexes, name -> (fields, {values: _id})
+        self.unique = {}
+        self.indexes = {'_id_': {'key': {'_id': 1}, 'name': '_id_', 'v': 2}}
+
+    def key_values(self, doc, fields):
+        return tuple(repr(get_path(doc, field)) for field in fields)
+
+    def check_unique(self, doc, ignore_id=None):
+        if doc['_id'] in self.docs and doc['_id'] != ignore_id:
+            return f"E11000 duplicate key error index: _id_ dup key: {{ _id: {doc['_id']!r} }}"
+        for name, (fields, keys) in self.unique.items():
+            owner = keys.get(self.key_values(doc, fields))
+            if owner is not None and owner != ignore_id:
+                return f"E11000 duplicate key error index: {name} dup key: {self.key_values(doc, fields)}"
+        return None
+
+    def add(self, doc):
+        self.docs[doc['_id']] = doc
+        for fields, keys in self.unique.values():
+            keys[self.key_values(doc, fields)] = doc['_id']
+
+    def remove(self, doc):
+        del self.docs[doc['_id']]
+        for fields, keys in self.unique.values():
+            keys.pop(self.key_values(doc, fields), None)
+
+    def create_index(self, spec):
+        name = spec['name']
+        self.indexes[name] = spec
+        if spec.get('unique') and name not in self.unique:
+            fields = list(spec['key'])
+            keys = {}
+            for doc in self.docs.values():
+                key = self.key_values(doc, fields)
+                if key in keys:
+                    raise CommandError(f"E11000 duplicate key error index: {name}", DUPLICATE_KEY_ERROR)
+                keys[key] = doc['_id']
+            self.unique[name] = (fields, keys)
+
+    def find(self, query):
+        if list(query) == ['_id'] and not isinstance(query['_id'], dict):
+            doc = self.docs.get(query['_id'])
+            return [doc] if doc is not None else []
+        return [doc for doc in self.docs.values() if matches(doc, query)]
+
+
+class LocalMongo:
+    """Stand-in for a standalone mongod, speaking the OP_MSG wire protocol from
+    threads of the benchmark process so the real pymongo client, and the pool
+    workers of the stages, use it like the server. Counts the commands run"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.databases = {}
+        self.cursors = {}
+        self.cursor_ids = itertools.count(1)
+        self.connection_ids = itertools.count(1)
+        self.lock = threading.RLock()
+        self.commands = Counter()
+        handler = type('Handler', (MongoHandler,), {'mongo': self})
+        self.server = socketserver.ThreadingTCPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def host(self):
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def collection(self, db, name):
+        return self.databases.setdefault(db, {}).setdefault(name, Collection())
+
+    def run_command(self, db, command):
+        name = next(iter(command))
+        handler = getattr(self, f'cmd_{name.lower()}', None)
+        if handler is None:
+            return {'ok': 0., 'errmsg': f"no such command: '{name}'", 'code': 59, 'codeName': 'CommandNotFound'}
+        try:
+            with self.lock:
+                self.commands[name] += 1
+                return {**handler(db, command), 'ok': 1.}
+        except CommandError as e:
+            return {'ok': 0., 'errmsg': str(e), 'code': e.code}
+
+    def cmd_hello(self, db, command):
+        return {
+            'helloOk': True,
+            'isWritablePrimary': True,
+            'ismaster': True,
+            'maxBsonObjectSize': 16 * 1024 * 1024,
+            'maxMessageSizeBytes': 48000000,
+            'maxWriteBatchSize': 100000,
+            'localTime': datetime.datetime.now(datetime.timezone.utc),
+            'logicalSessionTimeoutMinutes': 30,
+            'connectionId': next(self.connection_ids),
+            'minWireVersion': 0,
+            'maxWireVersion': MAX_WIRE_VERSION,
+            'readOnly': False,
+        }
+
+    cmd_ismaster = cmd_hello
+
+    def cmd_ping(self, db, command):
+        return {}
+
+    def cmd_buildinfo(self, db, command):
+        return {'version': '7.0.0', 'versionArray': [7, 0, 0, 0]}
+
+    def cmd_endsessions(self, db, command):
+        return {}
+
+    def cmd_createindexes(self, db, command):
+        coll = self.collection(db, command['createIndexes'])
+        n_before = len(coll.indexes)
+        for spec in command['indexes']:
+            coll.create_index(spec)
+        return {'numIndexesBefore': n_before, 'numIndexesAfter': len(coll.indexes), 'createdCollectionAutomatically': False}
+
+    def cmd_insert(self, db, command):
+        coll = self.collection(db, command['insert'])
+        ordered = command.get('ordered', True)
+        n, write_errors = 0, []
+        for i, doc in enumerate(command['documents']):
+            if '_id' not in doc:
+                doc = {'_id': ObjectId(), **doc}
+            error = coll.check_unique(doc)
+            if error:
+                write_errors.append({'index': i, 'code': DUPLICATE_KEY_ERROR, 'errmsg': error})
+                if ordered:
+                    break
+                continue
+            coll.add(doc)
+            n += 1
+        response = {'n': n}
+        if write_errors:
+            response['writeErrors'] = write_errors
+        return response
+
+    def cmd_update(self, db, command):
+        coll = self.collection(db, command['update'])
+        ordered = command.get('ordered', True)
+        n, n_modified, upserted, write_errors = 0, 0, [], []
+        for i, update in enumerate(command['updates']):
+            found = coll.find(update['q'])
+            if not update.get('multi'):
+                found = found[:1]
+            if not found and update.get('upsert'):
+                base = {key: value for key, value in update['q'].items() if not key.startswith('$') and not isinstance(value, dict)}
+                found = [None]
+            for current in found:
+                doc = apply_update(current if current is not None else base, update['u'])
+                doc['_id'] = current['_id'] if current is not None else doc.get('_id', base.get('_id', ObjectId()))
+                error = coll.check_unique(doc, ignore_id=doc['_id'] if current is not None else None)
+                if error:
+                    write_errors.append({'index': i, 'code': DUPLICATE_KEY_ERROR, 'errmsg': error})
+                    break
+                if current is not None:
+                    coll.remove(current)
+                    n_modified += doc != current
+                else:
+                    upserted.append({'index': i, '_id': doc['_id']})
+                coll.add(doc)
+                n += 1
+            if write_errors and ordered:
+                break
+        response = {'n': n, 'nModified': n_modified}
+        if upserted:
+            response['upserted'] = upserted
+        if write_errors:
+            response['writeErrors'] = write_errors
+        return response
+
+    def cmd_delete(self, db, command):
+        coll = self.collection(db, command['delete'])
+        n = 0
+        for delete in command['deletes']:
+            found = coll.find(delete['q'])
+            if delete.get('limit'):
+                found = found[:delete['limit']]
+            for doc in found:
+                coll.remove(doc)
+                n += 1
+        return {'n': n}
+
+    def cmd_drop(self, db, command):
+        self.databases.get(db, {}).pop(command['drop'], None)
+        return {'ns': f"{db}.{command['drop']}"}
+
+    def cmd_count(self, db, command):
+        coll = self.collection(db, command['count'])
+        return {'n': len(coll.find(command.get('query') or {}))}
+
+    def open_cursor(self, ns, docs, batch_size, single_batch=False):
+        "First batch of a cursor, the remaining documents are kept for `getMore`"
+        batch, docs = take_batch(docs, batch_size or FIRST_BATCH_SIZE)
+        cursor_id = 0
+        if docs and not single_batch:
+            cursor_id = next(self.cursor_ids)
+            self.cursors[cursor_id] = (ns, docs)
+        return {'cursor': {'firstBatch': batch, 'id': Int64(cursor_id), 'ns': ns}}
+
+    def cmd_find(self, db, command):
+        coll = self.collection(db, command['find'])
+        docs = coll.find(command.get('filter') or {})
+        if command.get('sort'):
+            docs = sort_documents(docs, command['sort'])
+        docs = docs[command.get('skip', 0):]
+        if command.get('limit'):
+            docs = docs[:abs(command['limit'])]
+        docs = [project(doc, command.get('projection')) for doc in docs]
+        return self.open_cursor(f"{db}.{command['find']}", docs, command.get('batchSize'), command.get('singleBatch'))
+
+    def cmd_getmore(self, db, command):
+        cursor_id = int(command['getMore'])
+        if cursor_id not in self.cursors:
+            raise CommandError(f"cursor id {cursor_id} not found", code=43)
+        ns, docs = self.cursors.pop(cursor_id)
+        batch, docs = take_batch(docs, command.get('batchSize'))
+        if docs:
+            self.cursors[cursor_id] = (ns, docs)
+        return {'cursor': {'nextBatch': batch, 'id': Int64(cursor_id if docs else 0), 'ns': ns}}
+
+    def cmd_killcursors(self, db, command):
+        killed = [cursor_id for cursor_id in command['cursors'] if self.cursors.pop(int(cursor_id), None)]
+        return {'cursorsKilled': killed, 'cursorsNotFound': [], 'cursorsAlive': [], 'cursorsUnknown': []}
+
+    def cmd_aggregate(self, db, command):
+        "Only the `$match`, `$skip`, `$limit`, `$group` (by a constant) stages of `count_documents`"
+        coll = self.collection(db, command['aggregate'])
+        docs = list(coll.docs.values())
+        for stage in command['pipeline']:
+            name, spec = next(iter(stage.items()))
+            if name == '$match':
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif name == '$skip':
+                docs = docs[spec:]
+            elif name == '$limit':
+                docs = docs[:spec]
+            elif name == '$group' and not isinstance(spec['_id'], str):
+                group = {'_id': spec['_id']}
+                for field, accumulator in spec.items():
+                    if field != '_id':
+                        group[field] = len(docs) * accumulator['$sum']
+                docs = [group] if docs else []
+            else:
+                raise CommandError(f"aggregation stage {name} is not supported by the local mongo")
+        return self.open_cursor(f"{db}.{command['aggregate']}", docs, command.get('cursor', {}).get('batchSize'))
+
+
+def apply_update(doc, update):
+    "Document after a replacement or a `$set`/`$setOnInsert`/`$inc` update"
+    if not any(key.startswith('$') for key in update):
+        return dict(update)
+    doc = dict(doc or {})
+    for op, fields in update.items():
+        for field, value in fields.items():
+            if op in ('$set', '$setOnInsert'):
+                doc[field] = value
+            elif op == '$inc':
+                doc[field] = doc.get(field, 0) + value
+            elif op == '$unset':
+                doc.pop(field, None)
+            else:
+                raise CommandError(f"update operator {op} is not supported by the local mongo")
+    return doc
+
+
+def take_batch(docs, batch_size=None):
+    "Splits the next batch off `docs`, bounded by `batch_size` documents and `MAX_BATCH_BYTES`"
+    n_bytes = 0
+    for i, doc in enumerate(docs):
+        if batch_size and i == batch_size:
+            return docs[:i], docs[i:]
+        n_bytes += len(bson.encode(doc))
+        if i and n_bytes > MAX_BATCH_BYTES:
+            return docs[:i], docs[i:]
+    return docs, []
+
+
+def read_cstring(data, offset):
+    end = data.index(b'\x00', offset)
+    return data[offset:end].decode(), end + 1
+
+
+def read_document(data, offset):
+    size = struct.unpack_from('<i', data, offset)[0]
+    return bson.decode(data[offset:offset + size]), offset + size
+
+
+def parse_op_msg(data):
+    "Command of an OP_MSG, with the document sequences (like the inserted `documents`) merged in"
+    flags = struct.unpack_from('<I', data, 0)[0]
+    offset = 4
+    end = len(data) - (4 if flags & 1 else 0)
+    command, sequences = {}, {}
+    while offset < end:
+        kind = data[offset]
+        offset += 1
+        if kind == 0:
+            command, offset = read_document(data, offset)
+        else:
+            size = struct.unpack_from('<i', data, offset)[0]
+            section_end = offset + size
+            identifier, offset = read_cstring(data, offset + 4)
+            docs = sequences.setdefault(identifier, [])
+            while offset < section_end:
+                doc, offset = read_document(data, offset)
+                docs.append(doc)
+    command.update(sequences)
+    return flags, command
+
+
+class MongoHandler(socketserver.BaseRequestHandler):
+    mongo = None
+
+    def read_exactly(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data.extend(chunk)
+        return bytes(data)
+
+    def send(self, request_id, op_code, payload):
+        header = struct.pack('<iiii', 16 + len(payload), 0, request_id, op_code)
+        self.request.sendall(header + payload)
+
+    def handle(self):
+        try:
+            while True:
+                length, request_id, _, op_code = struct.unpack('<iiii', self.read_exactly(16))
+                data = self.read_exactly(length - 16)
+                if op_code == OP_MSG:
+                    flags, command = parse_op_msg(data)
+                    response = self.mongo.run_command(command.pop('$db', 'admin'), command)
+                    if not flags & MORE_TO_COME:
+                        self.send(request_id, OP_MSG, struct.pack('<I', 0) + b'\x00' + bson.encode(response))
+                elif op_code == OP_QUERY:
+                    # Legacy handshake, `admin.$cmd` with the command as the query
+                    namespace, offset = read_cstring(data, 4)
+                    command, _ = read_document(data, offset + 8)
+                    command = command.get('$query', command)
+                    response = self.mongo.run_command(namespace.split('.', 1)[0], command)
+                    payload = struct.pack('<iqii', 0, 0, 0, 1) + bson.encode(response)
+                    self.send(request_id, OP_REPLY, payload)
+                else:
+                    return
+        except (ConnectionError, OSError):
+            return
@@ -0,0 +1,290 @@
+"""Benchmarks the pipeline stages on a synthetic MS MARCO shaped corpus, against
+in-process stand-ins of Elasticsearch and MongoDB, and writes the throughput,
+latencies and peak RSS of each stage as JSON:
+
+    python benchmarks/run.py --scale small --output results/HEAD.json
+    python benchmarks/run.py --scale small --output results/new.json --compare results/HEAD.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.normpath(os.path.join(BENCHMARKS_DIR, os.pardir, 'src'))
+sys.path.insert(0, SRC_DIR)
+
+import pymongo
+import pyarrow.parquet as pq
+from config import *
+from metrics import load_snapshots, merge_snapshots
+from corpus import SCALES, generate_corpus, get_dataset_path, read_jsonl
+from local_es import LocalElasticsearch
+from local_mongo import LocalMongo
+
+STAGES = ['build_index', 'termvectors_queries', 'extract_similarity_features', 'build_dataset_from_features', 'evaluate', 'train']
+# Similarities written by the `field` and `msearch` modes, one run each
+EXTRACTION_SIMILARITIES = {'bm25': 'bm25', 'lmir.dir': 'lmir_dir', 'lmir.jm': 'lmir_jm'}
+INSERT_BATCH_SIZE = 10000
+
+
+def get_git_revision():
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=BENCHMARKS_DIR, capture_output=True, text=True).stdout.strip()
+    return {'commit': git('rev-parse', 'HEAD') or None, 'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def seed_document_features(mongodb_host, workdir):
+    "Loads the document features of the corpus, which `build_dataset_from_features` reads from mongo"
+    with pymongo.MongoClient(mongodb_host) as client:
+        coll = client[FEATURES_DB]['document_features_v2']
+        coll.drop()
+        coll.create_index('doc_id', unique=True)
+        batch = []
+        for doc in read_jsonl(get_dataset_path(workdir, '../datasets/document_features.jsonl')):
+            batch.append(doc)
+            if len(batch) == INSERT_BATCH_SIZE:
+                coll.insert_many(batch)
+                batch = []
+        if batch:
+            coll.insert_many(batch)
+        return coll.count_documents({})
+
+
+def summarize_metrics(path):
+    "Counters and latency percentiles in ms of every process of a stage metrics file"
+    if not os.path.exists(path):
+        return {}, {}
+    counters, _, histograms, _ = merge_snapshots(load_snapshots(path))
+    latencies = {
+        name: {
+            'count': histogram.count,
+            'mean_ms': histogram.total / histogram.count * 1000 if histogram.count else 0.,
+            'p50_ms': histogram.percentile(50) * 1000,
+            'p99_ms': histogram.percentile(99) * 1000,
+            'max_ms': histogram.max * 1000,
+        }
+        for name, histogram in sorted(histograms.items())
+    }
+    return counters, latencies
+
+
+def count_delta(after, before):
+    return {name: after[name] - before.get(name, 0) for name in sorted(after) if after[name] != before.get(name, 0)}
+
+
+class Runner:
+    def __init__(self, workdir, es, mongo, workers, verbose=False):
+        self.workdir = workdir
+        self.es = es
+        self.mongo = mongo
+        self.workers = workers
+        self.verbose = verbose
+        for name in ['src', 'data', 'metrics', 'logs', 'usage']:
+            os.makedirs(os.path.join(workdir, name), exist_ok=True)
+
+    def run(self, name, script, argv, items=None):
+        """Runs `script` in a subprocess and returns the stage results. `items` maps
+        the merged counters to the number of items processed by the stage"""
+        metrics_path = os.path.join(self.workdir, 'metrics', f'{name}.jsonl')
+        usage_path = os.path.join(self.workdir, 'usage', f'{name}.json')
+        spec_path = os.path.join(self.workdir, 'usage', f'{name}.spec.json')
+        for path in [metrics_path, usage_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        # `evaluate` has no metrics file
+        if script != 'evaluate.py':
+            argv = argv + ['--metrics', metrics_path]
+        with open(spec_path, 'w') as f:
+            json.dump({
+                'script': script,
+                'argv': argv,
+                'cwd': os.path.join(self.workdir, 'src'),
+                'es_host': self.es.url,
+                'mongodb_host': self.mongo.host,
+                'usage': usage_path,
+            }, f)
+
+        es_requests = dict(self.es.requests)
+        mongo_commands = dict(self.mongo.commands)
+        print(f"Running {name}: {script} {' '.join(argv)}")
+        start = time.perf_counter()
+        with open(os.path.join(self.workdir, 'logs', f'{name}.log'), 'w') as log:
+            process = subprocess.run(
+                [sys.executable, os.path.join(BENCHMARKS_DIR, 'stage.py'), spec_path],
+                stdout=None if self.verbose else log,
+                stderr=subprocess.STDOUT if not self.verbose else None,
+            )
+        elapsed = time.perf_counter() - start
+        if process.returncode:
+            raise RuntimeError(f"Stage `{name}` failed with status {process.returncode}, see {log.name}")
+
+        counters, latencies = summarize_metrics(metrics_path)
+        n_items = items(counters) if items else None
+        with open(usage_path) as f:
+            usage = json.load(f)
+        result = {
+            'seconds': elapsed,
+            'items': n_items,
+            'throughput': n_items / elapsed if n_items else None,
+            **usage,
+            'latencies': latencies,
+            'counters': counters,
+            'es_requests': count_delta(self.es.requests, es_requests),
+            'mongo_commands': count_delta(self.mongo.commands, mongo_commands),
+        }
+        print(f"  {elapsed:.2f}s, {n_items or 0:,} items "
+              f"({result['throughput'] or 0:,.1f}/s), peak RSS {usage['peak_rss_mb']['self']:.0f} MB")
+        return result
+
+
+def run_stages(runner, stages, extraction_mode, export_every, chunk_size):
+    results = {}
+    dev_dataset = os.path.join(runner.workdir, 'data', 'dev_dataset.parquet')
+    workers = str(runner.workers)
+
+    if 'build_index' in stages:
+        results['build_index'] = runner.run(
+            'build_index', 'build_index.py', ['--loader', 'parallel', '--recreate'],
+            items=lambda counters: sum(v for k, v in counters.items() if k.startswith('bulk.') and k.endswith('.documents')),
+        )
+
+    if 'termvectors_queries' in stages:
+        results['termvectors_queries'] = runner.run(
+            'termvectors_queries', 'termvectors_queries.py', ['--mode', 'mtermvectors', '--workers', workers],
+            items=lambda counters: counters.get('documents', 0),
+        )
+
+    if 'extract_similarity_features' in stages:
+        argv = ['--type', 'dev', '--db', FEATURES_DB, '--mode', extraction_mode,
+                '--workers', workers, '--export-every', str(export_every)]
+        if extraction_mode == 'explain':
+            # Writes every similarity to `dev_{similarity}` in a single run
+            results['extract_similarity_features'] = runner.run(
+                'extract_similarity_features', 'extract_similarity_features.py', argv + ['--coll', 'dev'],
+                items=lambda counters: counters.get('queries', 0),
+            )
+        else:
+            for similarity, key in EXTRACTION_SIMILARITIES.items():
+                name = f'extract_similarity_features.{key}'
+                results[name] = runner.run(
+                    name, 'extract_similarity_features.py',
+                    argv + ['--coll', f'dev_{key}', '--similarity', similarity],
+                    items=lambda counters: counters.get('queries', 0),
+                )
+
+    if 'build_dataset_from_features' in stages:
+        results['build_dataset_from_features'] = runner.run(
+            'build_dataset_from_features', 'build_dataset_from_features.py',
+            ['--type', 'dev', '--output', dev_dataset, '--chunk-size', str(chunk_size)],
+            items=lambda counters: counters.get('rows', 0),
+        )
+
+    if 'evaluate' in stages:
+        results['evaluate'] = runner.run(
+            'evaluate', 'evaluate.py', [dev_dataset],
+            items=lambda counters: pq.read_metadata(dev_dataset).num_rows,
+        )
+
+    if 'train' in stages:
+        results['train'] = runner.run(
+            'train', 'train.py', [dev_dataset, '--output', os.path.join(runner.workdir, 'data', 'model.json'),
+                                  '--n-estimators', '20'],
+            # `train.rows` counts every pass of XGBoost over the batches
+            items=lambda counters: pq.read_metadata(dev_dataset).num_rows,
+        )
+    return results
+
+
+def compare(results, baseline):
+    "Printable relative change of the time, throughput and peak RSS of the stages in both runs"
+    lines = [f"Compared to {baseline.get('commit') or 'baseline'}{' (dirty)' if baseline.get('dirty') else ''}",
+             f"{'stage':<44}{'seconds':>18}{'throughput':>18}{'peak RSS MB':>18}"]
+
+    def delta(new, old):
+        if not new or not old:
+            return f"{'-':>18}"
+        return f"{new:>9.1f} {(new - old) / old:>+7.1%}"
+
+    for name, stage in results['stages'].items():
+        old = baseline['stages'].get(name)
+        if old is None:
+            lines.append(f"{name:<44}{'(new stage)':>18}")
+            continue
+        lines.append(
+            f"{name:<44}{delta(stage['seconds'], old['seconds'])}"
+            f"{delta(stage['throughput'], old['throughput'])}"
+            f"{delta(stage['peak_rss_mb']['self'], old['peak_rss_mb']['self'])}"
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", choices=list(SCALES), default='small', type=str)
+    parser.add_argument("--docs", default=None, type=int, help="Overrides the number of documents of the scale")
+    parser.add_argument("--dev-queries", default=None, type=int, help="Overrides the number of dev queries of the scale")
+    parser.add_argument("--seed", default=SAMPLE_SEED, type=int, help="Seed of the synthetic corpus")
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument("--extraction-mode", choices=['field', 'msearch', 'explain'], default='explain', type=str)
+    parser.add_argument("--workers", default=4, type=int)
+    parser.add_argument("--export-every", default=50, type=int)
+    parser.add_argument("--chunk-size", default=100, type=int, help="Queries per chunk of the dataset stage")
+    parser.add_argument("--workdir", default=None, type=str,
+                        help="Corpus, data and logs of the run, defaults to a temporary directory removed at the end")
+    parser.add_argument("--output", "-o", default=None, type=str, help="JSON results file")
+    parser.add_argument("--compare", default=None, type=str, help="Results of a previous run to compare with")
+    parser.add_argument("--verbose", "-v", action='store_true', help="Shows the output of the stages instead of logging it")
+    args = parser.parse_args()
+
+    scale = dict(SCALES[args.scale])
+    if args.docs:
+        scale['docs'] = args.docs
+    if args.dev_queries:
+        scale['dev_queries'] = args.dev_queries
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    es = LocalElasticsearch().start()
+    mongo = LocalMongo().start()
+    try:
+        print(f"Generating the `{args.scale}` corpus in {workdir}")
+        start = time.perf_counter()
+        counts = generate_corpus(workdir, seed=args.seed, **scale)
+        corpus_seconds = time.perf_counter() - start
+        n_document_features = seed_document_features(mongo.host, workdir)
+        print(f"  {corpus_seconds:.2f}s, {counts['documents']:,} documents, {n_document_features:,} document features")
+
+        runner = Runner(workdir, es, mongo, args.workers, args.verbose)
+        stages = run_stages(runner, args.stages, args.extraction_mode, args.export_every, args.chunk_size)
+    finally:
+        es.stop()
+        mongo.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        **get_git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'scale': {'name': args.scale, **scale, 'seed': args.seed},
+        'options': {
+            'extraction_mode': args.extraction_mode,
+            'workers': args.workers,
+            'export_every': args.export_every,
+            'chunk_size': args.chunk_size,
+        },
+        'corpus': {'seconds': corpus_seconds, **counts},
+        'stages': stages,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote the results to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(results, json.load(f)))
@@ -0,0 +1,58 @@
+"""Runs a pipeline script against the local stand-ins, as a subprocess of `run.py`:
+
+    python stage.py SPEC_JSON
+
+The spec holds the `script`, its `argv`, the `cwd` the script runs from, the
+`es_host` and `mongodb_host` patched into `config` before the script imports
+it, and the `usage` file where the peak RSS of the stage is written"""
+import os
+import sys
+import json
+import runpy
+import resource
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+
+
+def get_peak_rss():
+    """Peak resident memory in MB of this process and of its largest waited child (a pool worker).
+    `ru_maxrss` survives the exec of the stage and starts at the peak of `run.py`,
+    so the `VmHWM` of the process is preferred where procfs is available"""
+    # `ru_maxrss` and `VmHWM` are in KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peak_rss = int(line.split()[1])
+    except OSError:
+        pass
+    return {
+        'self': peak_rss / 1024,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as f:
+        spec = json.load(f)
+
+    src_dir = os.path.normpath(SRC_DIR)
+    sys.path.insert(0, src_dir)
+    import config
+    config.ES_HOST = spec['es_host']
+    config.MONGODB_HOST = spec['mongodb_host']
+
+    # The `config` paths are relative to `src`, so the stage reads and writes the benchmark workdir
+    os.chdir(spec['cwd'])
+    script = os.path.join(src_dir, spec['script'])
+    sys.argv = [script] + spec['argv']
+    status = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    finally:
+        with open(spec['usage'], 'w') as f:
+            json.dump({'peak_rss_mb': get_peak_rss()}, f)
+    sys.exit(status)
@@ -1,10 +1,17 @@
 import pymongo
 import argparse
+import itertools
+from array import array
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import tqdm
 from config import *
 from utils import *
+from scoreddocs_store import ScoredDocs
+from ids import get_id_encoder, encode_ids, save_id_encoders, to_float32
+from metrics import init_metrics, get_metrics, summarize, timed
 import pdb
 
 import warnings
@@ -12,99 +19,254 @@ import warnings
 warnings.filterwarnings("ignore", message=".*elastic.*")
 
 def get_collection(host, db, coll):
-    return pymongo.MongoClient(host)[db][coll]
+    return get_mongo_client(host)[db][coll]
 
 
-def build_document_features():
+@timed('stage.document_features')
+def build_document_features(doc_ids=None, progress=True):
+    """Document features of the `doc_ids` strings, with int32 encoded doc ids and float32 features"""
     # Document features are extracted from the termsvector API
     coll = get_collection(MONGODB_HOST, FEATURES_DB, 'document_features_v2')
-    query = {}
+    query = {"doc_id": {"$in": doc_ids}} if doc_ids is not None else {}
     projection = {"_id": 0}
     n_docs = coll.count_documents(query)
-    cursor = tqdm.tqdm(coll.find(query, projection), total=n_docs, desc='Querying document features')
+    cursor = tqdm.tqdm(coll.find(query, projection), total=n_docs, desc='Querying document features', disable=not progress)
     df = pd.DataFrame(list(cursor))
-    return df
+    return to_float32(encode_ids(df, ['doc_id']))
 
 
-def build_scoreddocs_dataframe(type, query_ids):
-    body = {
-        "size": 10000,
-        "query": {"terms": {"query_id": query_ids}}
-    }
+def build_scoreddocs_dataframe(type, query_ids, progress=True, scoreddocs=None):
+    if scoreddocs is not None:
+        # Prefetched candidates, no need to query the scoreddocs index
+        groups = list(scoreddocs.groups(query_ids))
+        df = pd.DataFrame({
+            'query_id': [query_id for query_id, doc_ids, _ in groups for _ in doc_ids],
+            'doc_id': np.concatenate([doc_ids for _, doc_ids, _ in groups]) if groups else [],
+            'score': np.concatenate([scores for _, _, scores in groups]) if groups else [],
+        })
+        return to_float32(encode_ids(df))
+
     index = get_scoreddocs_index(type)
-    n_docs, gen = documents_from_index_factory(host=[ES_HOST], index=index, body=body)
-    docs = [doc for doc in tqdm.tqdm(gen(), total=n_docs, desc="Building scoreddocs dataframe")]
+    n_docs, gen = documents_by_terms_factory(host=[ES_HOST], index=index, field="query_id", values=query_ids)
+    docs = [doc for doc in tqdm.tqdm(gen(), total=n_docs, desc="Building scoreddocs dataframe", disable=not progress)]
     df = pd.DataFrame(docs)
-    return df
+    return to_float32(encode_ids(df))
 
 
-def build_query_document_features(type, query_ids):
-    similarity_collection_map = {
+def get_similarity_collection_map(type):
+    return {
         'bm25': f'{type}_bm25',
         'lmir_dir': f'{type}_lmir_dir',
         'lmir_jm': f'{type}_lmir_jm'
     }
+
+
+def sorted_scoreddocs_factory(type, query_ids):
+    "Scoreddocs of `query_ids` sorted by (query_id, doc_id)"
+    body = {
+        "size": 10000,
+        "sort": [{"query_id.keyword": "asc"}, {"doc_id.keyword": "asc"}],
+    }
+    index = get_scoreddocs_index(type)
+    return documents_by_terms_factory(host=[ES_HOST], index=index, field="query_id", values=query_ids, body=body)
+
+
+def sorted_scoreddocs_groups(type, query_ids, scoreddocs=None):
+    """Returns the number of scoreddocs and a generator of `(query_id, doc_ids, scores)`
+    sorted by (query_id, doc_id), read from the prefetched `scoreddocs` when given"""
+    if scoreddocs is not None:
+        query_ids = list(set(query_ids))
+        rows = scoreddocs.query_rows(query_ids) if len(scoreddocs) else np.full(len(query_ids), -1)
+        rows = rows[rows >= 0]
+        n_docs = int((scoreddocs.offsets[rows + 1] - scoreddocs.offsets[rows]).sum())
+        return n_docs, lambda: scoreddocs.groups(query_ids)
+
+    n_docs, scoreddocs_gen = sorted_scoreddocs_factory(type, query_ids)
+
+    def gen():
+        for query_id, docs in itertools.groupby(scoreddocs_gen(), key=lambda doc: doc['query_id']):
+            docs = list(docs)
+            yield query_id, np.array([doc['doc_id'] for doc in docs]), np.array([float(doc['score']) for doc in docs])
+    return n_docs, gen
+
+
+def sorted_similarity_cursor(type, similarity, query_ids):
+    "Similarity features of `query_ids` sorted by the (query_id, doc_id) unique index"
+    collection = get_similarity_collection_map(type)[similarity]
+    coll = get_collection(MONGODB_HOST, FEATURES_DB, collection)
+    query = {"query_id": {"$in": query_ids}}
+    projection = {"_id": 0}
+    return coll.find(query, projection, batch_size=10000).sort([("query_id", 1), ("doc_id", 1)])
+
+
+def similarity_blocks(cursor, fields, storage='rows'):
+    "Yields `(query_id, doc_ids, scores)` for each query of a sorted similarity cursor"
+    if storage == 'packed':
+        for record in cursor:
+            yield unpack_query_features(record, fields)
+        return
+
+    for query_id, rows in itertools.groupby(cursor, key=lambda doc: doc['query_id']):
+        rows = list(rows)
+        doc_ids = np.array([doc['doc_id'] for doc in rows])
+        scores = np.array(
+            [[doc.get(field, np.nan) for field in fields] for doc in rows],
+            dtype=np.float64
+        )
+        yield query_id, doc_ids, scores
+
+
+@timed('stage.query_document_features')
+def build_query_document_features(type, query_ids, progress=True, storage='rows', scoreddocs=None):
+    """Left joins the scoreddocs with every similarity collection in a single
+    k-way sort-merge pass, all sources are read sorted by (query_id, doc_id)"""
+    similarities = list(get_similarity_collection_map(type))
     document_fields = ['url', 'title', 'body', 'anchor_text', 'whole_document']
 
-    df_merged = build_scoreddocs_dataframe(type, query_ids)
-    for similarity, collection in similarity_collection_map.items():
-        print(f"Fetching data for {similarity} on collection : {collection}")
-        coll = get_collection(MONGODB_HOST, FEATURES_DB, collection)
-        query = {"query_id": {"$in": query_ids}}
-        projection = {"_id": 0}
-        n_docs = coll.count_documents(query)
-        cursor = tqdm.tqdm(coll.find(query, projection), total=n_docs, desc=f"Building query-doc features - similarity `{similarity}`")
-        df = pd.DataFrame(list(cursor))
-
-        # Possible missing variables
-        for col in document_fields:
-            if col not in df.columns:
-                print(col, df.columns)
-                df[col] = 0
-        
-        col_name_map = {col: f'{similarity}_{col}' for col in document_fields}
-        df = df.rename(columns=col_name_map)
-        df_merged = df_merged.merge(df, on=['query_id', 'doc_id'], how='left')
-    
-    df_merged = (
-        df_merged
-        .sort_values(by=['query_id', 'doc_id'])
-        .fillna(0)
-    )
-    return df_merged
+    blocks = {
+        similarity: similarity_blocks(
+            sorted_similarity_cursor(type, similarity, query_ids),
+            document_fields,
+            storage
+        )
+        for similarity in similarities
+    }
+    heads = {similarity: next(block_iter, None) for similarity, block_iter in blocks.items()}
+
+    query_id_column, doc_id_column = [], []
+    score_column = array('d')
+    feature_blocks = {similarity: [] for similarity in similarities}
+
+    n_docs, groups = sorted_scoreddocs_groups(type, query_ids, scoreddocs)
+    pbar = tqdm.tqdm(total=n_docs, desc="Merging query-doc features", disable=not progress)
+    for query_id, doc_ids, scores in groups():
+        query_id_column.extend([query_id] * len(doc_ids))
+        doc_id_column.extend(doc_ids.tolist())
+        score_column.extend(scores.tolist())
+
+        for similarity, block_iter in blocks.items():
+            # Advance the source up to the current query, missing pairs are filled with 0
+            head = heads[similarity]
+            while head is not None and head[0] < query_id:
+                head = next(block_iter, None)
+            heads[similarity] = head
 
+            values = np.zeros((len(doc_ids), len(document_fields)), dtype=np.float32)
+            if head is not None and head[0] == query_id and len(head[1]):
+                _, block_doc_ids, block_scores = head
+                positions = np.minimum(np.searchsorted(block_doc_ids, doc_ids), len(block_doc_ids) - 1)
+                matched = block_doc_ids[positions] == doc_ids
+                values[matched] = block_scores[positions[matched]]
+            feature_blocks[similarity].append(values)
+        pbar.update(len(doc_ids))
+    pbar.close()
 
-def get_source_queries(type, sample_frac=None):
+    # Join keys are int32 codes and features float32 from here on
+    columns = {
+        'query_id': get_id_encoder('query_id').encode(query_id_column),
+        'doc_id': get_id_encoder('doc_id').encode(doc_id_column),
+        'score': np.frombuffer(score_column, dtype=np.float64).astype(np.float32),
+    }
+    for similarity, values in feature_blocks.items():
+        if values:
+            values = np.nan_to_num(np.concatenate(values), nan=0.)
+        else:
+            values = np.zeros((0, len(document_fields)), dtype=np.float32)
+        for j, field in enumerate(document_fields):
+            columns[f'{similarity}_{field}'] = values[:, j]
+    return pd.DataFrame(columns)
+
+
+@timed('stage.source_queries')
+def get_source_queries(type, sample_frac=None, seed=SAMPLE_SEED):
+    """Sorted query ids of the `type` dataset. With `sample_frac`, a sample without
+    replacement that only depends on `seed` and the set of ids, not on the scroll order"""
     index = get_queries_index(type)
     n_queries, gen = queries_from_index_factory(host=[ES_HOST], index=index)
 
     qids = set()
     for doc in tqdm.tqdm(gen(), total=n_queries, desc=f"Fetching queries related to `{type}` dataset"):
         qids.add(doc['query_id'])
+    qids = sorted(qids)
 
     if not sample_frac:
-        return list(qids)
-    
-    np.random.seed(42)
-    n_samples = int(sample_frac * n_queries)
-    samples = np.random.choice(list(qids), size=n_samples)
-    return list(samples)
+        return qids
 
+    rng = np.random.default_rng(seed)
+    n_samples = int(sample_frac * len(qids))
+    samples = rng.choice(len(qids), size=n_samples, replace=False)
+    return [qids[i] for i in np.sort(samples)]
 
-def get_relevance_labels(type, query_ids):
-    body = {
-        "size": 100,
-        "query": {"terms": {"query_id": query_ids}}
-    }
+
+@timed('stage.relevance_labels')
+def get_relevance_labels(type, query_ids, progress=True):
+    """Relevance grades of `query_ids` as a `query_id, doc_id, label` frame,
+    with one row per relevant document and int32 encoded ids"""
     index = get_qrels_index(type)
-    n_docs, gen = documents_from_index_factory(host=[ES_HOST], index=index, body=body)
-    relevance_map = {
-        doc['query_id']: doc['doc_id']
-        for doc in tqdm.tqdm(gen(), total=n_docs, desc="Fetching document relevancy grade (qrels)")
-    }
-    return relevance_map
+    n_docs, gen = documents_by_terms_factory(host=[ES_HOST], index=index, field="query_id", values=query_ids)
+    query_id_column, doc_id_column = [], []
+    label_column = array('b')
+    for doc in tqdm.tqdm(gen(), total=n_docs, desc="Fetching document relevancy grade (qrels)", disable=not progress):
+        query_id_column.append(doc['query_id'])
+        doc_id_column.append(doc['doc_id'])
+        label_column.append(int(doc.get('relevance', 1)))
+    labels = pd.DataFrame({
+        'query_id': get_id_encoder('query_id').encode(query_id_column),
+        'doc_id': get_id_encoder('doc_id').encode(doc_id_column),
+        'label': np.frombuffer(label_column, dtype=np.int8),
+    })
+    # The same pair can not be labeled twice by the join
+    return labels.drop_duplicates(subset=['query_id', 'doc_id'], keep='last')
+
+
+def add_relevance_labels(df, labels):
+    "Left joins the `get_relevance_labels` frame, the pairs without a qrel get the label 0"
+    df = df.merge(labels, how='left', on=['query_id', 'doc_id'])
+    df['label'] = df['label'].fillna(0).astype(np.int8)
+    return df
 
 
+@timed('stage.dataset_chunk')
+def build_dataset_chunk(type, query_ids, storage='rows', scoreddocs=None):
+    "Builds the dataset rows of `query_ids`, fetching only the documents features they reference"
+    df_query_doc = build_query_document_features(type, query_ids, progress=False, storage=storage, scoreddocs=scoreddocs)
+    doc_ids = get_id_encoder('doc_id').decode(df_query_doc['doc_id'].unique()).tolist()
+    df_doc = build_document_features(doc_ids, progress=False)
+    df = df_query_doc.merge(df_doc, how='left', on='doc_id')
+    labels = get_relevance_labels(type, query_ids, progress=False)
+    # The left join turns the missing document features into float64 NaN
+    return to_float32(add_relevance_labels(df, labels))
+
+
+def write_dataset_in_chunks(type, query_ids, output, chunk_size, storage='rows', scoreddocs=None):
+    """Streams the dataset to a single parquet file, one row group per chunk
+    of `chunk_size` queries, so memory is bounded by the chunk size"""
+    query_ids = sorted(query_ids)
+    n_chunks = (len(query_ids) + chunk_size - 1) // chunk_size
+    writer, columns = None, None
+    n_rows = 0
+    try:
+        chunks = batch_iterator(query_ids, chunk_size)
+        for chunk_query_ids in tqdm.tqdm(chunks, total=n_chunks, desc="Writing dataset chunks"):
+            df = build_dataset_chunk(type, chunk_query_ids, storage, scoreddocs)
+            if writer is None:
+                columns = list(df.columns)
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                writer = pq.ParquetWriter(output, table.schema)
+            else:
+                # Features missing from a chunk still need the first chunk schema
+                df = df.reindex(columns=columns)
+                table = pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False)
+            with get_metrics().timer('parquet.write_table'):
+                writer.write_table(table)
+            n_rows += len(df)
+            get_metrics().increment('rows', len(df))
+            get_metrics().increment('queries', len(chunk_query_ids))
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
 
 if __name__ == "__main__":
 
@@ -113,27 +275,54 @@ if __name__ == "__main__":
         "--type", choices=["dev", "train", "eval"], type=str, default="dev"
     )
     parser.add_argument("--output", "-o", type=str)
+    parser.add_argument("--chunk-size", default=None, type=int,
+                        help="Streams the dataset in chunks of this many queries instead of building it in memory")
+    parser.add_argument("--storage", choices=['rows', 'packed'], default='rows', type=str,
+                        help="Storage format used by `extract_similarity_features` for the similarity collections")
+    parser.add_argument("--prefetch-scoreddocs", action='store_true',
+                        help="Streams the scoreddocs index once instead of querying it with the sampled query ids")
+    parser.add_argument("--sample-frac", default=None, type=float,
+                        help="Fraction of the queries sampled, defaults to 10% of train and all of dev/eval. "
+                             "Use 1 with `--chunk-size` to build the full train split for `train`")
+    parser.add_argument("--metrics", default=None, type=str,
+                        help="JSON lines metrics file, defaults to a new file in `METRICS_DIR`")
     args = parser.parse_args()
+    init_metrics('build_dataset_from_features', args.metrics)
 
-    sample_frac = 0.10 if args.type == "train" else None
+    scoreddocs = ScoredDocs.from_index(args.type) if args.prefetch_scoreddocs else None
+
+    sample_frac = args.sample_frac
+    if sample_frac is None:
+        sample_frac = 0.10 if args.type == "train" else None
+    elif sample_frac >= 1:
+        sample_frac = None
     sampled_qids = get_source_queries(args.type, sample_frac)
+
+    if args.chunk_size:
+        n_rows = write_dataset_in_chunks(args.type, sampled_qids, args.output, args.chunk_size, args.storage, scoreddocs)
+        print(f"Wrote {n_rows:,} rows for {len(sampled_qids):,} queries to {args.output}")
+        save_id_encoders()
+        print(summarize())
+        exit(0)
     
-    query_relevant_document_map = get_relevance_labels(args.type, sampled_qids)
+    labels = get_relevance_labels(args.type, sampled_qids)
 
     df_doc = build_document_features()
-    df_query_doc = build_query_document_features(args.type, sampled_qids)
+    df_query_doc = build_query_document_features(args.type, sampled_qids, storage=args.storage, scoreddocs=scoreddocs)
     df = df_query_doc.merge(df_doc, how='left', on='doc_id')
 
     print(df.columns)
     print(df.shape, len(sampled_qids))
 
-    query_relevant_document = df['query_id'].map(query_relevant_document_map)
-    df['label'] = query_relevant_document == df['doc_id']
-    df['label'] = df['label'].astype(int)
+    df = to_float32(add_relevance_labels(df, labels))
 
     print(df.label.value_counts())
     print(df.label.value_counts(True))
 
-    df.to_parquet(args.output)
+    with get_metrics().timer('parquet.write_table'):
+        df.to_parquet(args.output)
+    save_id_encoders()
+    get_metrics().increment('rows', len(df))
+    print(summarize())
 
 
@@ -1,15 +1,19 @@
 import os
+import time
+import sqlite3
 import tqdm
 import json
 import argparse
 import traceback
 import elasticsearch
 from collections import deque
+from contextlib import contextmanager
 from elasticsearch import helpers
 from pprint import pprint
 from config import *
+from utils import get_es_client
+from metrics import init_metrics, get_metrics, summarize
 
-import pdb
 
 def get_generic_document_iterator(path, id_field=None, limit=None):
     with open(path, 'r') as f:
@@ -17,9 +21,6 @@ def get_generic_document_iterator(path, id_field=None, limit=None):
             if limit and i == limit + 1:
                 return
             doc = json.loads(line)
-            if doc['doc_id'] != 'D2765617':
-                continue
-            pdb.set_trace()
             if id_field:
                 doc['_id'] = doc[id_field]
             yield doc
@@ -41,14 +42,17 @@ def get_anchor_text_indexer(path, index):
         }
         yield query
 
+def build_whole_document(doc):
+    return ' '.join([
+        doc['url'],
+        doc['title'],
+        doc['body'],
+        doc.get('anchor_text', '')
+    ])
+
 def get_concat_field_updater(path, index):
     for doc in get_document_indexer(path):
-        concat_document_field = ' '.join([
-            doc['url'],
-            doc['title'],
-            doc['body'],
-            doc.get('anchor_text', '')
-        ])
+        concat_document_field = build_whole_document(doc)
         query = {
             '_op_type': 'update',
             '_index': index,
@@ -59,6 +63,38 @@ def get_concat_field_updater(path, index):
         }
         yield query
 
+def build_anchor_lookup(path, db_path):
+    "Stores the anchor text of each document in a sqlite table keyed by doc_id"
+    # The `parallel` loader consumes the indexer generator from a pool thread
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS anchors (doc_id TEXT PRIMARY KEY, text TEXT) WITHOUT ROWID")
+    if conn.execute("SELECT 1 FROM anchors LIMIT 1").fetchone():
+        print(f"Reusing anchor text lookup `{db_path}`")
+        return conn
+
+    count = count_lines(path)
+    rows = ((doc['doc_id'], doc['text']) for doc in get_generic_document_iterator(path))
+    for batch in tqdm.tqdm(batch_iterator(rows, 10000), total=count // 10000, desc="Building anchor text lookup"):
+        conn.executemany("INSERT OR REPLACE INTO anchors VALUES (?, ?)", batch)
+    conn.commit()
+    return conn
+
+
+def get_joined_document_indexer(path, anchors_conn, batch_size=500):
+    "Documents joined with their anchor text and `whole_document`, so each one is indexed exactly once"
+    for docs in batch_iterator(get_document_indexer(path, id_field='doc_id'), batch_size):
+        doc_ids = [doc['doc_id'] for doc in docs]
+        placeholders = ','.join('?' * len(doc_ids))
+        anchors = dict(anchors_conn.execute(
+            f"SELECT doc_id, text FROM anchors WHERE doc_id IN ({placeholders})",
+            doc_ids
+        ))
+        for doc in docs:
+            doc['anchor_text'] = anchors.get(doc['doc_id'], '')
+            doc['whole_document'] = build_whole_document(doc)
+            yield doc
+
+
 def batch_iterator(generator, batch_size):
     batch = []
     for i, doc in enumerate(generator, 1):
@@ -69,106 +105,208 @@ def batch_iterator(generator, batch_size):
     yield batch
 
 
-def compute_in_batches(json_path, index, generator):
-    f = os.popen(f"wc -l {json_path}")
-    count = int(f.read().split(" ")[0])
+def create_documents_index(es, recreate=False):
+    "Creates the documents index with the explicit mapping of `MSMARCO_DOCS_INDEX_CONFIG`"
+    if es.indices.exists(index=MSMARCO_DOCS_INDEX):
+        if not recreate:
+            print(f"Index `{MSMARCO_DOCS_INDEX}` already exists, keeping its mapping")
+            return
+        es.indices.delete(index=MSMARCO_DOCS_INDEX)
+    es.indices.create(index=MSMARCO_DOCS_INDEX, body=MSMARCO_DOCS_INDEX_CONFIG)
 
-    batch = []
-    batch_size = 10000
-    n_batches = count // batch_size
-    iterator = batch_iterator(generator, batch_size)
-    es = elasticsearch.Elasticsearch(hosts=[ES_HOST])
-    i = 0
-    for i, batch in tqdm.tqdm(enumerate(iterator, 1), total=n_batches):
-        try:
-            response = helpers.bulk(es, batch, index=index)
-        except Exception:
-            traceback.print_exc()
-            print(f"Error in batch {i}")
-            break
+
+def count_lines(path, buffer_size=1024 * 1024):
+    with open(path, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(buffer_size), b''))
+
+
+@contextmanager
+def bulk_indexing_settings(es, index):
+    "Disables refreshes and replicas of `index` while it is bulk loaded, restoring them afterwards"
+    if not es.indices.exists(index=index):
+        es.indices.create(index=index)
+    response = es.indices.get_settings(index=index, flat_settings=True)
+    settings = next(iter(response.values()))['settings']
+    previous = {
+        'index.refresh_interval': settings.get('index.refresh_interval'),
+        'index.number_of_replicas': settings.get('index.number_of_replicas'),
+    }
+    es.indices.put_settings(index=index, body={'index.refresh_interval': '-1', 'index.number_of_replicas': 0})
+    try:
+        yield
+    finally:
+        # Unset values are restored to the ES defaults
+        es.indices.put_settings(index=index, body=previous)
+        es.indices.refresh(index=index)
+
+
+def is_rejection(item):
+    return any(result.get('status') == 429 for result in item.values())
+
+
+def compute_in_batches(json_path, index, generator, loader='serial'):
+    count = count_lines(json_path)
+    es = get_es_client()
+
+    n_docs, n_errors, n_rejections = 0, 0, 0
+    start = time.perf_counter()
+    with bulk_indexing_settings(es, index):
+        if loader == 'parallel':
+            results = helpers.parallel_bulk(
+                es,
+                generator,
+                index=index,
+                thread_count=BULK_THREADS,
+                chunk_size=BULK_CHUNK_SIZE,
+                max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+                raise_on_error=False,
+                raise_on_exception=False,
+                request_timeout=BULK_REQUEST_TIMEOUT,
+            )
+            for ok, item in tqdm.tqdm(results, total=count):
+                get_metrics().increment(f'bulk.{index}.documents' if ok else f'bulk.{index}.errors')
+                n_docs += 1
+                if not ok:
+                    n_errors += 1
+                    n_rejections += is_rejection(item)
+        else:
+            batch_size = 10000
+            n_batches = count // batch_size
+            iterator = batch_iterator(generator, batch_size)
+            for i, batch in tqdm.tqdm(enumerate(iterator, 1), total=n_batches):
+                try:
+                    _, errors = helpers.bulk(es, batch, index=index, raise_on_error=False)
+                    get_metrics().increment(f'bulk.{index}.documents', len(batch) - len(errors))
+                    get_metrics().increment(f'bulk.{index}.errors', len(errors))
+                    n_docs += len(batch)
+                    n_errors += len(errors)
+                    n_rejections += sum(is_rejection(item) for item in errors)
+                except Exception:
+                    traceback.print_exc()
+                    print(f"Error in batch {i}")
+                    break
+
+    elapsed = time.perf_counter() - start
+    print(f"Indexed {n_docs:,} documents in {elapsed:.2f}s ({n_docs/elapsed:.2f} docs/s) - "
+          f"{n_errors:,} errors, {n_rejections:,} bulk rejections")
+    get_metrics().increment(f'bulk.{index}.rejections', n_rejections)
+    return n_docs, n_errors, n_rejections
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument("--loader", choices=['serial', 'parallel'], default='serial', type=str,
+                        help="`parallel` sends byte bounded chunks from `BULK_THREADS` threads")
+    parser.add_argument("--ingestion", choices=['single', 'passes'], default='single', type=str,
+                        help="`single` joins the anchor text and writes each document once, "
+                             "`passes` indexes the documents and then updates them twice")
+    parser.add_argument("--recreate", action="store_true",
+                        help="Deletes the documents index and creates it again with the current mapping")
+    parser.add_argument("--metrics", default=None, type=str,
+                        help="JSON lines metrics file, defaults to a new file in `METRICS_DIR`")
     args = parser.parse_args()
+    init_metrics('build_index', args.metrics)
 
-    es = elasticsearch.Elasticsearch(
-        hosts=["localhost:9200"]
-    )
-    print("Populating original documents...")
-    compute_in_batches(
-        MSMARCO_DOCS_PATH,
-        MSMARCO_DOCS_INDEX,
-        get_document_indexer(path=MSMARCO_DOCS_PATH, id_field='doc_id')
-    )
+    es = get_es_client()
+    create_documents_index(es, recreate=args.recreate)
 
-    print("Adding `anchor_text` field...")
-    compute_in_batches(
-        MSMARCO_ANCHORS_PATH,
-        MSMARCO_DOCS_INDEX,
-        get_anchor_text_indexer(path=MSMARCO_ANCHORS_PATH, index=MSMARCO_DOCS_INDEX)
-    )
+    if args.ingestion == 'single':
+        anchors_conn = build_anchor_lookup(MSMARCO_ANCHORS_PATH, MSMARCO_ANCHORS_DB_PATH)
+        print("Populating documents with `anchor_text` and `whole_document` fields...")
+        compute_in_batches(
+            MSMARCO_DOCS_PATH,
+            MSMARCO_DOCS_INDEX,
+            get_joined_document_indexer(MSMARCO_DOCS_PATH, anchors_conn),
+            loader=args.loader
+        )
+        anchors_conn.close()
+    else:
+        print("Populating original documents...")
+        compute_in_batches(
+            MSMARCO_DOCS_PATH,
+            MSMARCO_DOCS_INDEX,
+            get_document_indexer(path=MSMARCO_DOCS_PATH, id_field='doc_id'),
+            loader=args.loader
+        )
 
-    print("Adding concatenated `whole_document` field...")
-    compute_in_batches(
-        MSMARCO_DOCS_PATH,
-        MSMARCO_DOCS_INDEX,
-        get_concat_field_updater(path=MSMARCO_DOCS_PATH, index=MSMARCO_DOCS_INDEX)
-    )
+        print("Adding `anchor_text` field...")
+        compute_in_batches(
+            MSMARCO_ANCHORS_PATH,
+            MSMARCO_DOCS_INDEX,
+            get_anchor_text_indexer(path=MSMARCO_ANCHORS_PATH, index=MSMARCO_DOCS_INDEX),
+            loader=args.loader
+        )
+
+        print("Adding concatenated `whole_document` field...")
+        compute_in_batches(
+            MSMARCO_DOCS_PATH,
+            MSMARCO_DOCS_INDEX,
+            get_concat_field_updater(path=MSMARCO_DOCS_PATH, index=MSMARCO_DOCS_INDEX),
+            loader=args.loader
+        )
 
     print("Populating dev queries...")
     compute_in_batches(
         DEV_QUERIES_PATH,
         DEV_QUERIES_INDEX,
-        get_generic_document_iterator(DEV_QUERIES_PATH)
+        get_generic_document_iterator(DEV_QUERIES_PATH),
+        loader=args.loader
     )
 
     print("Populating dev scoreddocs...")
     compute_in_batches(
         DEV_SCOREDDOCS_PATH,
         DEV_SCOREDDOCS_INDEX,
-        get_generic_document_iterator(DEV_SCOREDDOCS_PATH)
+        get_generic_document_iterator(DEV_SCOREDDOCS_PATH),
+        loader=args.loader
     )
 
     print("Populating dev qrels...")
     compute_in_batches(
         DEV_QRELS_PATH,
         DEV_QRELS_INDEX,
-        get_generic_document_iterator(DEV_QRELS_PATH)
+        get_generic_document_iterator(DEV_QRELS_PATH),
+        loader=args.loader
     )
 
     print("Populating train queries...")
     compute_in_batches(
         TRAIN_QUERIES_PATH,
         TRAIN_QUERIES_INDEX,
-        get_generic_document_iterator(TRAIN_QUERIES_PATH)
+        get_generic_document_iterator(TRAIN_QUERIES_PATH),
+        loader=args.loader
     )
 
     print("Populating train scoreddocs...")
     compute_in_batches(
         TRAIN_SCOREDDOCS_PATH,
         TRAIN_SCOREDDOCS_INDEX,
-        get_generic_document_iterator(TRAIN_SCOREDDOCS_PATH)
+        get_generic_document_iterator(TRAIN_SCOREDDOCS_PATH),
+        loader=args.loader
     )
 
     print("Populating train qrels...")
     compute_in_batches(
         TRAIN_QRELS_PATH,
         TRAIN_QRELS_INDEX,
-        get_generic_document_iterator(TRAIN_QRELS_PATH)
+        get_generic_document_iterator(TRAIN_QRELS_PATH),
+        loader=args.loader
     )
 
     print("Populating eval queries...")
     compute_in_batches(
         EVAL_QUERIES_PATH,
         EVAL_QUERIES_INDEX,
-        get_generic_document_iterator(EVAL_QUERIES_PATH)
+        get_generic_document_iterator(EVAL_QUERIES_PATH),
+        loader=args.loader
     )
 
     print("Populating eval scoreddocs...")
     compute_in_batches(
         EVAL_SCOREDDOCS_PATH,
         EVAL_SCOREDDOCS_INDEX,
-        get_generic_document_iterator(EVAL_SCOREDDOCS_PATH)
+        get_generic_document_iterator(EVAL_SCOREDDOCS_PATH),
+        loader=args.loader
     )
 
+    print(summarize())
@@ -0,0 +1,101 @@
+import threading
+from collections import deque
+from pymongo.errors import BulkWriteError
+from config import *
+from mongo_writer import is_duplicate_only
+
+
+class Checkpoint:
+    """Compact record of the work done by a job that processes ids in sorted order.
+
+    Every id <= `watermark` is complete, except the ones in `failed` (kept sorted),
+    so a restart only retries `failed` and resumes the producer after `watermark`
+    instead of scanning the whole output collection. Ids can be completed from
+    another thread, such as the callbacks of a `MongoWriter`.
+
+    The failed ids are stored one per document in `CHECKPOINT_FAILED_COLL`, so
+    their number is not bounded by the 16MB limit of the checkpoint document."""
+
+    def __init__(self, client, name, db=FEATURES_DB):
+        self.coll = client[db][CHECKPOINTS_COLL]
+        self.failed_coll = client[db][CHECKPOINT_FAILED_COLL]
+        self.failed_coll.create_index([('checkpoint', 1), ('id', 1)], unique=True)
+        self.name = name
+        doc = self.coll.find_one({'_id': name}) or {}
+        self.watermark = doc.get('watermark')
+        # Failures written before a crash that did not save the watermark are above it, the producer yields them again
+        self.failed = sorted(
+            doc['id'] for doc in self.failed_coll.find({'checkpoint': name}, {'_id': 0, 'id': 1})
+            if self.watermark is not None and doc['id'] <= self.watermark
+        )
+        self._dispatched = deque()
+        self._status = {}
+        self._lock = threading.RLock()
+
+    @property
+    def exists(self):
+        return self.watermark is not None
+
+    def bootstrap(self, output_colls, id_field):
+        """Initializes the watermark from the ids already written, for outputs created before the checkpoint.
+        A job writing several collections resumes after the smallest of their largest ids,
+        so no collection skips ids it never received"""
+        watermarks = []
+        for output_coll in output_colls:
+            doc = output_coll.find_one({}, {'_id': 0, id_field: 1}, sort=[(id_field, -1)])
+            if not doc:
+                return
+            watermarks.append(doc[id_field])
+        if watermarks:
+            self.watermark = min(watermarks)
+            self.save()
+
+    def dispatch(self, id):
+        "Must be called in the producer order, with the retried failed ids first"
+        with self._lock:
+            self._dispatched.append(id)
+
+    def complete(self, id, ok=True):
+        "Marks `id` as done, only after its results were written"
+        with self._lock:
+            self._status[id] = ok
+
+    def commit(self):
+        "Advances the watermark over the completed prefix of the dispatched ids and persists it"
+        with self._lock:
+            failed = set(self.failed)
+            changed = False
+            while self._dispatched and self._dispatched[0] in self._status:
+                id = self._dispatched.popleft()
+                if self._status.pop(id):
+                    failed.discard(id)
+                else:
+                    failed.add(id)
+                if self.watermark is None or id > self.watermark:
+                    self.watermark = id
+                changed = True
+
+            if changed:
+                previous = set(self.failed)
+                self.failed = sorted(failed)
+                self.save(failed - previous, previous - failed)
+
+    def save(self, new_failed=(), recovered=()):
+        """Persists the watermark and the changes of the failed ids. The new failures are written
+        before the watermark moves past them, the recovered ids are deleted after it"""
+        if new_failed:
+            try:
+                self.failed_coll.insert_many(
+                    [{'checkpoint': self.name, 'id': id} for id in sorted(new_failed)],
+                    ordered=False
+                )
+            except BulkWriteError as e:
+                if not is_duplicate_only(e):
+                    raise
+        self.coll.replace_one(
+            {'_id': self.name},
+            {'_id': self.name, 'watermark': self.watermark},
+            upsert=True
+        )
+        if recovered:
+            self.failed_coll.delete_many({'checkpoint': self.name, 'id': {'$in': sorted(recovered)}})
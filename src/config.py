@@ -1,6 +1,8 @@
 MSMARCO_DOCS_INDEX = "msmarco-documents"
 MSMARCO_DOCS_PATH = "../datasets/msmarco-documents.jsonl"
 MSMARCO_ANCHORS_PATH = "../datasets/anchor-text.jsonl"
+# On disk doc_id -> anchor text lookup, built from MSMARCO_ANCHORS_PATH
+MSMARCO_ANCHORS_DB_PATH = "../datasets/anchor-text.sqlite"
 MSMARCO_FEATURES_INDEX = "msmarco-features"
 
 TRAIN_QUERIES_INDEX = "train_queries"
@@ -24,7 +26,16 @@ EVAL_SCOREDDOCS_PATH = "../datasets/eval/scoreddocs.jsonl"
 ES_HOST = "http://localhost:9200"
 ES_TIMEOUT = 30
 MAX_RETRIES = 3
+# Seconds to wait before the first application level retry, doubled on each attempt
+ES_RETRY_BACKOFF = 1
+# Max number of keep-alive connections held by each client (per process)
+ES_POOL_MAXSIZE = 10
 SCROLL_EXPIRATION = "1m"
+# Number of slices read concurrently by the sliced scroll, one per shard
+ES_SCROLL_SLICES = 4
+# `terms` queries over large id lists are split below `index.max_terms_count` (65536)
+TERMS_QUERY_CHUNK_SIZE = 10000
+TERMS_QUERY_WORKERS = 4
 
 
 # Config for the script that generates 
@@ -33,41 +44,102 @@ ES_SCROLL_BATCH_SIZE = 5000
 MONGO_INSERT_BATCH_SIZE = 15000
 WORKERS = 12
 MONGODB_HOST = 'localhost:27017'
+# Background mongo writer, batches queued before blocking the producer,
+# max bytes of each write and write concern (`w` as an int or "majority")
+MONGO_WRITER_QUEUE_SIZE = 8
+MONGO_WRITER_BATCH_BYTES = 16 * 1024 * 1024
+MONGO_WRITE_CONCERN = {"w": 1}
 FEATURES_DB = 'features'
 TERM_VECTORS_COLL = 'term_vectors'
+CHECKPOINTS_COLL = 'checkpoints'
+# Failed ids of the checkpoints, one document each so the list is not bounded by the document size
+CHECKPOINT_FAILED_COLL = 'checkpoints_failed'
+# Memory mapped copy of the term vectors collection
+TERM_VECTORS_STORE_PATH = "../data/term_vectors"
+# Codes of the ids that can not be encoded as their number, see `ids.IdEncoder`
+ID_DICTIONARY_PATH = "../data/id_dictionary.json"
+# Number of documents requested on each `_mtermvectors` call
+MTERMVECTORS_BATCH_SIZE = 200
+
+# Metrics files written by the scripts, and how often each process appends a snapshot
+METRICS_DIR = "../metrics"
+METRICS_FLUSH_INTERVAL = 10
+
+# Seed of the train queries sample
+SAMPLE_SEED = 42
 
 OUTPUT_FILE = "features.parquet.gzip"
 
+# Config for the bulk loader of `build_index`
+BULK_THREADS = 4
+BULK_CHUNK_SIZE = 2000
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+BULK_REQUEST_TIMEOUT = 120
+
+# Similarity parameters, must match the ones of the index similarities
+BM25_K1 = 1.2
+BM25_B = 0.75
+LM_DIRICHLET_MU = 2000
+LM_JELINEK_MERCER_LAMBDA = 0.1
+
+# Config for the similarity features extraction
+DOCUMENT_FIELDS = ["body", "anchor_text", "title", "url", "whole_document"]
+MSEARCH_BATCH_SIZE = 20
+MSEARCH_MAX_CONCURRENT_SEARCHES = 10
+# Max number of ES requests in flight for the asyncio engine
+ASYNC_MAX_IN_FLIGHT = 256
+
+# Config for the persistent cache of the similarity scores shared by the extraction
+# workers (`feature_cache`), bounded to a number of (query, doc, field) entries
+FEATURE_CACHE_PATH = "../data/feature_cache.sqlite"
+FEATURE_CACHE_MAX_ENTRIES = 50_000_000
+# Rows written by each process between two evictions, the table can exceed the bound by this much per worker
+FEATURE_CACHE_EVICT_EVERY = 100_000
+
+# Config for the `rerank` service, documents whose features are kept in memory
+RERANK_CACHE_SIZE = 100000
+
+# Config for `train`, rows per batch streamed to XGBoost, rounded down to whole queries
+TRAIN_BATCH_ROWS = 1_000_000
+
+# Multi-fields indexed with each similarity, so all of them can be queried
+# without reindexing the corpus: `{field}.{subfield}`
+SIMILARITY_SUBFIELDS = {
+    "bm25": "bm25_default",
+    "lmir_dir": "lm_dirichlet",
+    "lmir_jm": "lm_jelinek_mercer",
+}
+
+MSMARCO_TEXT_FIELD_MAPPING = {
+    "type": "text",
+    "term_vector": "with_positions_offsets",
+    "store": True,
+    "fields": {
+        subfield: {"type": "text", "similarity": similarity}
+        for subfield, similarity in SIMILARITY_SUBFIELDS.items()
+    },
+}
+
 MSMARCO_DOCS_INDEX_CONFIG = {
     "mappings": {
         "properties": {
-            "anchor_text": {
-                "type": "text",
-                "term_vector": "with_positions_offsets",
-                "store": True,
-            },
-            "body": {
-                "type": "text",
-                "term_vector": "with_positions_offsets",
-                "store": True,
-            },
-            "concat_document_fields": {
-                "type": "text",
-                "term_vector": "with_positions_offsets",
-                "store": True,
-            },
+            "anchor_text": MSMARCO_TEXT_FIELD_MAPPING,
+            "body": MSMARCO_TEXT_FIELD_MAPPING,
+            "whole_document": MSMARCO_TEXT_FIELD_MAPPING,
             "doc_id": {"type": "keyword"},
-            "title": {
-                "type": "text",
-                "term_vector": "with_positions_offsets",
-                "store": True,
-            },
-            "url": {
-                "type": "text",
-                "term_vector": "with_positions_offsets",
-                "store": True,
+            "title": MSMARCO_TEXT_FIELD_MAPPING,
+            "url": MSMARCO_TEXT_FIELD_MAPPING,
+        }
+    },
+    "settings": {
+        "index": {
+            "number_of_shards": "4",
+            "number_of_replicas": "0",
+            "similarity": {
+                "bm25_default": {"type": "BM25", "k1": BM25_K1, "b": BM25_B},
+                "lm_dirichlet": {"type": "LMDirichlet", "mu": LM_DIRICHLET_MU},
+                "lm_jelinek_mercer": {"type": "LMJelinekMercer", "lambda": LM_JELINEK_MERCER_LAMBDA},
             },
         }
     },
-    "settings": {"index": {"number_of_shards": "4", "number_of_replicas": "0"}},
 }
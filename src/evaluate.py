@@ -0,0 +1,142 @@
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from config import *
+
+
+def get_group_offsets(query_ids):
+    "Start offsets of each group of contiguous query ids, followed by the total size"
+    query_ids = np.asarray(query_ids)
+    if len(query_ids) == 0:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(query_ids[1:] != query_ids[:-1]) + 1
+    return np.concatenate([[0], starts, [len(query_ids)]]).astype(np.int64)
+
+
+def get_group_index(offsets):
+    "Group number of each row"
+    sizes = np.diff(offsets)
+    return np.repeat(np.arange(len(sizes)), sizes)
+
+
+def rank_within_groups(scores, offsets):
+    """Ranks (starting at 1) of each row inside its group, by descending score.
+    Returns the ranks and the rows ordered by (group, rank)"""
+    group = get_group_index(offsets)
+    order = np.lexsort((-np.asarray(scores), group))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - offsets[group[order]] + 1
+    return ranks, order
+
+
+def mrr_at_k(labels, ranks, offsets, k):
+    group = get_group_index(offsets)
+    relevant = (np.asarray(labels) > 0) & (ranks <= k)
+    first_rank = np.full(len(offsets) - 1, np.inf)
+    np.minimum.at(first_rank, group[relevant], ranks[relevant])
+    return float(np.mean(1 / first_rank))
+
+
+def _dcg(gains, ranks, group, n_groups, k):
+    top_k = ranks <= k
+    discounts = 1 / np.log2(ranks[top_k] + 1)
+    return np.bincount(group[top_k], weights=gains[top_k] * discounts, minlength=n_groups)
+
+
+def ndcg_at_k(labels, ranks, offsets, k):
+    labels = np.asarray(labels, dtype=np.float64)
+    group = get_group_index(offsets)
+    n_groups = len(offsets) - 1
+    gains = 2 ** labels - 1
+    ideal_ranks, _ = rank_within_groups(labels, offsets)
+
+    dcg = _dcg(gains, ranks, group, n_groups, k)
+    idcg = _dcg(gains, ideal_ranks, group, n_groups, k)
+    ndcg = np.divide(dcg, idcg, out=np.zeros(n_groups), where=idcg > 0)
+    return float(np.mean(ndcg))
+
+
+def recall_at_k(labels, ranks, offsets, k):
+    group = get_group_index(offsets)
+    n_groups = len(offsets) - 1
+    relevant = np.asarray(labels) > 0
+    n_relevant = np.bincount(group[relevant], minlength=n_groups)
+    n_retrieved = np.bincount(group[relevant & (ranks <= k)], minlength=n_groups)
+    recall = np.divide(n_retrieved, n_relevant, out=np.zeros(n_groups), where=n_relevant > 0)
+    return float(np.mean(recall))
+
+
+def mean_average_precision(labels, ranks, order, offsets):
+    group = get_group_index(offsets)
+    n_groups = len(offsets) - 1
+    relevant = (np.asarray(labels) > 0)[order]
+
+    # Relevant documents seen up to each position, restarting on every group
+    cumulative = np.cumsum(relevant)
+    group_start = np.concatenate([[0], cumulative])[offsets[:-1]]
+    seen = cumulative - group_start[group[order]]
+
+    precisions = seen[relevant] / ranks[order][relevant]
+    n_relevant = np.bincount(group[order][relevant], minlength=n_groups)
+    average_precision = np.bincount(group[order][relevant], weights=precisions, minlength=n_groups)
+    average_precision = np.divide(average_precision, n_relevant, out=np.zeros(n_groups), where=n_relevant > 0)
+    return float(np.mean(average_precision))
+
+
+def evaluate_scores(scores, labels, offsets, k_values=(10, 100)):
+    """Computes the ranking metrics of flat `scores`/`labels` arrays, where the
+    queries are contiguous groups delimited by `offsets`"""
+    ranks, order = rank_within_groups(scores, offsets)
+    metrics = {}
+    for k in k_values:
+        metrics[f'mrr@{k}'] = mrr_at_k(labels, ranks, offsets, k)
+        metrics[f'ndcg@{k}'] = ndcg_at_k(labels, ranks, offsets, k)
+        metrics[f'recall@{k}'] = recall_at_k(labels, ranks, offsets, k)
+    metrics['map'] = mean_average_precision(labels, ranks, order, offsets)
+    return metrics
+
+
+def predict_scores(model, X):
+    "Scores the whole feature matrix at once, with the positive class probability for classifiers"
+    if hasattr(model, 'predict_proba'):
+        return model.predict_proba(X)[:, 1]
+    return np.asarray(model.predict(X))
+
+
+def evaluate_model(model, X, labels, offsets, k_values=(10, 100)):
+    return evaluate_scores(predict_scores(model, X), labels, offsets, k_values)
+
+
+def get_similarity_columns(columns):
+    "The `{similarity}_{field}` feature columns of a dataset"
+    return [
+        col for col in columns
+        if any(col.endswith(f'_{field}') for field in DOCUMENT_FIELDS)
+    ]
+
+
+def load_features(path):
+    columns = pq.read_schema(path).names
+    similarity_columns = get_similarity_columns(columns)
+    df = pd.read_parquet(path, columns=['query_id', 'label'] + similarity_columns)
+    df = df.sort_values(by='query_id', kind='stable')
+    return df, similarity_columns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="Features parquet built by `build_dataset_from_features`")
+    parser.add_argument("--k", nargs='+', default=[10, 100], type=int)
+    args = parser.parse_args()
+
+    df, similarity_columns = load_features(args.path)
+    offsets = get_group_offsets(df['query_id'].to_numpy())
+    labels = df['label'].to_numpy()
+
+    results = {}
+    for col in similarity_columns:
+        results[col] = evaluate_scores(df[col].to_numpy(), labels, offsets, args.k)
+
+    print(f"Evaluated {len(offsets) - 1:,} queries")
+    print(pd.DataFrame(results).T.sort_values(by=f'mrr@{args.k[0]}', ascending=False).to_string())
@@ -1,3 +1,6 @@
+import time
+import atexit
+import asyncio
 import traceback
 import tqdm
 import argparse
@@ -9,49 +12,36 @@ import multiprocessing as mp
 import pdb
 import itertools
 from functools import partial
-from collections import defaultdict
+from collections import defaultdict, deque
+from checkpoint import Checkpoint
+from mongo_writer import MongoWriter, parse_write_concern, is_duplicate_only
+from pymongo.errors import BulkWriteError
+from metrics import init_metrics, get_metrics, summarize, timed, get_instrumented_async_connection_class
+from scoreddocs_store import ScoredDocs, init_scoreddocs, set_scoreddocs, get_scoreddocs
+from feature_cache import FeatureCache, init_feature_cache, get_feature_cache, get_cache_similarity, get_index_version
 
 import warnings
 
 warnings.filterwarnings("ignore", message=".*elastic.*")
 
 
-def get_es_client():
-    es = elasticsearch.Elasticsearch(
-        hosts=[ES_HOST], timeout=ES_TIMEOUT, max_retries=MAX_RETRIES, retry_on_timeout=True
-    )
-    return es
+def get_scoreddocs_query_body(query_doc):
+    return {"size": 100, "query": {"match": {"query_id": query_doc['query_id']}}}
 
 
-def get_similarity_features(es, query_doc, scoreddocs):
+def get_query_scoreddocs(es, query_doc, type):
+    "Pre scored documents of a query, looked up locally when the process has a prefetched store"
+    scoreddocs = get_scoreddocs()
+    if scoreddocs is not None:
+        return scoreddocs.get_hits(query_doc['query_id'])
+    response = es.search(
+        index=get_scoreddocs_index(type),
+        body=get_scoreddocs_query_body(query_doc)
+    )
+    return get_hits_from_response(response)
 
-    # stores each document feature since they can be in different orders on each query
-    doc_features_map = defaultdict(lambda: {})
-    for field in ["body", "anchor_text", "title", "url", "whole_document"]:
-        body = {
-            "size": len(scoreddocs),
-            "_source": False,
-            # "explain": True,
-            "query": {
-                "bool": {
-                    # Restrict only for the pre scored documents
-                    "filter": {
-                        "terms": {
-                            "doc_id": [doc['doc_id'] for doc in scoreddocs]
-                            }
-                        },
-                    # Search for field of interest
-                    "should": {
-                        "match": {field: query_doc['text']}
-                    }
-                }
-            }
-        }
-        response = es.search(index=MSMARCO_DOCS_INDEX, body=body)
-        for hit in response['hits']['hits']:
-            doc_id = hit['_id']
-            doc_features_map[doc_id][field] = hit['_score']
 
+def build_features_records(query_doc, doc_features_map):
     features = []
     for doc_id, doc_features in doc_features_map.items():
         features.append({
@@ -62,25 +52,207 @@ def get_similarity_features(es, query_doc, scoreddocs):
     return features
 
 
+def get_cached_scores(query_doc, scoreddocs, keys):
+    "Scores of the `(similarity, field)` keys found in the feature cache, as `{key: {doc_id: score}}`"
+    cache = get_feature_cache()
+    if cache is None or not scoreddocs:
+        return {}
+    return cache.get(query_doc['text'], keys, [doc['doc_id'] for doc in scoreddocs])
+
+
+def cache_scores(query_doc, scoreddocs, scores):
+    "Stores the searched `{key: {doc_id: score}}`, the documents missing from the hits are stored as None"
+    cache = get_feature_cache()
+    if cache is None or not scoreddocs or not scores:
+        return
+    doc_ids = [doc['doc_id'] for doc in scoreddocs]
+    cache.put(query_doc['text'], {
+        key: {doc_id: doc_scores.get(doc_id) for doc_id in doc_ids}
+        for key, doc_scores in scores.items()
+    })
+
+
+def build_fields_features_map(field_scores):
+    "Features of each document from `{field: {doc_id: score}}`, skipping the documents not returned"
+    doc_features_map = defaultdict(lambda: {})
+    for field, doc_scores in field_scores.items():
+        for doc_id, score in doc_scores.items():
+            if score is not None:
+                doc_features_map[doc_id][field] = score
+    return doc_features_map
+
+
+def get_similarity_features(es, query_doc, scoreddocs, similarity=None):
+    cache_similarity = get_cache_similarity(similarity)
+    cached = get_cached_scores(query_doc, scoreddocs, [(cache_similarity, field) for field in DOCUMENT_FIELDS])
+
+    # stores each document feature since they can be in different orders on each query
+    field_scores, searched = {}, {}
+    for field in DOCUMENT_FIELDS:
+        if (cache_similarity, field) in cached:
+            field_scores[field] = cached[(cache_similarity, field)]
+            continue
+        body = get_similarity_query_body(query_doc, scoreddocs, field, similarity)
+        response = es.search(index=MSMARCO_DOCS_INDEX, body=body)
+        field_scores[field] = {hit['_id']: hit['_score'] for hit in response['hits']['hits']}
+        searched[(cache_similarity, field)] = field_scores[field]
+    cache_scores(query_doc, scoreddocs, searched)
+
+    return build_features_records(query_doc, build_fields_features_map(field_scores))
+
+
+def get_scoreddocs_msearch(es, query_docs, type, max_concurrent_searches=MSEARCH_MAX_CONCURRENT_SEARCHES):
+    "Returns the pre scored documents of each query, or None for the failed searches"
+    scoreddocs = get_scoreddocs()
+    if scoreddocs is not None:
+        return [scoreddocs.get_hits(query_doc['query_id']) for query_doc in query_docs]
+
+    scoreddocs_index = get_scoreddocs_index(type)
+    bodies = [get_scoreddocs_query_body(query_doc) for query_doc in query_docs]
+    responses = msearch(es, scoreddocs_index, bodies, max_concurrent_searches)
+
+    query_rated_docs = []
+    for query_doc, response in zip(query_docs, responses):
+        if 'error' in response:
+            print(f"Failed to retrieve scoreddocs - query_id : `{query_doc['query_id']}` - {response['error']}")
+            query_rated_docs.append(None)
+        else:
+            query_rated_docs.append(get_hits_from_response(response))
+    return query_rated_docs
+
+
+def get_similarity_features_msearch(es, query_docs, query_rated_docs, max_concurrent_searches=MSEARCH_MAX_CONCURRENT_SEARCHES, similarity=None):
+    """Computes the same records as `get_similarity_features` for a batch of queries,
+    sending the searches of every (query, field) pair in a single `_msearch` request"""
+    cache_similarity = get_cache_similarity(similarity)
+    field_scores = [{} for _ in query_docs]
+    search_keys, bodies = [], []
+    for i, (query_doc, scoreddocs) in enumerate(zip(query_docs, query_rated_docs)):
+        if not scoreddocs:
+            continue
+        cached = get_cached_scores(query_doc, scoreddocs, [(cache_similarity, field) for field in DOCUMENT_FIELDS])
+        for field in DOCUMENT_FIELDS:
+            if (cache_similarity, field) in cached:
+                field_scores[i][field] = cached[(cache_similarity, field)]
+                continue
+            search_keys.append((i, field))
+            bodies.append(get_similarity_query_body(query_doc, scoreddocs, field, similarity))
+
+    responses = msearch(es, MSMARCO_DOCS_INDEX, bodies, max_concurrent_searches) if bodies else []
+
+    # Demultiplex the responses back to their queries
+    searched = [{} for _ in query_docs]
+    failed = set()
+    for (i, field), response in zip(search_keys, responses):
+        if 'error' in response:
+            failed.add(i)
+            continue
+        field_scores[i][field] = {hit['_id']: hit['_score'] for hit in response['hits']['hits']}
+        searched[i][(cache_similarity, field)] = field_scores[i][field]
+
+    features = []
+    for i, (query_doc, scoreddocs) in enumerate(zip(query_docs, query_rated_docs)):
+        if i in failed:
+            print(f"Skipping query specific error - query_id : `{query_doc['query_id']}`...")
+            features.append([])
+        elif not scoreddocs:
+            features.append([])
+        else:
+            cache_scores(query_doc, scoreddocs, searched[i])
+            features.append(build_features_records(query_doc, build_fields_features_map(field_scores[i])))
+    return features
+
+
+def get_all_similarities_query_body(query_doc, scoreddocs, fields=DOCUMENT_FIELDS, similarities=SIMILARITY_SUBFIELDS):
+    """Single search matching every (field, similarity) multi-field, with `explain`
+    so the score of each clause can be recovered from the hits explanations"""
+    return {
+        "size": len(scoreddocs),
+        "_source": False,
+        "explain": True,
+        "query": {
+            "bool": {
+                # Restrict only for the pre scored documents
+                "filter": {
+                    "terms": {
+                        "doc_id": [doc['doc_id'] for doc in scoreddocs]
+                        }
+                    },
+                "should": [
+                    {"match": {get_similarity_field(field, similarity): query_doc['text']}}
+                    for field in fields
+                    for similarity in similarities
+                ]
+            }
+        }
+    }
+
+
+def get_explanation_scores(explanation, scores=None):
+    """Sums the term weights of an explanation by field. Lucene describes each
+    of them as `weight(body.bm25:term in 12) [...]`, the clauses that do not
+    match a document are absent from its explanation"""
+    if scores is None:
+        scores = defaultdict(float)
+    description = explanation.get('description', '')
+    if description.startswith('weight('):
+        field = description[len('weight('):].split(':', 1)[0]
+        scores[field] += explanation['value']
+    else:
+        for detail in explanation.get('details', []):
+            get_explanation_scores(detail, scores)
+    return scores
+
+
+def get_all_similarities_features(es, query_doc, scoreddocs, fields=DOCUMENT_FIELDS, similarities=SIMILARITY_SUBFIELDS):
+    """Computes the records of `get_similarity_features` for every similarity in a
+    single search, returns `{similarity: records}`. Only the similarities missing
+    from the feature cache are searched"""
+    keys = [(similarity, field) for similarity in similarities for field in fields]
+    scores = get_cached_scores(query_doc, scoreddocs, keys)
+    missing = [similarity for similarity in similarities if any((similarity, field) not in scores for field in fields)]
+
+    if missing:
+        body = get_all_similarities_query_body(query_doc, scoreddocs, fields, missing)
+        response = es.search(index=MSMARCO_DOCS_INDEX, body=body)
+        searched = {(similarity, field): {} for similarity in missing for field in fields}
+        for hit in response['hits']['hits']:
+            hit_scores = get_explanation_scores(hit['_explanation'])
+            for similarity in missing:
+                for field in fields:
+                    searched[(similarity, field)][hit['_id']] = hit_scores.get(get_similarity_field(field, similarity), 0.0)
+        cache_scores(query_doc, scoreddocs, searched)
+        scores.update(searched)
+
+    return {
+        similarity: build_features_records(
+            query_doc, build_fields_features_map({field: scores[(similarity, field)] for field in fields})
+        )
+        for similarity in similarities
+    }
+
+
+def init_worker(host=ES_HOST, maxsize=ES_POOL_MAXSIZE, scoreddocs_handle=None, feature_cache_config=None):
+    "Pool initializer, creates the worker ES client, attaches the prefetched scoreddocs and the feature cache"
+    init_es_client(host, maxsize)
+    init_scoreddocs(scoreddocs_handle)
+    init_feature_cache(feature_cache_config)
+
+
 class MaxTriesException(Exception):
     def __init__(self, msg, *args, **kwargs):
         super().__init__(msg, *args, **kwargs)
 
 
-def extract_features_for_all_docs(query_doc, type):
+@timed('extract.query')
+def extract_features_for_all_docs(query_doc, type, similarity=None):
     try:
         # Get the pre scored documents
         es = get_es_client()
-        scoreddocs_index = get_scoreddocs_index(type)
-        body = {"size": 100, "query": {"match": {"query_id": query_doc['query_id']}}}
-        response = es.search(
-            index=scoreddocs_index,
-            body=body
-        )
-        query_rated_docs = get_hits_from_response(response)
+        query_rated_docs = get_query_scoreddocs(es, query_doc, type)
 
         # Feature for the best 100 documents
-        query_doc_features = get_similarity_features(es, query_doc, query_rated_docs)
+        query_doc_features = get_similarity_features(es, query_doc, query_rated_docs, similarity)
         return query_doc_features
     except Exception:
         traceback.print_exc()
@@ -93,6 +265,266 @@ def extract_features_for_all_docs(query_doc, type):
             raise
 
 
+@timed('extract.query')
+def extract_all_similarities_features_for_all_docs(query_doc, type):
+    "Same as `extract_features_for_all_docs` for every similarity at once, returns `{similarity: records}`"
+    try:
+        es = get_es_client()
+        query_rated_docs = get_query_scoreddocs(es, query_doc, type)
+        return get_all_similarities_features(es, query_doc, query_rated_docs)
+    except Exception:
+        traceback.print_exc()
+        es = get_es_client()
+        if es.cluster.health()['status'] == 'green':
+            print(f"Skipping query specific error - query_id : `{query_doc['query_id']}`...")
+            return {}
+        else:
+            raise
+
+
+@timed('extract.batch')
+def extract_features_for_query_batch(query_docs, type, max_concurrent_searches=MSEARCH_MAX_CONCURRENT_SEARCHES, similarity=None):
+    "Batched version of `extract_features_for_all_docs`, returns the features of each query"
+    try:
+        es = get_es_client()
+        query_rated_docs = get_scoreddocs_msearch(es, query_docs, type, max_concurrent_searches)
+        return get_similarity_features_msearch(es, query_docs, query_rated_docs, max_concurrent_searches, similarity)
+    except Exception:
+        traceback.print_exc()
+        es = get_es_client()
+        if es.cluster.health()['status'] == 'green':
+            print(f"Skipping batch specific error - query_ids : `{[doc['query_id'] for doc in query_docs]}`...")
+            return [[] for _ in query_docs]
+        else:
+            raise
+
+
+def get_output_collections(db, coll, mode):
+    "Collection written for each similarity, the `explain` mode writes one `{coll}_{similarity}` per similarity"
+    if mode == 'explain':
+        return {similarity: db[f'{coll}_{similarity}'] for similarity in SIMILARITY_SUBFIELDS}
+    return {None: db[coll]}
+
+
+def get_key_fields(storage='rows'):
+    "Fields identifying a features document, used to upsert them"
+    return ('query_id',) if storage == 'packed' else ('query_id', 'doc_id')
+
+
+def export_features(writer, collections, batch, batch_ids, storage='rows', checkpoint=None):
+    """Queues a batch of queries features on the background `writer`, their ids are
+    recorded on the checkpoint once written. `collections` comes from `get_output_collections`"""
+    writes = []
+    for similarity, features_coll in collections.items():
+        similarity_batch = batch if similarity is None else [features.get(similarity, []) for features in batch]
+        docs = to_storage_documents(similarity_batch, storage)
+        if docs:
+            writes.append((features_coll, docs))
+
+    def on_written():
+        if checkpoint is not None:
+            for query_id, ok in batch_ids:
+                checkpoint.complete(query_id, ok)
+            checkpoint.commit()
+    writer.put(writes, on_written)
+
+
+def get_features_iterator(p, queries, args):
+    "Yields `(query_id, features)` of each query, regardless of the execution mode"
+    # imap returns the results in the dispatch order, so the ids are matched through a queue
+    query_ids = deque()
+
+    def dispatch(queries):
+        for query_doc in queries:
+            query_ids.append(query_doc['query_id'])
+            get_metrics().gauge('extract.pending_queries', len(query_ids))
+            yield query_doc
+
+    if args.mode == 'msearch':
+        get_batch_features = partial(
+            extract_features_for_query_batch,
+            type=args.type,
+            max_concurrent_searches=args.max_concurrent_searches,
+            similarity=args.similarity
+        )
+        for batch_features in p.imap(get_batch_features, batch_iterator(dispatch(queries), args.batch_size)):
+            for features in batch_features:
+                yield query_ids.popleft(), features
+    elif args.mode == 'explain':
+        get_query_document_features = partial(extract_all_similarities_features_for_all_docs, type=args.type)
+        for features in p.imap(get_query_document_features, dispatch(queries)):
+            yield query_ids.popleft(), features
+    else:
+        get_query_document_features = partial(
+            extract_features_for_all_docs,
+            type=args.type,
+            similarity=args.similarity
+        )
+        for features in p.imap(get_query_document_features, dispatch(queries)):
+            yield query_ids.popleft(), features
+
+
+async def _bounded_search(semaphore, es, **kwargs):
+    async with semaphore:
+        return await es.search(**kwargs)
+
+
+async def extract_features_for_all_docs_async(es, semaphore, query_doc, type, similarity=None):
+    """Coroutine version of `extract_features_for_all_docs`, the field searches run concurrently.
+    The fields found in the feature cache are not searched"""
+    try:
+        scoreddocs = get_scoreddocs()
+        if scoreddocs is not None:
+            query_rated_docs = scoreddocs.get_hits(query_doc['query_id'])
+        else:
+            scoreddocs_index = get_scoreddocs_index(type)
+            body = get_scoreddocs_query_body(query_doc)
+            response = await _bounded_search(semaphore, es, index=scoreddocs_index, body=body)
+            query_rated_docs = get_hits_from_response(response)
+
+        cache_similarity = get_cache_similarity(similarity)
+        cached = get_cached_scores(query_doc, query_rated_docs, [(cache_similarity, field) for field in DOCUMENT_FIELDS])
+        field_scores = {field: cached[(cache_similarity, field)] for field in DOCUMENT_FIELDS if (cache_similarity, field) in cached}
+        fields = [field for field in DOCUMENT_FIELDS if field not in field_scores]
+
+        responses = await asyncio.gather(*[
+            _bounded_search(
+                semaphore,
+                es,
+                index=MSMARCO_DOCS_INDEX,
+                body=get_similarity_query_body(query_doc, query_rated_docs, field, similarity)
+            )
+            for field in fields
+        ])
+        searched = {}
+        for field, response in zip(fields, responses):
+            field_scores[field] = {hit['_id']: hit['_score'] for hit in response['hits']['hits']}
+            searched[(cache_similarity, field)] = field_scores[field]
+        cache_scores(query_doc, query_rated_docs, searched)
+        return build_features_records(query_doc, build_fields_features_map(field_scores))
+    except Exception:
+        traceback.print_exc()
+        health = await es.cluster.health()
+        if health['status'] == 'green':
+            print(f"Skipping query specific error - query_id : `{query_doc['query_id']}`...")
+            return []
+        else:
+            raise
+
+
+async def insert_documents(coll, docs):
+    "Unordered insert tolerating the documents already written by a previous run"
+    try:
+        await coll.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if not is_duplicate_only(e):
+            raise
+
+
+def import_async_clients():
+    "Clients of the `async` engine, from the optional `async` extra (`poetry install -E async`)"
+    try:
+        # The connection of `AsyncElasticsearch` is built on aiohttp
+        import aiohttp
+        from elasticsearch import AsyncElasticsearch
+        from motor.motor_asyncio import AsyncIOMotorClient
+    except ImportError as e:
+        raise ImportError(
+            f"the `async` engine requires the `async` extra (motor and aiohttp), "
+            f"install it with `poetry install -E async`: {e}"
+        ) from e
+    return AsyncElasticsearch, AsyncIOMotorClient
+
+
+async def run_async_engine(queries, type, db, coll, export_every, max_in_flight, pbar=None, storage='rows', checkpoint=None, similarity=None, write_concern=None):
+    """Extracts the features of `queries` from a single process, keeping up to
+    `max_in_flight` ES requests in flight and writing to mongo asynchronously"""
+    AsyncElasticsearch, AsyncIOMotorClient = import_async_clients()
+
+    es = AsyncElasticsearch(
+        hosts=[ES_HOST],
+        timeout=ES_TIMEOUT,
+        max_retries=MAX_RETRIES,
+        retry_on_timeout=True,
+        maxsize=max_in_flight,
+        connection_class=get_instrumented_async_connection_class(),
+    )
+    mongo_client = AsyncIOMotorClient(MONGODB_HOST)
+    features_coll = mongo_client[db][coll].with_options(write_concern=write_concern or parse_write_concern())
+    semaphore = asyncio.Semaphore(max_in_flight)
+    loop = asyncio.get_running_loop()
+
+    queries = iter(queries)
+    pending, inserts = set(), set()
+    pending_query_ids = {}
+    batch, batch_ids = [], []
+    n_processed = 0
+    exhausted = False
+
+    def mark_exported(exported_ids):
+        if checkpoint is not None:
+            for query_id, ok in exported_ids:
+                checkpoint.complete(query_id, ok)
+            checkpoint.commit()
+
+    def export_batch():
+        docs = to_storage_documents(batch, storage)
+        exported_ids = list(batch_ids)
+        batch.clear()
+        batch_ids.clear()
+        if not docs:
+            mark_exported(exported_ids)
+            return
+
+        insert_start = time.perf_counter()
+
+        def on_inserted(insert):
+            inserts.discard(insert)
+            get_metrics().observe('mongo.insert_many', time.perf_counter() - insert_start)
+            if not insert.cancelled() and insert.exception() is None:
+                get_metrics().increment('mongo.documents', len(docs))
+                mark_exported(exported_ids)
+
+        insert = asyncio.ensure_future(insert_documents(features_coll, docs))
+        inserts.add(insert)
+        insert.add_done_callback(on_inserted)
+
+    try:
+        while pending or not exhausted:
+            # Keeps the pipeline full, the generator scrolls ES synchronously so it is consumed on a thread
+            n_missing = max_in_flight - len(pending)
+            if not exhausted and n_missing > 0:
+                query_docs = await loop.run_in_executor(None, list, itertools.islice(queries, n_missing))
+                exhausted = len(query_docs) < n_missing
+                for query_doc in query_docs:
+                    task = asyncio.ensure_future(
+                        extract_features_for_all_docs_async(es, semaphore, query_doc, type, similarity)
+                    )
+                    pending.add(task)
+                    pending_query_ids[task] = query_doc['query_id']
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                features = task.result()
+                get_metrics().increment('queries' if features else 'queries.failed')
+                get_metrics().gauge('extract.pending_queries', len(pending))
+                batch.append(features)
+                batch_ids.append((pending_query_ids.pop(task), bool(features)))
+                n_processed += 1
+                if pbar is not None:
+                    pbar.update(1)
+                if len(batch) % export_every == 0:
+                    export_batch()
+
+        export_batch()
+        await asyncio.gather(*inserts)
+    finally:
+        await es.close()
+        mongo_client.close()
+    return n_processed
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -107,19 +539,61 @@ if __name__ == "__main__":
     parser.add_argument("--query-id", default=None, type=str)
     parser.add_argument("--similarity",
                         choices=['bm25', 'boolean', 'lmir.dir', 'lmir.jm', 'tfidf', 'word2vec', 'elmo'],
-                        type=str)
+                        type=str,
+                        help="Similarities with a multi-field in the index (bm25, lmir.dir, lmir.jm) query it, "
+                             "the other ones query the field with the index similarity")
+    parser.add_argument("--mode", choices=['field', 'msearch', 'explain'], default='field', type=str,
+                        help="`field` sends one search per field, `msearch` batches all of them in a single request, "
+                             "`explain` scores every field and similarity in a single search and writes `{coll}_{similarity}`")
+    parser.add_argument("--batch-size", default=MSEARCH_BATCH_SIZE, type=int,
+                        help="Number of queries per `_msearch` request")
+    parser.add_argument("--max-concurrent-searches", default=MSEARCH_MAX_CONCURRENT_SEARCHES, type=int,
+                        help="Searches executed concurrently by the cluster for each `_msearch` request")
+    parser.add_argument("--engine", choices=['process', 'async'], default='process', type=str,
+                        help="`process` uses a multiprocessing pool, `async` a single asyncio process")
+    parser.add_argument("--max-in-flight", default=ASYNC_MAX_IN_FLIGHT, type=int,
+                        help="Max number of ES requests in flight for the `async` engine")
+    parser.add_argument("--storage", choices=['rows', 'packed'], default='rows', type=str,
+                        help="`rows` stores one document per (query, doc), `packed` one per query with binary scores")
+    parser.add_argument("--es-pool-size", default=ES_POOL_MAXSIZE, type=int,
+                        help="Keep-alive connections held by the client of each worker")
+    parser.add_argument("--prefetch-scoreddocs", action='store_true',
+                        help="Streams the scoreddocs index once into shared memory instead of searching it for each query")
+    parser.add_argument("--write-concern", default=None, type=str,
+                        help="Mongo write concern `w`, a number of nodes or `majority`")
+    parser.add_argument("--write-mode", choices=['insert', 'upsert'], default='insert', type=str,
+                        help="`insert` skips the duplicated documents, `upsert` replaces them")
+    parser.add_argument("--writer-queue-size", default=MONGO_WRITER_QUEUE_SIZE, type=int,
+                        help="Batches waiting for the background writer before the producer blocks")
+    parser.add_argument("--writer-batch-bytes", default=MONGO_WRITER_BATCH_BYTES, type=int,
+                        help="Max BSON bytes sent on each mongo write")
+    parser.add_argument("--metrics", default=None, type=str,
+                        help="JSON lines metrics file, defaults to a new file in `METRICS_DIR`")
+    parser.add_argument("--feature-cache", nargs='?', const=FEATURE_CACHE_PATH, default=None, type=str,
+                        help="SQLite cache of the scores shared by the workers and the runs, defaults to `FEATURE_CACHE_PATH`")
+    parser.add_argument("--feature-cache-max-entries", default=FEATURE_CACHE_MAX_ENTRIES, type=int,
+                        help="Scores kept by the feature cache, the oldest ones are evicted")
     args = parser.parse_args()
+    if args.engine == 'async':
+        # The `async` engine sends one search per field and inserts through motor, without the `MongoWriter`
+        if args.mode != 'field':
+            parser.error(f"the `{args.mode}` mode is only supported by the `process` engine")
+        if args.write_mode != 'insert':
+            parser.error("`--write-mode upsert` is only supported by the `process` engine")
+        if args.writer_queue_size != MONGO_WRITER_QUEUE_SIZE or args.writer_batch_bytes != MONGO_WRITER_BATCH_BYTES:
+            parser.error("the `--writer-*` options are only supported by the `process` engine")
+        try:
+            import_async_clients()
+        except ImportError as e:
+            parser.error(str(e))
 
+    init_metrics('extract_similarity_features', args.metrics)
 
     queries_index = get_queries_index(args.type)
-    n_queries, queries_generator = queries_from_index_factory(
-        host=ES_HOST,
-        index=queries_index,
-        limit=args.limit
-    )
-
 
+    checkpoint = None
     if args.query_id:
+        n_total = 1
         def generator():
             doc = {
                 "query_id": args.query_id,
@@ -127,58 +601,128 @@ if __name__ == "__main__":
             }
             yield doc
     else:
-        # Since this is a long running process that can fail
-        # we add wrapper to ignore previously processed ids
-        with pymongo.MongoClient(MONGODB_HOST) as client:
-            coll = client[args.db][args.coll]
-            coll.create_index("doc_id")
-            coll.create_index("query_id")
-            coll.create_index([("query_id", 1), ("doc_id", 1)], unique=True)
-
-            n_processed = coll.count_documents({})
-            cursor = coll.find({}, {'_id': 0, 'query_id': 1}, batch_size=1000)
-            pbar = tqdm.tqdm(cursor, total=n_processed, desc="Retrieving query ids to skip")
-            ids_to_skip = {doc["query_id"] for doc in pbar}
-        
+        client = get_mongo_client()
+        output_collections = get_output_collections(client[args.db], args.coll, args.mode)
+        for coll in output_collections.values():
+            if args.storage == 'packed':
+                coll.create_index("query_id", unique=True)
+            else:
+                coll.create_index("doc_id")
+                coll.create_index("query_id")
+                coll.create_index([("query_id", 1), ("doc_id", 1)], unique=True)
+
+        # Since this is a long running process that can fail, the checkpoint
+        # lets it resume after the last exported query id
+        checkpoint = Checkpoint(client, f"{args.db}.{args.coll}")
+        if not checkpoint.exists:
+            checkpoint.bootstrap(output_collections.values(), 'query_id')
+
+        n_queries, queries_generator = queries_from_index_factory(
+            host=ES_HOST,
+            index=queries_index,
+            limit=args.limit,
+            after=checkpoint.watermark
+        )
+        if checkpoint.failed:
+            n_failed, failed_queries_generator = queries_by_ids_factory(ES_HOST, queries_index, checkpoint.failed)
+        else:
+            n_failed, failed_queries_generator = 0, lambda: iter(())
+        n_total = n_queries + n_failed
 
         def generator():
-            print(f"Skipping {len(ids_to_skip):,} {100*len(ids_to_skip)/n_queries:.2f}% query ids")
-            skipped = 0
-            for query_doc in queries_generator():
-                if ids_to_skip and query_doc['query_id'] in ids_to_skip:
-                    if skipped % 10000 == 0:
-                        print(f"Skipped {skipped:,} queries...")
-                    skipped += 1
-                else:
-                    yield query_doc
-
-    if not args.workers:
-        for query_doc in tqdm.tqdm(queries_generator(), total=n_queries):
+            print(f"Resuming after query_id `{checkpoint.watermark}`, retrying {n_failed:,} failed queries")
+            for query_doc in itertools.chain(failed_queries_generator(), queries_generator()):
+                checkpoint.dispatch(query_doc['query_id'])
+                yield query_doc
+
+    scoreddocs_handle = None
+    if args.prefetch_scoreddocs:
+        scoreddocs = ScoredDocs.from_index(args.type)
+        if args.engine == 'async':
+            set_scoreddocs(scoreddocs)
+        else:
+            scoreddocs_handle = scoreddocs.share()
+            atexit.register(scoreddocs.unlink)
+        print(f"Prefetched the candidates of {len(scoreddocs):,} queries")
+
+    feature_cache_config = None
+    if args.feature_cache:
+        feature_cache_config = {
+            'path': args.feature_cache,
+            'version': get_index_version(get_es_client()),
+            'max_entries': args.feature_cache_max_entries,
+        }
+        # Scores of a previous mapping or similarity config are never read again
+        feature_cache = FeatureCache(**feature_cache_config)
+        feature_cache.invalidate()
+        # The workers evict while they write, the last rows are trimmed once the run ends
+        feature_cache.evict()
+        atexit.register(feature_cache.evict)
+
+    if args.engine == 'async':
+        # The cache is read and written from the event loop, through the connection of this process
+        init_feature_cache(feature_cache_config)
+        pbar = tqdm.tqdm(total=n_total)
+        start = time.perf_counter()
+        n_processed = asyncio.run(run_async_engine(
+            generator(),
+            type=args.type,
+            db=args.db,
+            coll=args.coll,
+            export_every=args.export_every,
+            max_in_flight=args.max_in_flight,
+            pbar=pbar,
+            storage=args.storage,
+            checkpoint=checkpoint,
+            similarity=args.similarity,
+            write_concern=parse_write_concern(args.write_concern),
+        ))
+        pbar.close()
+        elapsed = time.perf_counter() - start
+        print(f"Processed {n_processed:,} queries in {elapsed:.2f}s "
+              f"({n_processed/elapsed:.2f} queries/s) - engine `async`")
+        print(summarize())
+
+    elif not args.workers:
+        for query_doc in tqdm.tqdm(generator(), total=n_total):
             qid = query_doc['query_id']
 
     else:
-        # Get queries from the specified set
-        get_query_document_features = partial(
-            extract_features_for_all_docs,
-            type=args.type
-        )
-     
-        with mp.Pool(args.workers) as p:
+        with mp.Pool(args.workers, initializer=init_worker, initargs=(ES_HOST, args.es_pool_size, scoreddocs_handle, feature_cache_config)) as p:
             with pymongo.MongoClient(MONGODB_HOST) as client:
-                
-                pbar = tqdm.tqdm(p.imap(get_query_document_features, generator()), total=n_queries-len(ids_to_skip))
-
-                batch = []
-                for best_docs_features in pbar:
-                    batch.append(best_docs_features)
-
-                    if len(batch) % args.export_every == 0:
-                        features_coll = client[args.db][args.coll]
-                        docs = list(itertools.chain.from_iterable(batch))
-                        features_coll.insert_many(docs)
-                        batch = []
-
-                if batch:
-                    features_coll = client[args.db][args.coll]
-                    docs = list(itertools.chain.from_iterable(batch))
-                    features_coll.insert_many(docs)
+                # Writes from a background thread, so the pool keeps being drained during the inserts
+                writer = MongoWriter(
+                    key_fields=get_key_fields(args.storage) if args.write_mode == 'upsert' else None,
+                    write_concern=parse_write_concern(args.write_concern),
+                    max_queue_size=args.writer_queue_size,
+                    max_batch_bytes=args.writer_batch_bytes,
+                )
+                with writer:
+                    pbar = tqdm.tqdm(get_features_iterator(p, generator(), args), total=n_total)
+
+                    start = time.perf_counter()
+                    n_processed = 0
+                    batch, batch_ids = [], []
+                    for query_id, best_docs_features in pbar:
+                        batch.append(best_docs_features)
+                        batch_ids.append((query_id, bool(best_docs_features)))
+                        n_processed += 1
+                        get_metrics().increment('queries' if best_docs_features else 'queries.failed')
+
+                        if len(batch) % args.export_every == 0:
+                            output_collections = get_output_collections(client[args.db], args.coll, args.mode)
+                            export_features(writer, output_collections, batch, batch_ids, args.storage, checkpoint)
+                            batch, batch_ids = [], []
+
+                    if batch:
+                        output_collections = get_output_collections(client[args.db], args.coll, args.mode)
+                        export_features(writer, output_collections, batch, batch_ids, args.storage, checkpoint)
+
+                elapsed = time.perf_counter() - start
+                print(f"Processed {n_processed:,} queries in {elapsed:.2f}s "
+                      f"({n_processed/elapsed:.2f} queries/s) - mode `{args.mode}`")
+
+            # Lets the workers exit cleanly so their last metrics are flushed
+            p.close()
+            p.join()
+        print(summarize())
@@ -0,0 +1,168 @@
+import os
+import json
+import sqlite3
+import hashlib
+from config import *
+from metrics import get_metrics
+
+# Settings of the cache used by the current process, see `init_feature_cache`
+_cache_config = None
+_caches = {}
+
+
+# Version of the query key, part of the index version so entries keyed differently are invalidated
+QUERY_KEY_VERSION = 2
+
+
+def normalize_query(text):
+    """Only case and whitespace are normalized, which the `standard` analyzer ignores.
+    `utils.analyze` would also merge queries that ES tokenizes differently (`don't` and `don t`)"""
+    return ' '.join(text.lower().split())
+
+
+def get_query_hash(text):
+    return hashlib.sha1(normalize_query(text).encode()).hexdigest()
+
+
+def get_index_version(es=None, index=MSMARCO_DOCS_INDEX):
+    """Hash of the mapping and similarity settings, plus the uuid of the live index
+    when a client is given, so recreating the index also invalidates the scores"""
+    config = json.dumps({
+        'index': index,
+        'config': MSMARCO_DOCS_INDEX_CONFIG,
+        'subfields': SIMILARITY_SUBFIELDS,
+        'query_key': QUERY_KEY_VERSION,
+    }, sort_keys=True)
+    if es is not None:
+        config += es.indices.get_settings(index=index)[index]['settings']['index']['uuid']
+    return hashlib.sha1(config.encode()).hexdigest()[:16]
+
+
+def get_cache_similarity(similarity=None):
+    "Similarity part of the key, matching the field queried by `get_similarity_field`"
+    if similarity:
+        subfield = similarity.replace('.', '_')
+        if subfield in SIMILARITY_SUBFIELDS:
+            return subfield
+    return 'default'
+
+
+class FeatureCache:
+    """SQLite cache of the similarity scores, keyed by (index version, normalized
+    query hash, similarity, field, doc_id).
+
+    A score of None records a document that the search did not return, so a
+    (query, similarity, field) is complete once every requested document has
+    an entry. The file is opened in WAL mode and can be shared by the pool
+    workers, each process opening its own connection. Every `evict_every` rows
+    written, a connection evicts the oldest entries above `max_entries`, so the
+    table stays bounded during a run, even one that crashes"""
+
+    def __init__(self, path=FEATURE_CACHE_PATH, version='', max_entries=FEATURE_CACHE_MAX_ENTRIES,
+                 evict_every=FEATURE_CACHE_EVICT_EVERY):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.version = version
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.n_written = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS features (
+                version TEXT,
+                query_hash TEXT,
+                similarity TEXT,
+                field TEXT,
+                doc_id TEXT,
+                score REAL,
+                PRIMARY KEY (version, query_hash, similarity, field, doc_id)
+            )
+        """)
+
+    def get(self, query_text, keys, doc_ids):
+        """Cached scores of the complete `(similarity, field)` keys of a query,
+        as `{key: {doc_id: score}}`. The other keys must be searched"""
+        rows = self.conn.execute(
+            "SELECT similarity, field, doc_id, score FROM features WHERE version = ? AND query_hash = ?",
+            (self.version, get_query_hash(query_text))
+        ).fetchall()
+        cached = {}
+        for similarity, field, doc_id, score in rows:
+            cached.setdefault((similarity, field), {})[doc_id] = score
+
+        complete = {}
+        for key in keys:
+            scores = cached.get(key, {})
+            if all(doc_id in scores for doc_id in doc_ids):
+                complete[key] = {doc_id: scores[doc_id] for doc_id in doc_ids}
+        n_hits = len(complete) * len(doc_ids)
+        n_misses = (len(keys) - len(complete)) * len(doc_ids)
+        self.hits += n_hits
+        self.misses += n_misses
+        get_metrics().increment('feature_cache.hits', n_hits)
+        get_metrics().increment('feature_cache.misses', n_misses)
+        return complete
+
+    def put(self, query_text, scores):
+        "Stores `{(similarity, field): {doc_id: score or None}}` in a single transaction"
+        query_hash = get_query_hash(query_text)
+        rows = [
+            (self.version, query_hash, similarity, field, doc_id, score)
+            for (similarity, field), doc_scores in scores.items()
+            for doc_id, score in doc_scores.items()
+        ]
+        if not rows:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.n_written += len(rows)
+        if self.n_written >= self.evict_every:
+            self.evict()
+
+    def invalidate(self):
+        "Drops the scores computed for another mapping, similarity config or index"
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM features WHERE version != ?", (self.version,))
+
+    def evict(self):
+        """Deletes the entries older than the last `max_entries` rowids, which follow the insertion order.
+        The rowid gaps of the replaced rows make it an upper bound of the entries kept, so the table is never
+        counted under the write lock, and concurrent evictions read the bound in the same statement"""
+        self.n_written = 0
+        with self.conn:
+            n_evicted = self.conn.execute(
+                "DELETE FROM features WHERE rowid <= (SELECT max(rowid) FROM features) - ?",
+                (self.max_entries,)
+            ).rowcount
+        get_metrics().increment('feature_cache.evicted', n_evicted)
+        return n_evicted
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.
+
+
+def init_feature_cache(config):
+    "Enables the cache in the current process, `config` holds the `FeatureCache` arguments or None"
+    global _cache_config
+    _cache_config = config
+    _caches.clear()
+
+
+def get_feature_cache():
+    "Cache connection of the current process, or None when the cache is disabled"
+    if _cache_config is None:
+        return None
+    pid = os.getpid()
+    if pid not in _caches:
+        # SQLite connections can not be shared with forked processes
+        _caches.clear()
+        _caches[pid] = FeatureCache(**_cache_config)
+    return _caches[pid]
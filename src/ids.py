@@ -0,0 +1,113 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from config import *
+
+INT32_MAX = np.iinfo(np.int32).max
+
+# Encoders of the current process, see `get_id_encoder`
+_encoders = {}
+
+
+class IdEncoder:
+    """Reversible int32 encoding of string ids.
+
+    Ids made of `prefix` followed by a decimal number (without leading zeros)
+    that fits in an int32 are encoded as that number, like `D2765617` -> 2765617.
+    Any other id gets a negative code from `codes`, which must be saved to
+    decode it back"""
+
+    def __init__(self, prefix='', codes=None):
+        self.prefix = prefix
+        self.codes = codes or {}
+        self.ids = {code: id for id, code in self.codes.items()}
+        self.changed = False
+
+    def code(self, id):
+        "Dictionary code of a non conforming id, assigned on first use"
+        if id not in self.codes:
+            code = -(len(self.codes) + 1)
+            self.codes[id] = code
+            self.ids[code] = id
+            self.changed = True
+        return self.codes[id]
+
+    def encode(self, ids):
+        "int32 codes of `ids`, the conforming ones are parsed in a single vectorized pass"
+        ids = pd.Series(ids, dtype=object).astype(str)
+        digits = ids.str.slice(len(self.prefix))
+        conforming = ids.str.startswith(self.prefix) & digits.str.fullmatch(r'0|[1-9][0-9]{0,9}')
+        numbers = pd.to_numeric(digits.where(conforming), errors='coerce')
+        conforming &= numbers <= INT32_MAX
+
+        codes = np.empty(len(ids), dtype=np.int32)
+        codes[conforming.to_numpy()] = numbers[conforming].to_numpy(dtype=np.int64)
+        for i in np.flatnonzero(~conforming.to_numpy()):
+            codes[i] = self.code(ids.iat[i])
+        return codes
+
+    def decode(self, codes):
+        "String ids of `codes`, as an object array"
+        codes = np.asarray(codes)
+        ids = np.empty(len(codes), dtype=object)
+        numbers = codes >= 0
+        ids[numbers] = [f'{self.prefix}{code}' for code in codes[numbers].tolist()]
+        ids[~numbers] = [self.ids[code] for code in codes[~numbers].tolist()]
+        return ids
+
+
+def load_id_encoders(path=ID_DICTIONARY_PATH):
+    "Encoders of the `doc_id` and `query_id` columns, with the codes saved by `save_id_encoders`"
+    saved = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+    _encoders['doc_id'] = IdEncoder('D', saved.get('doc_id'))
+    _encoders['query_id'] = IdEncoder('', saved.get('query_id'))
+    return _encoders
+
+
+def save_id_encoders(path=ID_DICTIONARY_PATH):
+    "Persists the codes of the non conforming ids, only when new ones were assigned"
+    if not any(encoder.changed for encoder in _encoders.values()):
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({name: encoder.codes for name, encoder in _encoders.items()}, f)
+    for encoder in _encoders.values():
+        encoder.changed = False
+
+
+def get_id_encoder(column):
+    "Encoder of an id column, `doc_id` or `query_id`"
+    if not _encoders:
+        load_id_encoders()
+    return _encoders[column]
+
+
+def encode_ids(df, columns=('query_id', 'doc_id')):
+    "Replaces the string id columns of `df` by their int32 codes, in place"
+    for column in columns:
+        if column in df.columns and not pd.api.types.is_integer_dtype(df[column]):
+            df[column] = get_id_encoder(column).encode(df[column].to_numpy())
+    return df
+
+
+def decode_ids(df, columns=('query_id', 'doc_id')):
+    "Inverse of `encode_ids`"
+    for column in columns:
+        if column in df.columns and pd.api.types.is_integer_dtype(df[column]):
+            df[column] = get_id_encoder(column).decode(df[column].to_numpy())
+    return df
+
+
+def to_float32(df, exclude=('query_id', 'doc_id', 'label')):
+    "Stores the numeric feature columns of `df` as float32, in place, including the integer lengths"
+    for column in df.columns:
+        dtype = df[column].dtype
+        if column in exclude or dtype == np.float32 or pd.api.types.is_bool_dtype(dtype):
+            continue
+        if pd.api.types.is_numeric_dtype(dtype):
+            df[column] = df[column].astype(np.float32)
+    return df
@@ -0,0 +1,275 @@
+import os
+import json
+import math
+import time
+import atexit
+import functools
+import threading
+from contextlib import contextmanager
+from multiprocessing import util
+from elasticsearch.connection import Urllib3HttpConnection
+from config import *
+
+# Latency histograms use log buckets of a quarter octave (~19% wide), from 1us
+BUCKETS_PER_OCTAVE = 4
+
+# Metrics of the current process, see `get_metrics`
+_metrics = {}
+_metrics_path = None
+
+
+def get_bucket(seconds):
+    return max(0, int(math.log2(max(seconds, 1e-6) * 1e6) * BUCKETS_PER_OCTAVE))
+
+
+def get_bucket_upper_bound(bucket):
+    return 2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE) / 1e6
+
+
+class Histogram:
+    "Mergeable log bucketed histogram of durations in seconds"
+
+    def __init__(self, buckets=None, count=0, total=0., max=0.):
+        self.buckets = buckets or {}
+        self.count = count
+        self.total = total
+        self.max = max
+
+    def record(self, seconds):
+        bucket = get_bucket(seconds)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = seconds if seconds > self.max else self.max
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        "Upper bound of the bucket holding the `q` percentile, capped by the max"
+        if not self.count:
+            return 0.
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(get_bucket_upper_bound(bucket), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'buckets': self.buckets, 'count': self.count, 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls({int(bucket): count for bucket, count in d['buckets'].items()}, d['count'], d['total'], d['max'])
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of a single process.
+
+    Snapshots are cumulative and appended to a JSON lines file at most every
+    `flush_interval` seconds, so the workers of a pool write to the same file
+    and `summarize` merges the last snapshot of each process"""
+
+    def __init__(self, path=None, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self.start = time.time()
+        self.last_flush = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].record(seconds)
+        self.maybe_flush()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        self.maybe_flush()
+
+    def gauge(self, name, value):
+        "Keeps the last and max values, meant for queue depths"
+        with self.lock:
+            last, max_value = self.gauges.get(name, (value, value))
+            self.gauges[name] = (value, max(max_value, value))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'pid': self.pid,
+                'start': self.start,
+                'counters': dict(self.counters),
+                'gauges': {name: {'last': last, 'max': max_value} for name, (last, max_value) in self.gauges.items()},
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            }
+
+    def maybe_flush(self):
+        if self.path and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.path:
+            return
+        self.last_flush = time.monotonic()
+        line = json.dumps(self.snapshot()) + '\n'
+        # Appends of a single write are not interleaved between processes
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+
+def init_metrics(name, path=None):
+    """Enables the metrics file for the current run, `path` defaults to
+    `METRICS_DIR/{name}-{timestamp}.jsonl`. Forked workers inherit it"""
+    global _metrics_path
+    if path is None:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+    _metrics_path = path
+    _metrics.clear()
+    return get_metrics()
+
+
+def get_metrics():
+    "Returns the metrics of the current process, flushed when the process exits"
+    pid = os.getpid()
+    if pid not in _metrics:
+        metrics = Metrics(_metrics_path)
+        _metrics.clear()
+        _metrics[pid] = metrics
+        # Pool workers do not run `atexit` hooks, but they do run the multiprocessing finalizers
+        atexit.register(metrics.flush)
+        util.Finalize(None, metrics.flush, exitpriority=10)
+    return _metrics[pid]
+
+
+def load_snapshots(path):
+    "Last snapshot of each process of a metrics file"
+    snapshots = {}
+    with open(path) as f:
+        for line in f:
+            snapshot = json.loads(line)
+            snapshots[snapshot['pid']] = snapshot
+    return list(snapshots.values())
+
+
+def merge_snapshots(snapshots):
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in snapshots:
+        for name, value in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, gauge in snapshot['gauges'].items():
+            gauges[name] = max(gauges.get(name, 0), gauge['max'])
+        for name, histogram in snapshot['histograms'].items():
+            histograms.setdefault(name, Histogram()).merge(Histogram.from_dict(histogram))
+    start = min([snapshot['start'] for snapshot in snapshots], default=0)
+    end = max([snapshot['time'] for snapshot in snapshots], default=0)
+    return counters, gauges, histograms, end - start
+
+
+def summarize(path=None):
+    "End of run summary of every process of the metrics file, as printable text"
+    metrics = get_metrics()
+    metrics.flush()
+    snapshots = load_snapshots(path or metrics.path) if (path or metrics.path) else [metrics.snapshot()]
+    counters, gauges, histograms, elapsed = merge_snapshots(snapshots)
+
+    lines = [f"Metrics of {len(snapshots)} process(es) over {elapsed:.2f}s"]
+    if histograms:
+        lines.append(f"{'latency':<28}{'count':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, histogram in sorted(histograms.items()):
+            mean = histogram.total / histogram.count if histogram.count else 0.
+            lines.append(
+                f"{name:<28}{histogram.count:>10,}{mean * 1e3:>10.2f}{histogram.percentile(50) * 1e3:>10.2f}"
+                f"{histogram.percentile(99) * 1e3:>10.2f}{histogram.max * 1e3:>10.2f}"
+            )
+    for name, value in sorted(counters.items()):
+        rate = value / elapsed if elapsed else 0.
+        lines.append(f"{name:<28}{value:>10,} ({rate:,.2f}/s)")
+    # Caches count `{name}.hits` and `{name}.misses`
+    for name in sorted(counters):
+        if name.endswith('.hits'):
+            cache = name[:-len('.hits')]
+            n = counters[name] + counters.get(f'{cache}.misses', 0)
+            lines.append(f"{cache + ' hit rate':<28}{counters[name] / n if n else 0.:>10.2%}")
+    for name, value in sorted(gauges.items()):
+        lines.append(f"{name:<28} max {value:,}")
+    return '\n'.join(lines)
+
+
+def get_call_type(url):
+    "Name of the ES API of a request path, `/msmarco-docs/_search` -> `search`"
+    path = url.split('?', 1)[0]
+    if '/_search/scroll' in path:
+        return 'scroll'
+    for part in path.split('/'):
+        if part.startswith('_'):
+            return part[1:]
+    return 'document'
+
+
+class InstrumentedConnection(Urllib3HttpConnection):
+    "Records the latency of every ES request by API, and the failed ones by exception type"
+
+    def perform_request(self, method, url, *args, **kwargs):
+        metrics = get_metrics()
+        call_type = get_call_type(url)
+        start = time.perf_counter()
+        try:
+            return super().perform_request(method, url, *args, **kwargs)
+        except Exception as e:
+            metrics.increment(f'es.{call_type}.errors.{type(e).__name__}')
+            raise
+        finally:
+            metrics.observe(f'es.{call_type}', time.perf_counter() - start)
+
+
+def get_instrumented_async_connection_class():
+    "Same as `InstrumentedConnection` for `AsyncElasticsearch`, aiohttp is only required by the async engine"
+    from elasticsearch._async.http_aiohttp import AIOHttpConnection
+
+    class InstrumentedAIOHttpConnection(AIOHttpConnection):
+        async def perform_request(self, method, url, *args, **kwargs):
+            metrics = get_metrics()
+            call_type = get_call_type(url)
+            start = time.perf_counter()
+            try:
+                return await super().perform_request(method, url, *args, **kwargs)
+            except Exception as e:
+                metrics.increment(f'es.{call_type}.errors.{type(e).__name__}')
+                raise
+            finally:
+                metrics.observe(f'es.{call_type}', time.perf_counter() - start)
+
+    return InstrumentedAIOHttpConnection
+
+
+def timed(name):
+    "Decorator recording the duration of every call, the wrapped function stays picklable by name"
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,137 @@
+import time
+import queue
+import threading
+import bson
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+from config import *
+from metrics import get_metrics
+
+DUPLICATE_KEY_ERROR = 11000
+
+_WRITER_DONE = object()
+
+
+def parse_write_concern(w=None, j=None):
+    "Write concern from the `--write-concern` value, `majority` or a number of nodes"
+    options = dict(MONGO_WRITE_CONCERN)
+    if w is not None:
+        options['w'] = int(w) if str(w).isdigit() else w
+    if j is not None:
+        options['j'] = j
+    return WriteConcern(**options)
+
+
+def is_duplicate_only(error):
+    "Whether a `BulkWriteError` only failed on already written documents"
+    details = error.details or {}
+    return not details.get('writeConcernErrors') and all(
+        write_error['code'] == DUPLICATE_KEY_ERROR for write_error in details.get('writeErrors', [])
+    )
+
+
+def split_by_bytes(docs, max_batch_bytes):
+    "Splits `docs` in consecutive lists of at most `max_batch_bytes` of BSON"
+    batch, batch_bytes = [], 0
+    for doc in docs:
+        doc_bytes = len(bson.encode(doc))
+        if batch and batch_bytes + doc_bytes > max_batch_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(doc)
+        batch_bytes += doc_bytes
+    if batch:
+        yield batch
+
+
+def write_documents(coll, docs, key_fields=None):
+    """Unordered write of `docs` that tolerates documents written by a previous run.
+    With `key_fields` documents are upserted on them, otherwise inserted and the
+    duplicate key errors ignored. Returns the number of duplicates"""
+    if key_fields:
+        requests = [ReplaceOne({field: doc[field] for field in key_fields}, doc, upsert=True) for doc in docs]
+        result = coll.bulk_write(requests, ordered=False)
+        # Unacknowledged writes have no counts
+        return result.matched_count if result.acknowledged else 0
+    try:
+        coll.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if not is_duplicate_only(e):
+            raise
+        return len(e.details['writeErrors'])
+    return 0
+
+
+class MongoWriter:
+    """Writes to mongo from a background thread, so the producer keeps draining
+    its workers while the previous batches are written.
+
+    `put` blocks once `max_queue_size` batches are waiting, which applies
+    backpressure to the producer. Each batch callback runs on the writer thread
+    once all of its documents are written, and a failed write is raised by the
+    following `put` or by `close`"""
+
+    def __init__(
+        self,
+        key_fields=None,
+        write_concern=None,
+        max_queue_size=MONGO_WRITER_QUEUE_SIZE,
+        max_batch_bytes=MONGO_WRITER_BATCH_BYTES,
+    ):
+        self.key_fields = key_fields
+        self.write_concern = write_concern or parse_write_concern()
+        self.max_batch_bytes = max_batch_bytes
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(raise_error=exc_type is None)
+
+    def put(self, writes, on_written=None):
+        "Queues `writes`, a list of `(collection, docs)`, `on_written` is called once they are all written"
+        self._raise_error()
+        metrics = get_metrics()
+        metrics.gauge('mongo_writer.queue_depth', self.queue.qsize())
+        start = time.perf_counter()
+        self.queue.put((writes, on_written))
+        metrics.observe('mongo_writer.put_wait', time.perf_counter() - start)
+
+    def close(self, raise_error=True):
+        "Waits for the queued batches to be written"
+        self.queue.put(_WRITER_DONE)
+        self.thread.join()
+        if raise_error:
+            self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        metrics = get_metrics()
+        while True:
+            item = self.queue.get()
+            if item is _WRITER_DONE:
+                return
+            if self.error is not None:
+                # Drops the remaining batches, they are not marked as written
+                continue
+            writes, on_written = item
+            try:
+                for coll, docs in writes:
+                    coll = coll.with_options(write_concern=self.write_concern)
+                    for batch in split_by_bytes(docs, self.max_batch_bytes):
+                        with metrics.timer('mongo.write'):
+                            n_duplicates = write_documents(coll, batch, self.key_fields)
+                        metrics.increment('mongo.documents', len(batch))
+                        metrics.increment('mongo.duplicates', n_duplicates)
+                if on_written is not None:
+                    on_written()
+            except Exception as e:
+                self.error = e
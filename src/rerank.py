@@ -0,0 +1,256 @@
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from config import *
+from utils import get_es_client, get_mongo_client, get_similarities_scores, analyze
+from metrics import Histogram
+from evaluate import predict_scores
+from term_statistics import TermVectorsIndex
+from term_vectors_store import TermVectorsStore
+
+import warnings
+
+warnings.filterwarnings("ignore", message=".*elastic.*")
+
+RERANK_SIMILARITIES = list(SIMILARITY_SUBFIELDS)
+
+
+class LRUCache:
+    "Bounded mapping that evicts the least recently used keys, with hit counts"
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.
+
+
+class ClusterBackend:
+    "Candidates and features read from the documents index and the document features collection"
+
+    def __init__(self, n_candidates=100, candidate_field='whole_document'):
+        self.n_candidates = n_candidates
+        self.candidate_field = candidate_field
+        self.es = get_es_client()
+        self.document_features_coll = get_mongo_client()[FEATURES_DB]['document_features_v2']
+
+    def candidates(self, query_text):
+        body = {
+            "size": self.n_candidates,
+            "_source": False,
+            "query": {"match": {self.candidate_field: query_text}},
+        }
+        response = self.es.search(index=MSMARCO_DOCS_INDEX, body=body)
+        return [hit['_id'] for hit in response['hits']['hits']]
+
+    def similarity_features(self, query_doc, doc_ids):
+        "`{similarity}_{field}` columns aligned with `doc_ids`, from a single `_msearch` without explanations"
+        scoreddocs = [{'doc_id': doc_id} for doc_id in doc_ids]
+        scores = get_similarities_scores(self.es, query_doc, scoreddocs, RERANK_SIMILARITIES)
+        columns = {}
+        for similarity in RERANK_SIMILARITIES:
+            for field in DOCUMENT_FIELDS:
+                doc_scores = scores.get((similarity, field), {})
+                columns[f'{similarity}_{field}'] = np.array(
+                    [doc_scores.get(doc_id, 0.) for doc_id in doc_ids], dtype=np.float32
+                )
+        return columns
+
+    def document_features(self, doc_ids):
+        "`{doc_id: {column: value}}` of the document features collection"
+        cursor = self.document_features_coll.find({'doc_id': {'$in': list(doc_ids)}}, {'_id': 0})
+        return {doc.pop('doc_id'): doc for doc in cursor}
+
+
+class LocalBackend:
+    """Stand-in for the cluster backed by a `TermVectorsStore` export, meant for
+    benchmarks on a small corpus. Candidates are the top BM25 documents of
+    `candidate_field` and the features are scored in process"""
+
+    def __init__(self, store, n_candidates=100, candidate_field='whole_document'):
+        self.n_candidates = n_candidates
+        doc_ids = [doc_id.decode() for doc_id in store.doc_ids.tolist()]
+        self.index = TermVectorsIndex.from_store(store, doc_ids, store.fields)
+        self.candidate_weights = self.index.postings[candidate_field].weights_matrix('bm25', len(self.index.vocabulary))
+
+    def candidates(self, query_text):
+        query_terms = self.index.query_matrix([analyze(query_text)])
+        scores = np.asarray((self.candidate_weights @ query_terms.T).todense()).ravel()
+        n = min(self.n_candidates, len(scores))
+        top = np.argpartition(-scores, n - 1)[:n] if n else np.zeros(0, dtype=np.int64)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [self.index.doc_ids[i] for i in top.tolist()]
+
+    def similarity_features(self, query_doc, doc_ids):
+        scores = self.index.score_pairs(
+            [analyze(query_doc['text'])], [0] * len(doc_ids), doc_ids, RERANK_SIMILARITIES
+        )
+        fields = list(self.index.postings)
+        return {
+            f'{similarity}_{field}': similarity_scores[:, j].astype(np.float32)
+            for similarity, similarity_scores in scores.items()
+            for j, field in enumerate(fields)
+        }
+
+    def document_features(self, doc_ids):
+        features = {}
+        for doc_id in doc_ids:
+            row = self.index.doc_index[doc_id]
+            features[doc_id] = {
+                f'{field}_doc_length': float(postings.lengths[row])
+                for field, postings in self.index.postings.items()
+            }
+        return features
+
+
+class ColumnScorer:
+    "Ranks by a single feature column, used to benchmark the service without a trained model"
+
+    def __init__(self, feature_columns, column='bm25_whole_document'):
+        self.j = feature_columns.index(column)
+
+    def predict(self, X):
+        return np.asarray(X)[:, self.j]
+
+
+def load_model(path):
+    "Loads an XGBoost model saved with `save_model`, xgboost is only required to serve a model"
+    import xgboost as xgb
+    with open(path) as f:
+        objective = json.load(f)['learner']['objective']['name']
+    model = xgb.XGBClassifier() if objective.startswith('binary') else xgb.XGBRanker()
+    model.load_model(path)
+    return model
+
+
+def get_feature_columns(model):
+    "Feature columns in training order, as recorded by the sklearn API or the booster"
+    columns = getattr(model, 'feature_names_in_', None)
+    if columns is None:
+        columns = model.get_booster().feature_names
+    return list(columns)
+
+
+class Reranker:
+    """Reorders the candidates of a query with a trained ranker. The features
+    of all candidates are assembled in a single matrix and scored by one
+    `predict`, the document features are kept in an LRU cache"""
+
+    def __init__(self, model, backend, feature_columns, cache_size=RERANK_CACHE_SIZE):
+        self.model = model
+        self.backend = backend
+        self.feature_columns = feature_columns
+        self.cache = LRUCache(cache_size)
+        self.latency = Histogram()
+
+    def get_document_features(self, doc_ids):
+        cached = {doc_id: self.cache.get(doc_id) for doc_id in doc_ids}
+        missing = [doc_id for doc_id, features in cached.items() if features is None]
+        if missing:
+            fetched = self.backend.document_features(missing)
+            for doc_id in missing:
+                # Documents without features are cached too, so they are not fetched again
+                cached[doc_id] = fetched.get(doc_id, {})
+                self.cache.put(doc_id, cached[doc_id])
+        return [cached[doc_id] for doc_id in doc_ids]
+
+    def get_features_matrix(self, query_doc, doc_ids):
+        similarity_features = self.backend.similarity_features(query_doc, doc_ids)
+        document_features = self.get_document_features(doc_ids)
+        X = np.zeros((len(doc_ids), len(self.feature_columns)), dtype=np.float32)
+        for j, column in enumerate(self.feature_columns):
+            if column in similarity_features:
+                X[:, j] = similarity_features[column]
+            else:
+                X[:, j] = [features.get(column, 0.) for features in document_features]
+        return pd.DataFrame(X, columns=self.feature_columns)
+
+    def rerank(self, query_text, query_id=None):
+        "Candidates of `query_text` as `(doc_id, score)` sorted by descending model score"
+        start = time.perf_counter()
+        doc_ids = self.backend.candidates(query_text)
+        if not doc_ids:
+            return []
+        query_doc = {'query_id': query_id, 'text': query_text}
+        scores = predict_scores(self.model, self.get_features_matrix(query_doc, doc_ids))
+        order = np.argsort(-scores, kind='stable')
+        self.latency.record(time.perf_counter() - start)
+        return [(doc_ids[i], float(scores[i])) for i in order.tolist()]
+
+    def latency_report(self):
+        return (
+            f"{self.latency.count:,} queries - p50 {self.latency.percentile(50) * 1e3:.2f}ms "
+            f"p99 {self.latency.percentile(99) * 1e3:.2f}ms max {self.latency.max * 1e3:.2f}ms - "
+            f"document features cache hit rate {self.cache.hit_rate:.2%}"
+        )
+
+
+def read_queries(path, limit=None):
+    "Queries of a `queries.jsonl` dataset file"
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if limit and i == limit:
+                return
+            yield json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=None, type=str,
+                        help="XGBoost model saved with `save_model`, ranks by `bm25_whole_document` when missing")
+    parser.add_argument("--local", default=None, type=str,
+                        help="Serves from a `term_vectors_store` export instead of the cluster")
+    parser.add_argument("--query", default=None, type=str, help="Reranks a single query and prints the results")
+    parser.add_argument("--queries", default=DEV_QUERIES_PATH, type=str,
+                        help="Queries file replayed to report the latency")
+    parser.add_argument("--limit", default=1000, type=int)
+    parser.add_argument("--candidates", default=100, type=int)
+    parser.add_argument("--cache-size", default=RERANK_CACHE_SIZE, type=int)
+    parser.add_argument("--top", default=10, type=int)
+    args = parser.parse_args()
+
+    if args.local:
+        backend = LocalBackend(TermVectorsStore(args.local), args.candidates)
+    else:
+        backend = ClusterBackend(args.candidates)
+
+    if args.model:
+        model = load_model(args.model)
+        feature_columns = get_feature_columns(model)
+    else:
+        feature_columns = [f'{similarity}_{field}' for similarity in RERANK_SIMILARITIES for field in DOCUMENT_FIELDS]
+        model = ColumnScorer(feature_columns)
+    reranker = Reranker(model, backend, feature_columns, args.cache_size)
+
+    if args.query:
+        for rank, (doc_id, score) in enumerate(reranker.rerank(args.query)[:args.top], 1):
+            print(f"{rank:>4} {doc_id:<12} {score:.4f}")
+    else:
+        for query_doc in read_queries(args.queries, args.limit):
+            reranker.rerank(query_doc['text'], query_doc.get('query_id'))
+    print(reranker.latency_report())
@@ -0,0 +1,155 @@
+import tqdm
+import numpy as np
+from array import array
+from multiprocessing import shared_memory
+from config import *
+from utils import *
+from ids import get_id_encoder
+
+# Arrays of a `ScoredDocs`, the query ids are fixed width bytes so they keep the keyword sort order
+SCOREDDOCS_ARRAYS = ['query_ids', 'offsets', 'doc_ids', 'scores']
+
+# Store attached by the current process, see `init_scoreddocs`
+_scoreddocs = None
+
+
+class ScoredDocs:
+    """Candidate documents of every query as CSR arrays, `offsets[i]:offsets[i + 1]`
+    delimits the int32 doc id codes (see `ids.IdEncoder`) and scores of the i-th query of the sorted `query_ids`.
+
+    The arrays can be moved to a single shared memory block with `share`, so the
+    pool workers look up their candidates locally instead of searching the scoreddocs index"""
+
+    def __init__(self, query_ids, offsets, doc_ids, scores, shm=None):
+        self.query_ids = query_ids
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.scores = scores
+        # Keeps the shared memory block mapped while the arrays are used
+        self.shm = shm
+
+    def __len__(self):
+        return len(self.query_ids)
+
+    @classmethod
+    def from_index(cls, type, limit=None, progress=True):
+        "Streams the `{type}_scoreddocs` index once, sorted by (query_id, doc_id)"
+        body = {
+            "size": 10000,
+            "_source": ["query_id", "doc_id", "score"],
+            "sort": [{"query_id.keyword": "asc"}, {"doc_id.keyword": "asc"}],
+        }
+        n_docs, gen = documents_from_index_factory(ES_HOST, get_scoreddocs_index(type), limit, body)
+
+        query_ids, offsets = [], array('q', [0])
+        doc_ids, scores = array('i'), array('f')
+        encoder = get_id_encoder('doc_id')
+        docs = tqdm.tqdm(gen(), total=n_docs, desc=f"Prefetching `{type}` scoreddocs", disable=not progress)
+        for batch in batch_iterator(docs, 100000):
+            for doc in batch:
+                if not query_ids or query_ids[-1] != doc['query_id']:
+                    if query_ids:
+                        offsets.append(len(scores))
+                    query_ids.append(doc['query_id'])
+                scores.append(float(doc['score']))
+            # Doc ids are encoded in vectorized batches
+            doc_ids.frombytes(encoder.encode([doc['doc_id'] for doc in batch]).tobytes())
+        if query_ids:
+            offsets.append(len(doc_ids))
+
+        encoded = [query_id.encode() for query_id in query_ids]
+        itemsize = max([len(query_id) for query_id in encoded], default=1)
+        return cls(
+            np.array(encoded, dtype=f'S{itemsize}'),
+            np.frombuffer(offsets, dtype=np.int64),
+            np.frombuffer(doc_ids, dtype=np.int32),
+            np.frombuffer(scores, dtype=np.float32),
+        )
+
+    def share(self):
+        """Copies the arrays to a new shared memory block and returns the picklable
+        handle the workers `attach` to. The caller owns the block and must `unlink` it"""
+        arrays = {name: getattr(self, name) for name in SCOREDDOCS_ARRAYS}
+        layout, size = [], 0
+        for name, values in arrays.items():
+            layout.append((name, values.dtype.str, size, len(values)))
+            # Keeps every array aligned to 8 bytes
+            size += (values.nbytes + 7) // 8 * 8
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, dtype, offset, length in layout:
+            np.ndarray(length, dtype=dtype, buffer=shm.buf, offset=offset)[:] = arrays[name]
+        self.shm = shm
+        return {'name': shm.name, 'layout': layout}
+
+    @classmethod
+    def attach(cls, handle):
+        "Zero copy view of a store shared by another process"
+        shm = shared_memory.SharedMemory(name=handle['name'])
+        arrays = {
+            name: np.ndarray(length, dtype=dtype, buffer=shm.buf, offset=offset)
+            for name, dtype, offset, length in handle['layout']
+        }
+        return cls(shm=shm, **arrays)
+
+    def close(self):
+        if self.shm is not None:
+            # The views must be released before closing the mapping
+            self.query_ids = self.offsets = self.doc_ids = self.scores = None
+            self.shm.close()
+
+    def unlink(self):
+        if self.shm is not None:
+            self.shm.unlink()
+
+    def query_rows(self, query_ids):
+        "Row of each query id in the store, -1 for the missing ones"
+        itemsize = self.query_ids.dtype.itemsize
+        encoded = [query_id.encode() for query_id in query_ids]
+        keys = np.array(encoded, dtype=self.query_ids.dtype)
+        rows = np.minimum(np.searchsorted(self.query_ids, keys), max(len(self) - 1, 0))
+        found = (self.query_ids[rows] == keys) & np.array([len(key) <= itemsize for key in encoded], dtype=bool)
+        return np.where(found, rows, -1)
+
+    def get(self, query_id):
+        "Zero copy `(doc_id_codes, scores)` views of the candidates of a query, empty for unknown queries"
+        row = self.query_rows([query_id])[0] if len(self) else -1
+        if row < 0:
+            return self.doc_ids[:0], self.scores[:0]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.doc_ids[start:end], self.scores[start:end]
+
+    def get_hits(self, query_id):
+        "Candidates of a query shaped as the `_source` of the scoreddocs index hits"
+        doc_id_codes, scores = self.get(query_id)
+        return [
+            {'query_id': query_id, 'doc_id': doc_id, 'score': score}
+            for doc_id, score in zip(get_id_encoder('doc_id').decode(doc_id_codes).tolist(), scores.tolist())
+        ]
+
+    def groups(self, query_ids):
+        "Yields `(query_id, doc_ids, scores)` for the known `query_ids`, in sorted order"
+        query_ids = sorted(set(query_ids))
+        rows = self.query_rows(query_ids) if len(self) else np.full(len(query_ids), -1)
+        for query_id, row in zip(query_ids, rows.tolist()):
+            if row < 0:
+                continue
+            start, end = self.offsets[row], self.offsets[row + 1]
+            doc_ids = get_id_encoder('doc_id').decode(self.doc_ids[start:end]).astype(str)
+            yield query_id, doc_ids, self.scores[start:end]
+
+
+def init_scoreddocs(handle):
+    "Attaches the shared store in a pool worker, meant to be used from a `mp.Pool` initializer"
+    global _scoreddocs
+    _scoreddocs = ScoredDocs.attach(handle) if handle is not None else None
+
+
+def set_scoreddocs(scoreddocs):
+    "Uses `scoreddocs` in the current process, for the engines running without a pool"
+    global _scoreddocs
+    _scoreddocs = scoreddocs
+
+
+def get_scoreddocs():
+    "The store attached by the current process, or None when the candidates must be searched"
+    return _scoreddocs
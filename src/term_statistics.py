@@ -0,0 +1,267 @@
+import time
+import tqdm
+import argparse
+import itertools
+import numpy as np
+import scipy.sparse as sp
+from array import array
+from config import *
+from utils import *
+from mongo_writer import MongoWriter, parse_write_concern
+from term_vectors_store import TermVectorsStore
+
+import warnings
+
+warnings.filterwarnings("ignore", message=".*elastic.*")
+
+
+SIMILARITIES = ['bm25', 'lmir_dir', 'lmir_jm', 'tfidf']
+
+
+class FieldPostings:
+    """CSR arrays of the term vectors of a single field, one row per document.
+
+    Besides the term frequencies, each entry keeps the `doc_freq` and `ttf`
+    term statistics returned by ES, and each row the field statistics of
+    the document shard, so the scores match the ones computed by ES"""
+
+    def __init__(self, indptr, term_ids, tf, doc_freq, ttf, doc_count, sum_ttf):
+        self.indptr = indptr
+        self.term_ids = term_ids
+        self.tf = tf
+        self.doc_freq = doc_freq
+        self.ttf = ttf
+        self.doc_count = doc_count
+        self.sum_ttf = sum_ttf
+        self.rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        self.lengths = np.bincount(self.rows, weights=tf, minlength=len(indptr) - 1)
+
+    @property
+    def n_docs(self):
+        return len(self.indptr) - 1
+
+    def weights(self, similarity):
+        """Score of every (doc, term) entry for `similarity`, matching the Lucene 8 similarities.
+        `tfidf` is the ClassicSimilarity formula, without the byte quantization of its length norm"""
+        tf = self.tf.astype(np.float64)
+        doc_freq = self.doc_freq.astype(np.float64)
+        doc_length = np.maximum(self.lengths[self.rows], 1)
+        doc_count = self.doc_count[self.rows].astype(np.float64)
+        sum_ttf = self.sum_ttf[self.rows].astype(np.float64)
+        # Lucene DefaultCollectionModel
+        collection_probability = (self.ttf + 1) / (sum_ttf + 1)
+
+        if similarity == 'bm25':
+            avg_doc_length = sum_ttf / np.maximum(doc_count, 1)
+            idf = np.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_length / avg_doc_length)
+            return idf * tf / (tf + norm)
+        elif similarity == 'lmir_dir':
+            mu = LM_DIRICHLET_MU
+            score = np.log(1 + tf / (mu * collection_probability)) + np.log(mu / (doc_length + mu))
+            return np.maximum(score, 0)
+        elif similarity == 'lmir_jm':
+            lambda_ = LM_JELINEK_MERCER_LAMBDA
+            return np.log(1 + ((1 - lambda_) * tf / doc_length) / (lambda_ * collection_probability))
+        elif similarity == 'tfidf':
+            idf = 1 + np.log((doc_count + 1) / (doc_freq + 1))
+            return np.sqrt(tf) * idf / np.sqrt(doc_length)
+        raise ValueError(f"Unknown similarity `{similarity}`")
+
+    def weights_matrix(self, similarity, n_terms):
+        return sp.csr_matrix(
+            (self.weights(similarity), self.term_ids, self.indptr),
+            shape=(self.n_docs, n_terms)
+        )
+
+
+class TermVectorsIndex:
+    "Term dictionary plus per field CSR postings of the term vectors stored by `termvectors_queries`"
+
+    def __init__(self, doc_ids, vocabulary, postings):
+        self.doc_ids = doc_ids
+        self.doc_index = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        self.vocabulary = vocabulary
+        self.postings = postings
+
+    @classmethod
+    def from_documents(cls, docs, fields=DOCUMENT_FIELDS):
+        doc_ids, vocabulary = [], {}
+        builders = {
+            field: {
+                'indptr': array('q', [0]),
+                'term_ids': array('i'),
+                'tf': array('i'),
+                'doc_freq': array('q'),
+                'ttf': array('q'),
+                'doc_count': array('q'),
+                'sum_ttf': array('q'),
+            }
+            for field in fields
+        }
+        for doc in docs:
+            doc_ids.append(doc['doc_id'])
+            term_vectors = doc.get('term_vectors', {})
+            for field, builder in builders.items():
+                field_vectors = term_vectors.get(field, {})
+                for term, term_stats in field_vectors.get('terms', {}).items():
+                    builder['term_ids'].append(vocabulary.setdefault(term, len(vocabulary)))
+                    builder['tf'].append(term_stats['term_freq'])
+                    builder['doc_freq'].append(term_stats.get('doc_freq', 0))
+                    builder['ttf'].append(term_stats.get('ttf', 0))
+                field_stats = field_vectors.get('field_statistics', {})
+                builder['doc_count'].append(field_stats.get('doc_count', 0))
+                builder['sum_ttf'].append(field_stats.get('sum_ttf', 0))
+                builder['indptr'].append(len(builder['term_ids']))
+
+        postings = {
+            field: FieldPostings(**{name: np.frombuffer(values, dtype=values.typecode) for name, values in builder.items()})
+            for field, builder in builders.items()
+        }
+        return cls(doc_ids, vocabulary, postings)
+
+    @classmethod
+    def from_mongo(cls, doc_ids, fields=DOCUMENT_FIELDS, batch_size=10000):
+        "Loads the term vectors of `doc_ids` from the `TERM_VECTORS_COLL` collection"
+        coll = get_mongo_client()[FEATURES_DB][TERM_VECTORS_COLL]
+        projection = {'_id': 0, 'doc_id': 1}
+        projection.update({f'term_vectors.{field}': 1 for field in fields})
+
+        def docs():
+            for batch in batch_iterator(doc_ids, batch_size):
+                yield from coll.find({'doc_id': {'$in': batch}}, projection)
+        return cls.from_documents(docs(), fields)
+
+    @classmethod
+    def from_store(cls, store, doc_ids, fields=DOCUMENT_FIELDS):
+        "Loads the term vectors of `doc_ids` from a memory mapped `TermVectorsStore`"
+        rows = store.doc_rows(doc_ids)
+        found = rows >= 0
+        postings = {field: FieldPostings(**store.gather(field, rows[found])) for field in fields}
+        doc_ids = [doc_id for doc_id, is_found in zip(doc_ids, found) if is_found]
+        return cls(doc_ids, store.terms, postings)
+
+    def query_matrix(self, queries_terms):
+        "Sparse (queries x terms) matrix with the frequency of each known term in each query"
+        rows, cols = [], []
+        for i, terms in enumerate(queries_terms):
+            for term in terms:
+                term_id = self.vocabulary.get(term)
+                # Terms absent from every document can not contribute to the scores
+                if term_id is not None:
+                    rows.append(i)
+                    cols.append(term_id)
+        data = np.ones(len(rows), dtype=np.float64)
+        return sp.csr_matrix((data, (rows, cols)), shape=(len(queries_terms), len(self.vocabulary)))
+
+    def score_pairs(self, queries_terms, pair_queries, pair_doc_ids, similarities=SIMILARITIES):
+        """Scores every (query, doc) pair for each similarity and field in a single
+        vectorized pass. Returns `{similarity: (n_pairs x n_fields) array}`"""
+        pair_queries = np.asarray(pair_queries)
+        pair_rows = np.array([self.doc_index.get(doc_id, -1) for doc_id in pair_doc_ids], dtype=np.int64)
+        found = pair_rows >= 0
+        query_terms = self.query_matrix(queries_terms)[pair_queries[found]]
+
+        fields = list(self.postings)
+        scores = {similarity: np.zeros((len(pair_rows), len(fields))) for similarity in similarities}
+        for j, field in enumerate(fields):
+            postings = self.postings[field]
+            for similarity in similarities:
+                doc_weights = postings.weights_matrix(similarity, len(self.vocabulary))[pair_rows[found]]
+                scores[similarity][found, j] = np.asarray(doc_weights.multiply(query_terms).sum(axis=1)).ravel()
+        return scores
+
+
+def query_candidates(type, limit=None):
+    "Yields `(query_doc, scoreddocs)`, queries and scoreddocs are both read sorted by query_id"
+    _, queries = queries_from_index_factory(ES_HOST, get_queries_index(type), limit)
+    body = {
+        "size": 10000,
+        "_source": ["query_id", "doc_id"],
+        "sort": [{"query_id.keyword": "asc"}, {"doc_id.keyword": "asc"}],
+    }
+    _, scoreddocs = documents_from_index_factory(ES_HOST, get_scoreddocs_index(type), body=body)
+
+    groups = itertools.groupby(scoreddocs(), key=lambda doc: doc['query_id'])
+    head = next(groups, None)
+    for query_doc in queries():
+        while head is not None and head[0] < query_doc['query_id']:
+            head = next(groups, None)
+        if head is not None and head[0] == query_doc['query_id']:
+            yield query_doc, list(head[1])
+            head = next(groups, None)
+
+
+def compute_similarity_features(candidates, similarities=SIMILARITIES, fields=DOCUMENT_FIELDS, store=None):
+    """Computes the `{doc_id, query_id, field: score}` records of a chunk of
+    `(query_doc, scoreddocs)` for every similarity, returns `{similarity: [query records]}`"""
+    doc_ids = sorted({doc['doc_id'] for _, scoreddocs in candidates for doc in scoreddocs})
+    if store is not None:
+        index = TermVectorsIndex.from_store(store, doc_ids, fields)
+    else:
+        index = TermVectorsIndex.from_mongo(doc_ids, fields)
+
+    queries_terms = [analyze(query_doc['text']) for query_doc, _ in candidates]
+    pair_queries = [i for i, (_, scoreddocs) in enumerate(candidates) for _ in scoreddocs]
+    pair_doc_ids = [doc['doc_id'] for _, scoreddocs in candidates for doc in scoreddocs]
+    scores = index.score_pairs(queries_terms, pair_queries, pair_doc_ids, similarities)
+
+    features = {similarity: [[] for _ in candidates] for similarity in similarities}
+    for similarity, similarity_scores in scores.items():
+        for i, doc_id, doc_scores in zip(pair_queries, pair_doc_ids, similarity_scores.tolist()):
+            record = {'doc_id': doc_id, 'query_id': candidates[i][0]['query_id']}
+            record.update(zip(fields, doc_scores))
+            features[similarity][i].append(record)
+    return features
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--type", choices=["dev", "train", "eval"], type=str, default="dev"
+    )
+    parser.add_argument("--limit", default=None, type=int)
+    parser.add_argument("--db", default=FEATURES_DB, type=str)
+    parser.add_argument("--chunk-size", default=1000, type=int,
+                        help="Number of queries scored on each pass, bounds the loaded term vectors")
+    parser.add_argument("--similarities", nargs='+', choices=SIMILARITIES, default=SIMILARITIES)
+    parser.add_argument("--storage", choices=['rows', 'packed'], default='rows', type=str)
+    parser.add_argument("--store", default=None, type=str,
+                        help="Reads the term vectors from a `term_vectors_store` export instead of mongo")
+    parser.add_argument("--write-concern", default=None, type=str,
+                        help="Mongo write concern `w`, a number of nodes or `majority`")
+    args = parser.parse_args()
+
+    store = TermVectorsStore(args.store) if args.store else None
+
+    client = get_mongo_client()
+    collections = {}
+    for similarity in args.similarities:
+        coll = client[args.db][f'{args.type}_{similarity}']
+        if args.storage == 'packed':
+            coll.create_index("query_id", unique=True)
+        else:
+            coll.create_index("doc_id")
+            coll.create_index("query_id")
+            coll.create_index([("query_id", 1), ("doc_id", 1)], unique=True)
+        collections[similarity] = coll
+
+    start = time.perf_counter()
+    n_processed = 0
+    pbar = tqdm.tqdm(desc="Scoring queries")
+    # Unordered inserts that skip the documents written before a restart, while the next chunk is scored
+    with MongoWriter(write_concern=parse_write_concern(args.write_concern)) as writer:
+        for candidates in batch_iterator(query_candidates(args.type, args.limit), args.chunk_size):
+            features = compute_similarity_features(candidates, args.similarities, store=store)
+            writes = []
+            for similarity, batch in features.items():
+                docs = to_storage_documents(batch, args.storage)
+                if docs:
+                    writes.append((collections[similarity], docs))
+            writer.put(writes)
+            n_processed += len(candidates)
+            pbar.update(len(candidates))
+    pbar.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {n_processed:,} queries in {elapsed:.2f}s ({n_processed/elapsed:.2f} queries/s)")
@@ -0,0 +1,212 @@
+import os
+import json
+import tqdm
+import argparse
+import numpy as np
+from array import array
+from config import *
+from utils import get_mongo_client
+
+# Arrays with one entry per (doc, term) and with one entry per document, for each field
+ENTRY_ARRAYS = {'term_ids': 'int32', 'tf': 'int32', 'doc_freq': 'int64', 'ttf': 'int64'}
+DOC_ARRAYS = {'indptr': 'int64', 'lengths': 'int32', 'doc_count': 'int64', 'sum_ttf': 'int64'}
+
+
+def _array_path(path, name, field=None):
+    return os.path.join(path, f'{field}.{name}.bin' if field else f'{name}.bin')
+
+
+def _open_array(path, dtype):
+    "Memory maps a raw array file, empty files can not be mapped"
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class TermDictionary:
+    "Sorted terms stored as a bytes blob plus offsets, looked up by binary search"
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _term_bytes(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def term(self, i):
+        return self._term_bytes(i).decode()
+
+    def get(self, term, default=None):
+        encoded = term.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_bytes(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._term_bytes(lo) == encoded:
+            return lo
+        return default
+
+
+class TermVectorsStore:
+    """Read only, memory mapped term vectors exported by `export_term_vectors`.
+
+    Documents are sorted by doc_id and each field is stored as CSR arrays
+    (`indptr`, `term_ids`, `tf`, ...), so every process opening the store
+    shares the same pages through the OS cache"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.fields = self.meta['fields']
+        self.doc_ids = _open_array(_array_path(path, 'doc_ids'), self.meta['doc_id_dtype'])
+        self.terms = TermDictionary(
+            _open_array(_array_path(path, 'terms_offsets'), 'int64'),
+            _open_array(_array_path(path, 'terms'), 'uint8'),
+        )
+        self.arrays = {
+            field: {
+                name: _open_array(_array_path(path, name, field), dtype)
+                for name, dtype in {**ENTRY_ARRAYS, **DOC_ARRAYS}.items()
+            }
+            for field in self.fields
+        }
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def doc_rows(self, doc_ids):
+        "Row of each doc id in the store, -1 for the missing ones"
+        itemsize = self.doc_ids.dtype.itemsize
+        encoded = [doc_id.encode() for doc_id in doc_ids]
+        keys = np.array(encoded, dtype=self.doc_ids.dtype)
+        rows = np.minimum(np.searchsorted(self.doc_ids, keys), max(len(self) - 1, 0))
+        found = (self.doc_ids[rows] == keys) & np.array([len(key) <= itemsize for key in encoded], dtype=bool)
+        return np.where(found, rows, -1)
+
+    def get(self, doc_id, field):
+        "Zero copy `(term_ids, tf)` views of the term vector of a document field"
+        row = self.doc_rows([doc_id])[0]
+        if row < 0:
+            raise KeyError(doc_id)
+        arrays = self.arrays[field]
+        start, end = arrays['indptr'][row], arrays['indptr'][row + 1]
+        return arrays['term_ids'][start:end], arrays['tf'][start:end]
+
+    def gather(self, field, rows):
+        "CSR arrays restricted to `rows`, in the given order"
+        arrays = self.arrays[field]
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = arrays['indptr'][rows], arrays['indptr'][rows + 1]
+        sizes = ends - starts
+        indptr = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        positions = np.repeat(starts - indptr[:-1], sizes) + np.arange(indptr[-1])
+
+        gathered = {name: arrays[name][positions] for name in ENTRY_ARRAYS}
+        gathered.update({name: arrays[name][rows] for name in ['doc_count', 'sum_ttf']})
+        gathered['indptr'] = indptr
+        return gathered
+
+
+def export_term_vectors(output, fields=DOCUMENT_FIELDS, flush_every=10000):
+    "Writes the term vectors of `TERM_VECTORS_COLL` to a memory mappable store at `output`"
+    os.makedirs(output, exist_ok=True)
+    coll = get_mongo_client()[FEATURES_DB][TERM_VECTORS_COLL]
+    n_docs = coll.estimated_document_count()
+    projection = {'_id': 0, 'doc_id': 1}
+    projection.update({f'term_vectors.{field}': 1 for field in fields})
+    cursor = coll.find({}, projection, batch_size=1000).sort('doc_id', 1)
+
+    files = {
+        (field, name): open(_array_path(output, name, field), 'wb')
+        for field in fields
+        for name in {**ENTRY_ARRAYS, **DOC_ARRAYS}
+    }
+    typecodes = {'int32': 'i', 'int64': 'q'}
+    dtypes = {**ENTRY_ARRAYS, **DOC_ARRAYS}
+    buffers = {key: array(typecodes[dtypes[key[1]]]) for key in files}
+    n_entries = {field: 0 for field in fields}
+    for field in fields:
+        buffers[(field, 'indptr')].append(0)
+
+    def flush():
+        for key, values in buffers.items():
+            values.tofile(files[key])
+            del values[:]
+
+    vocabulary, doc_ids = {}, []
+    try:
+        for i, doc in enumerate(tqdm.tqdm(cursor, total=n_docs, desc="Exporting term vectors"), 1):
+            doc_ids.append(doc['doc_id'])
+            term_vectors = doc.get('term_vectors', {})
+            for field in fields:
+                field_vectors = term_vectors.get(field, {})
+                length = 0
+                for term, term_stats in field_vectors.get('terms', {}).items():
+                    buffers[(field, 'term_ids')].append(vocabulary.setdefault(term, len(vocabulary)))
+                    buffers[(field, 'tf')].append(term_stats['term_freq'])
+                    buffers[(field, 'doc_freq')].append(term_stats.get('doc_freq', 0))
+                    buffers[(field, 'ttf')].append(term_stats.get('ttf', 0))
+                    length += term_stats['term_freq']
+                    n_entries[field] += 1
+                field_stats = field_vectors.get('field_statistics', {})
+                buffers[(field, 'indptr')].append(n_entries[field])
+                buffers[(field, 'lengths')].append(length)
+                buffers[(field, 'doc_count')].append(field_stats.get('doc_count', 0))
+                buffers[(field, 'sum_ttf')].append(field_stats.get('sum_ttf', 0))
+            if i % flush_every == 0:
+                flush()
+        flush()
+    finally:
+        for f in files.values():
+            f.close()
+
+    # Term ids follow the sorted terms, so the dictionary can be binary searched
+    terms = sorted(vocabulary)
+    remap = np.empty(len(terms), dtype=np.int32)
+    remap[[vocabulary[term] for term in terms]] = np.arange(len(terms), dtype=np.int32)
+    for field in fields:
+        if n_entries[field] == 0:
+            continue
+        term_ids = np.memmap(_array_path(output, 'term_ids', field), dtype='int32', mode='r+')
+        for start in range(0, len(term_ids), 10_000_000):
+            term_ids[start:start + 10_000_000] = remap[term_ids[start:start + 10_000_000]]
+        term_ids.flush()
+        del term_ids
+
+    encoded_terms = [term.encode() for term in terms]
+    offsets = np.concatenate([[0], np.cumsum([len(term) for term in encoded_terms])]).astype(np.int64)
+    offsets.tofile(_array_path(output, 'terms_offsets'))
+    with open(_array_path(output, 'terms'), 'wb') as f:
+        f.write(b''.join(encoded_terms))
+
+    encoded_doc_ids = [doc_id.encode() for doc_id in doc_ids]
+    itemsize = max([len(doc_id) for doc_id in encoded_doc_ids], default=1)
+    doc_ids = np.array(encoded_doc_ids, dtype=f'S{itemsize}')
+    doc_ids.tofile(_array_path(output, 'doc_ids'))
+
+    meta = {
+        'fields': list(fields),
+        'n_docs': len(doc_ids),
+        'n_terms': len(terms),
+        'n_entries': n_entries,
+        'doc_id_dtype': doc_ids.dtype.str,
+    }
+    with open(os.path.join(output, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", "-o", default=TERM_VECTORS_STORE_PATH, type=str)
+    args = parser.parse_args()
+
+    meta = export_term_vectors(args.output)
+    print(f"Exported {meta['n_docs']:,} documents and {meta['n_terms']:,} terms to {args.output}")
@@ -1,97 +1,227 @@
 from calendar import c
+import time
 import tqdm
 import pymongo
-import traceback
-import elasticsearch
+import argparse
+import itertools
 import multiprocessing as mp
+from functools import partial
+from collections import deque
 from config import *
-from utils import es_scroll_generator, get_hits_from_response
+from checkpoint import Checkpoint
+from mongo_writer import MongoWriter, parse_write_concern, write_documents
+from metrics import init_metrics, get_metrics, summarize
+from utils import (
+    batch_iterator,
+    es_scroll_generator,
+    es_sliced_scroll_generator,
+    get_hits_from_response,
+    get_es_client,
+    get_mongo_client,
+    init_es_client,
+    retry_with_backoff,
+)
 
 
 SCORED_DOCS_INDEX = 'dev_scoreddocs'
+TERM_VECTORS_FIELDS = "body,anchor_text,title,url,whole_document"
 
 
-def _get_es_client():
-    return elasticsearch.Elasticsearch(hosts=[ES_HOST])
-
-def get_termsvector(doc_id, max_retries=3):
-    for i in range(1, max_retries+1):
-        try:
-            es = _get_es_client()
-            response = es.termvectors(
-                id=doc_id,
-                index=MSMARCO_DOCS_INDEX,
-                fields="body,anchor_text,title,url,whole_document",
-                term_statistics=True,
-                field_statistics=True,
-                offsets=False,
-                positions=False,
-            )
-            del es
-            return response
-        except:
-            traceback.print_exc()
-    raise ValueError("Reached operation max retries")
+def _get_termsvector(doc_id):
+    es = get_es_client()
+    return es.termvectors(
+        id=doc_id,
+        index=MSMARCO_DOCS_INDEX,
+        fields=TERM_VECTORS_FIELDS,
+        term_statistics=True,
+        field_statistics=True,
+        offsets=False,
+        positions=False,
+    )
 
+def get_termsvector(doc_id, max_retries=MAX_RETRIES):
+    return retry_with_backoff(_get_termsvector, doc_id, max_retries=max_retries)
 
-if __name__ == "__main__":
 
+def _get_mtermvectors(doc_ids):
+    es = get_es_client()
+    response = es.mtermvectors(
+        index=MSMARCO_DOCS_INDEX,
+        body={"ids": doc_ids},
+        fields=TERM_VECTORS_FIELDS,
+        term_statistics=True,
+        field_statistics=True,
+        offsets=False,
+        positions=False,
+    )
+    return response['docs']
+
+def get_mtermvectors(doc_ids, max_retries=MAX_RETRIES):
+    return retry_with_backoff(_get_mtermvectors, doc_ids, max_retries=max_retries)
+
+
+def to_mongo_document(response):
+    response['doc_id'] = response['_id']
+    return {k: v for k,v in response.items() if k in ['doc_id', 'term_vectors']}
+
+
+def export_termsvectors_batch(doc_ids, export=True, write_concern=None, key_fields=None):
+    "Fetches the term vectors of `doc_ids` in a single request and writes them directly from the worker"
+    responses = get_mtermvectors(doc_ids)
+    docs = [to_mongo_document(response) for response in responses if response.get('found', True)]
+    if export and docs:
+        features_coll = get_mongo_client()[FEATURES_DB][TERM_VECTORS_COLL]
+        features_coll = features_coll.with_options(write_concern=write_concern or parse_write_concern())
+        with get_metrics().timer('mongo.write'):
+            n_duplicates = write_documents(features_coll, docs, key_fields)
+        get_metrics().increment('mongo.documents', len(docs))
+        get_metrics().increment('mongo.duplicates', n_duplicates)
+    get_metrics().increment('documents', len(doc_ids))
+    return len(doc_ids)
+
+
+def get_doc_ids_query(after=None):
+    if after is None:
+        return {"match_all": {}}
+    return {"range": {"doc_id": {"gt": after}}}
+
+
+def generate_doc_ids(after=None):
+    "Doc ids sorted ascending, optionally resuming after the `after` doc_id"
+    body = {
+        "size": ES_SCROLL_BATCH_SIZE,
+        "_source": ["doc_id"],
+        "query": get_doc_ids_query(after),
+        "sort": [
+            {"doc_id": "asc"},
+        ]
+    }
+    batches = es_sliced_scroll_generator(
+        ES_HOST,
+        MSMARCO_DOCS_INDEX,
+        body,
+        scroll=SCROLL_EXPIRATION,
+        preserve_order=True
+    )
+    for batch_docs in batches:
+        for doc in batch_docs:
+            yield doc['doc_id']
+
+
+def run_benchmark(n_docs, batch_size, workers):
+    "Measures docs/second of both modes over the same documents, without writing to mongo"
+    doc_ids = list(itertools.islice(generate_doc_ids(), n_docs))
+    with mp.Pool(workers, initializer=init_es_client) as p:
+        start = time.perf_counter()
+        for _ in tqdm.tqdm(p.imap(get_termsvector, doc_ids), total=len(doc_ids), desc="termvectors"):
+            pass
+        elapsed = time.perf_counter() - start
+        print(f"termvectors  : {len(doc_ids)/elapsed:,.2f} docs/s ({elapsed:.2f}s)")
+
+        start = time.perf_counter()
+        export_batch = partial(export_termsvectors_batch, export=False)
+        pbar = tqdm.tqdm(total=len(doc_ids), desc="mtermvectors")
+        for n in p.imap(export_batch, batch_iterator(doc_ids, batch_size)):
+            pbar.update(n)
+        pbar.close()
+        elapsed = time.perf_counter() - start
+        print(f"mtermvectors : {len(doc_ids)/elapsed:,.2f} docs/s ({elapsed:.2f}s) - batch size {batch_size}")
 
-    def generate_doc_ids(ids_to_skip=None):
-        body = {
-            "size": ES_SCROLL_BATCH_SIZE,
-            "query": {
-                "match_all": {}
-            },
-            "sort": [
-                {"doc_id": "asc"},
-            ]
-        }
-        skipped = 0
-        for batch_docs in es_scroll_generator(ES_HOST, MSMARCO_DOCS_INDEX, body, scroll=SCROLL_EXPIRATION):
-            for doc in batch_docs:
-                doc_id = doc['doc_id']
-                if ids_to_skip and doc_id in ids_to_skip:
-                    if skipped % 100000 == 0:
-                        print(f"Skipped {skipped:,} documents...")
-                    skipped += 1
-                else:
-                    yield doc['doc_id']
-    es = _get_es_client()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=['termvectors', 'mtermvectors'], default='termvectors', type=str,
+                        help="`termvectors` sends one request per document, `mtermvectors` one per batch")
+    parser.add_argument("--batch-size", default=MTERMVECTORS_BATCH_SIZE, type=int,
+                        help="Number of documents per `_mtermvectors` request")
+    parser.add_argument("--workers", default=WORKERS, type=int)
+    parser.add_argument("--benchmark", default=None, type=int,
+                        help="Compares both modes on the given number of documents and exits")
+    parser.add_argument("--write-concern", default=None, type=str,
+                        help="Mongo write concern `w`, a number of nodes or `majority`")
+    parser.add_argument("--write-mode", choices=['insert', 'upsert'], default='insert', type=str,
+                        help="`insert` skips the duplicated documents, `upsert` replaces them")
+    parser.add_argument("--metrics", default=None, type=str,
+                        help="JSON lines metrics file, defaults to a new file in `METRICS_DIR`")
+    args = parser.parse_args()
+    init_metrics('termvectors_queries', args.metrics)
+
+    es = get_es_client()
     assert es.cluster.health()['status'] == 'green'
     n_docs = es.count(index=MSMARCO_DOCS_INDEX)['count']
 
-    with pymongo.MongoClient(MONGODB_HOST) as client:
-        features_coll = client[FEATURES_DB][TERM_VECTORS_COLL]
-        features_coll.create_index('doc_id', unique=True)
-
-        n_processed = features_coll.count_documents({})
-        cursor = features_coll.find({}, {'_id': 0, 'doc_id': 1}, batch_size=1000)
-        pbar = tqdm.tqdm(cursor, total=n_processed, desc="Retrieving ids to skip")
-        ids_to_skip = [doc['doc_id'] for doc in pbar]
-        ids_to_skip = set(ids_to_skip)
-    
-
-    with mp.Pool(WORKERS) as p:
-        with pymongo.MongoClient(MONGODB_HOST) as client:
-            n_skip = len(ids_to_skip)
-            pbar = tqdm.tqdm(
-                p.imap(get_termsvector, generate_doc_ids(ids_to_skip=ids_to_skip)),
-                total=n_docs,
-                initial=n_skip
-            )
-
-            batch = []
-            for response in pbar:
-                response['doc_id'] = response['_id']
-                to_insert = {k: v for k,v in response.items() if k in ['doc_id', 'term_vectors']}
-                batch.append(to_insert)
-                if len(batch) % MONGO_INSERT_BATCH_SIZE == 0:
-                    features_coll = client[FEATURES_DB][TERM_VECTORS_COLL]
-                    features_coll.insert_many(batch)
-                    batch = []
-            if batch:
+    if args.benchmark:
+        run_benchmark(args.benchmark, args.batch_size, args.workers)
+        exit(0)
+
+    client = get_mongo_client()
+    features_coll = client[FEATURES_DB][TERM_VECTORS_COLL]
+    features_coll.create_index('doc_id', unique=True)
+
+    # Resumes after the last exported doc id instead of reading back every exported document
+    checkpoint = Checkpoint(client, f"{FEATURES_DB}.{TERM_VECTORS_COLL}")
+    if not checkpoint.exists:
+        checkpoint.bootstrap([features_coll], 'doc_id')
+    n_remaining = es.count(index=MSMARCO_DOCS_INDEX, body={"query": get_doc_ids_query(checkpoint.watermark)})['count']
+    n_skip = n_docs - n_remaining - len(checkpoint.failed)
+    print(f"Resuming after doc_id `{checkpoint.watermark}`, retrying {len(checkpoint.failed):,} failed documents")
+
+    def doc_ids_generator():
+        for doc_id in itertools.chain(list(checkpoint.failed), generate_doc_ids(after=checkpoint.watermark)):
+            checkpoint.dispatch(doc_id)
+            yield doc_id
+
+    def mark_exported(doc_ids):
+        for doc_id in doc_ids:
+            checkpoint.complete(doc_id)
+        checkpoint.commit()
+
+    write_concern = parse_write_concern(args.write_concern)
+    key_fields = ('doc_id',) if args.write_mode == 'upsert' else None
+
+    start = time.perf_counter()
+    with mp.Pool(args.workers, initializer=init_es_client) as p:
+        if args.mode == 'mtermvectors':
+            # Workers insert their own batches, only the counts come back through IPC
+            pbar = tqdm.tqdm(total=n_docs, initial=n_skip)
+            dispatched_batches = deque()
+
+            def doc_ids_batches():
+                for doc_ids in batch_iterator(doc_ids_generator(), args.batch_size):
+                    dispatched_batches.append(doc_ids)
+                    get_metrics().gauge('termvectors.pending_batches', len(dispatched_batches))
+                    yield doc_ids
+
+            export_batch = partial(export_termsvectors_batch, write_concern=write_concern, key_fields=key_fields)
+            for n in p.imap(export_batch, doc_ids_batches()):
+                mark_exported(dispatched_batches.popleft())
+                pbar.update(n)
+            pbar.close()
+        else:
+            with pymongo.MongoClient(MONGODB_HOST) as client, MongoWriter(key_fields, write_concern) as writer:
                 features_coll = client[FEATURES_DB][TERM_VECTORS_COLL]
-                features_coll.insert_many(batch)
+                pbar = tqdm.tqdm(
+                    p.imap(get_termsvector, doc_ids_generator()),
+                    total=n_docs,
+                    initial=n_skip
+                )
+
+                batch = []
+                for response in pbar:
+                    get_metrics().increment('documents')
+                    to_insert = to_mongo_document(response)
+                    batch.append(to_insert)
+                    if len(batch) % MONGO_INSERT_BATCH_SIZE == 0:
+                        writer.put([(features_coll, batch)], partial(mark_exported, [doc['doc_id'] for doc in batch]))
+                        batch = []
+                if batch:
+                    writer.put([(features_coll, batch)], partial(mark_exported, [doc['doc_id'] for doc in batch]))
 
+        # Lets the workers exit cleanly so their last metrics are flushed
+        p.close()
+        p.join()
 
+    elapsed = time.perf_counter() - start
+    n_exported = pbar.n - n_skip
+    print(f"Exported {n_exported:,} documents in {elapsed:.2f}s ({n_exported/elapsed:.2f} docs/s) - mode `{args.mode}`")
+    print(summarize())
@@ -0,0 +1,212 @@
+import os
+import json
+import argparse
+import numpy as np
+import pyarrow.parquet as pq
+import xgboost as xgb
+from config import *
+from evaluate import get_group_offsets, evaluate_scores
+from metrics import init_metrics, get_metrics, summarize, timed
+
+# Columns of the datasets built by `build_dataset_from_features` that are not features
+NON_FEATURE_COLUMNS = ['query_id', 'doc_id', 'label', 'score', 'query_relevant_document']
+
+OBJECTIVES = {
+    'pointwise': {'objective': 'binary:logistic', 'eval_metric': ['logloss', 'auc']},
+    'pairwise': {'objective': 'rank:pairwise', 'eval_metric': ['ndcg@10', 'ndcg@100']},
+    'ndcg': {'objective': 'rank:ndcg', 'eval_metric': ['ndcg@10', 'ndcg@100']},
+}
+
+
+def get_feature_columns(path, exclude=()):
+    "Feature columns of a dataset, in file order"
+    return [
+        col for col in pq.read_schema(path).names
+        if col not in NON_FEATURE_COLUMNS and col not in exclude
+    ]
+
+
+def read_record_batches(path, columns, batch_rows=TRAIN_BATCH_ROWS):
+    "Streams `columns` of a parquet file as `{column: array}`, one row group at a time"
+    parquet_file = pq.ParquetFile(path)
+    for record_batch in parquet_file.iter_batches(batch_size=batch_rows, columns=columns):
+        yield {col: record_batch.column(col).to_numpy(zero_copy_only=False) for col in columns}
+
+
+def group_batches(path, feature_columns, batch_rows=TRAIN_BATCH_ROWS):
+    """Yields `(X, labels, query_ids)` batches of about `batch_rows` rows that never
+    split a query. The dataset must hold the rows of each query contiguously,
+    as written by `build_dataset_from_features`; the rows of the last query of
+    a batch are carried to the next one"""
+    columns = ['query_id', 'label'] + feature_columns
+    pending = []
+    n_pending = 0
+    seen = set()
+
+    def split(chunks):
+        merged = {col: np.concatenate([chunk[col] for chunk in chunks]) for col in columns}
+        offsets = get_group_offsets(merged['query_id'])
+        query_ids = merged['query_id'][offsets[:-1]]
+        if len(np.unique(query_ids)) < len(query_ids) or seen.intersection(query_ids.tolist()):
+            raise ValueError(f"`{path}` rows are not grouped by query_id")
+        return merged, offsets
+
+    def to_batch(merged, end):
+        X = np.column_stack([merged[col][:end] for col in feature_columns]).astype(np.float32, copy=False)
+        # Missing features are served as 0 by the `rerank` service
+        X[np.isnan(X)] = 0.
+        seen.update(np.unique(merged['query_id'][:end]).tolist())
+        return X, merged['label'][:end], merged['query_id'][:end]
+
+    for chunk in read_record_batches(path, columns, batch_rows):
+        pending.append(chunk)
+        n_pending += len(chunk['query_id'])
+        if n_pending < batch_rows:
+            continue
+        merged, offsets = split(pending)
+        if len(offsets) < 3:
+            # A single query so far, it may continue in the next chunk
+            continue
+        # Everything up to the start of the last query, which may be incomplete
+        end = offsets[-2]
+        yield to_batch(merged, end)
+        pending = [{col: merged[col][end:] for col in columns}]
+        n_pending = len(pending[0]['query_id'])
+
+    if n_pending:
+        merged, _ = split(pending)
+        yield to_batch(merged, n_pending)
+
+
+class GroupedParquetIter(xgb.DataIter):
+    """Feeds a parquet dataset to XGBoost in query aligned batches, so a
+    `QuantileDMatrix` (or an external memory `DMatrix` with `cache_prefix`)
+    is built without loading the dataset in memory. The groups are numbered
+    in file order from the query_id boundaries, so `qid` is always sorted"""
+
+    def __init__(self, path, feature_columns, batch_rows=TRAIN_BATCH_ROWS, cache_prefix=None):
+        self.path = path
+        self.feature_columns = feature_columns
+        self.batch_rows = batch_rows
+        self.batches = None
+        self.n_groups = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def reset(self):
+        self.batches = group_batches(self.path, self.feature_columns, self.batch_rows)
+        self.n_groups = 0
+
+    def next(self, input_data):
+        batch = next(self.batches, None)
+        if batch is None:
+            return False
+        X, labels, query_ids = batch
+        offsets = get_group_offsets(query_ids)
+        qid = np.repeat(np.arange(self.n_groups, self.n_groups + len(offsets) - 1), np.diff(offsets))
+        self.n_groups += len(offsets) - 1
+        get_metrics().increment('train.rows', len(X))
+        input_data(data=X, label=labels, qid=qid, feature_names=self.feature_columns)
+        return True
+
+
+@timed('stage.dmatrix')
+def build_dmatrix(path, feature_columns, batch_rows=TRAIN_BATCH_ROWS, cache_prefix=None, max_bin=256, ref=None):
+    """Quantized matrix of a dataset built from its batches. With `cache_prefix` the
+    pages are kept on disk, otherwise only the quantized features are held in memory"""
+    data = GroupedParquetIter(path, feature_columns, batch_rows, cache_prefix)
+    if cache_prefix:
+        os.makedirs(os.path.dirname(cache_prefix) or '.', exist_ok=True)
+        return xgb.DMatrix(data)
+    return xgb.QuantileDMatrix(data, max_bin=max_bin, ref=ref)
+
+
+@timed('stage.evaluate')
+def evaluate_booster(booster, path, feature_columns, batch_rows=TRAIN_BATCH_ROWS, k_values=(10, 100)):
+    "Ranking metrics of a dataset scored batch by batch, up to the early stopping best iteration"
+    best_iteration = getattr(booster, 'best_iteration', None)
+    iteration_range = (0, best_iteration + 1) if best_iteration is not None else (0, 0)
+    scores, labels, query_ids = [], [], []
+    for X, batch_labels, batch_query_ids in group_batches(path, feature_columns, batch_rows):
+        dmatrix = xgb.DMatrix(X, feature_names=feature_columns)
+        scores.append(booster.predict(dmatrix, iteration_range=iteration_range))
+        labels.append(batch_labels)
+        query_ids.append(batch_query_ids)
+    if not scores:
+        return {}
+    query_ids = np.concatenate(query_ids)
+    return evaluate_scores(np.concatenate(scores), np.concatenate(labels), get_group_offsets(query_ids), k_values)
+
+
+@timed('stage.train')
+def train(train_path, eval_path=None, objective='pairwise', feature_columns=None, n_estimators=150,
+          early_stopping_rounds=10, batch_rows=TRAIN_BATCH_ROWS, cache_dir=None, params=None):
+    "Trains a booster on the `train_path` dataset, early stopping on `eval_path` when given"
+    feature_columns = feature_columns or get_feature_columns(train_path)
+    cache_prefix = os.path.join(cache_dir, 'train') if cache_dir else None
+    dtrain = build_dmatrix(train_path, feature_columns, batch_rows, cache_prefix)
+
+    evals = [(dtrain, 'train')]
+    if eval_path:
+        eval_cache_prefix = os.path.join(cache_dir, 'eval') if cache_dir else None
+        # The eval set shares the train quantiles, as `fit` does with an `eval_set`
+        deval = build_dmatrix(eval_path, feature_columns, batch_rows, eval_cache_prefix, ref=None if cache_dir else dtrain)
+        # The last eval set drives the early stopping
+        evals.append((deval, 'eval'))
+
+    train_params = {
+        **OBJECTIVES[objective],
+        'tree_method': 'hist',
+        'alpha': 10,
+        'seed': SAMPLE_SEED,
+        **(params or {}),
+    }
+    return xgb.train(
+        train_params,
+        dtrain,
+        num_boost_round=n_estimators,
+        evals=evals,
+        early_stopping_rounds=early_stopping_rounds if eval_path else None,
+        verbose_eval=True,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("train_path", type=str, help="Train parquet built by `build_dataset_from_features`")
+    parser.add_argument("--eval-path", default=None, type=str, help="Dev parquet used for early stopping and evaluation")
+    parser.add_argument("--output", "-o", required=True, type=str, help="Model file, loaded by `rerank --model`")
+    parser.add_argument("--objective", choices=list(OBJECTIVES), default='pairwise', type=str)
+    parser.add_argument("--n-estimators", default=150, type=int)
+    parser.add_argument("--early-stopping-rounds", default=10, type=int)
+    parser.add_argument("--exclude", nargs='*', default=[], type=str, help="Feature columns left out of the model")
+    parser.add_argument("--batch-rows", default=TRAIN_BATCH_ROWS, type=int,
+                        help="Rows per batch fed to XGBoost, rounded down to whole queries")
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Keeps the quantized pages on disk (external memory) instead of in memory")
+    parser.add_argument("--params", default=None, type=json.loads, help="Extra XGBoost params as JSON")
+    parser.add_argument("--k", nargs='+', default=[10, 100], type=int)
+    parser.add_argument("--metrics", default=None, type=str,
+                        help="JSON lines metrics file, defaults to a new file in `METRICS_DIR`")
+    args = parser.parse_args()
+    init_metrics('train', args.metrics)
+
+    feature_columns = get_feature_columns(args.train_path, args.exclude)
+    booster = train(
+        args.train_path,
+        args.eval_path,
+        args.objective,
+        feature_columns,
+        args.n_estimators,
+        args.early_stopping_rounds,
+        args.batch_rows,
+        args.cache_dir,
+        args.params,
+    )
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    booster.save_model(args.output)
+    print(f"Saved the model trained on {len(feature_columns)} features to {args.output}")
+
+    if args.eval_path:
+        results = evaluate_booster(booster, args.eval_path, feature_columns, args.batch_rows, args.k)
+        print(json.dumps(results, indent=2))
+    print(summarize())
@@ -1,5 +1,76 @@
+import os
+import re
+import heapq
+import queue
+import threading
+import itertools
+import contextlib
+import traceback
+import time
+import bson
+import pymongo
+import numpy as np
 import elasticsearch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from config import *
+from metrics import InstrumentedConnection, get_metrics
+
+
+# Clients are cached per process and host, forked workers must not reuse the
+# sockets of the parent connection pool
+_es_clients = {}
+_mongo_clients = {}
+
+
+def _as_hosts(host):
+    return tuple(host) if isinstance(host, (list, tuple)) else (host,)
+
+
+def create_es_client(host=ES_HOST, maxsize=ES_POOL_MAXSIZE):
+    return elasticsearch.Elasticsearch(
+        hosts=list(_as_hosts(host)),
+        timeout=ES_TIMEOUT,
+        max_retries=MAX_RETRIES,
+        retry_on_timeout=True,
+        maxsize=maxsize,
+        connection_class=InstrumentedConnection,
+    )
+
+
+def init_es_client(host=ES_HOST, maxsize=ES_POOL_MAXSIZE):
+    "Creates the process client, meant to be used as `mp.Pool(initializer=init_es_client)`"
+    key = (os.getpid(), _as_hosts(host))
+    _es_clients[key] = create_es_client(host, maxsize)
+    return _es_clients[key]
+
+
+def get_es_client(host=ES_HOST):
+    "Returns the persistent client of the current process, creating it on the first call"
+    key = (os.getpid(), _as_hosts(host))
+    if key not in _es_clients:
+        return init_es_client(host)
+    return _es_clients[key]
+
+
+def get_mongo_client(host=MONGODB_HOST):
+    "Returns the persistent mongo client of the current process"
+    key = (os.getpid(), host)
+    if key not in _mongo_clients:
+        _mongo_clients[key] = pymongo.MongoClient(host)
+    return _mongo_clients[key]
+
+
+def retry_with_backoff(func, *args, max_retries=MAX_RETRIES, backoff=ES_RETRY_BACKOFF, **kwargs):
+    for i in range(max_retries):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+            get_metrics().increment('retries')
+            if i < max_retries - 1:
+                time.sleep(backoff * 2 ** i)
+    raise ValueError("Reached operation max retries")
 
 
 def get_queries_index(type):
@@ -35,6 +106,82 @@ def clean_search_fields(query):
     "Removes fields compatible only with elastic search API"
     return {k: v for k,v in query.items() if k not in ['size', '_source', 'sort']}
 
+
+def get_similarity_field(field, similarity=None):
+    "Multi-field of `field` indexed with `similarity`, or the field itself"
+    if similarity:
+        subfield = similarity.replace('.', '_')
+        if subfield in SIMILARITY_SUBFIELDS:
+            return f'{field}.{subfield}'
+    return field
+
+
+def get_similarity_query_body(query_doc, scoreddocs, field, similarity=None):
+    return {
+        "size": len(scoreddocs),
+        "_source": False,
+        # "explain": True,
+        "query": {
+            "bool": {
+                # Restrict only for the pre scored documents
+                "filter": {
+                    "terms": {
+                        "doc_id": [doc['doc_id'] for doc in scoreddocs]
+                        }
+                    },
+                # Search for field of interest
+                "should": {
+                    "match": {get_similarity_field(field, similarity): query_doc['text']}
+                }
+            }
+        }
+    }
+
+
+def msearch(es, index, bodies, max_concurrent_searches=MSEARCH_MAX_CONCURRENT_SEARCHES):
+    "Sends all `bodies` in a single `_msearch` request, returning one response per body"
+    searches = []
+    for body in bodies:
+        searches.append({"index": index})
+        searches.append(body)
+    response = es.msearch(body=searches, max_concurrent_searches=max_concurrent_searches)
+    return response['responses']
+
+
+def get_similarities_scores(es, query_doc, scoreddocs, similarities=SIMILARITY_SUBFIELDS, fields=DOCUMENT_FIELDS,
+                            max_concurrent_searches=MSEARCH_MAX_CONCURRENT_SEARCHES):
+    """Scores of `scoreddocs` as `{(similarity, field): {doc_id: score}}`, from one doc_id filtered
+    search per similarity multi-field sent in a single `_msearch` request. Failed searches are left out"""
+    keys = [(similarity, field) for similarity in similarities for field in fields]
+    bodies = [get_similarity_query_body(query_doc, scoreddocs, field, similarity) for similarity, field in keys]
+    responses = msearch(es, MSMARCO_DOCS_INDEX, bodies, max_concurrent_searches)
+    return {
+        key: {hit['_id']: hit['_score'] for hit in response['hits']['hits']}
+        for key, response in zip(keys, responses)
+        if 'error' not in response
+    }
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def analyze(text):
+    "Approximation of the ES `standard` analyzer, used to tokenize the queries"
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def batch_iterator(generator, batch_size):
+    "Groups the items of `generator` in lists of at most `batch_size` elements"
+    batch = []
+    for item in generator:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def es_scroll_generator(
     host,
     index,
@@ -44,10 +191,7 @@ def es_scroll_generator(
     debug=False,
     batch=True
 ):
-    es = elasticsearch.Elasticsearch(
-        host,
-        timeout=timeout,
-    )
+    es = get_es_client(host)
     if debug:
         n_docs = es.count(
             index=index,
@@ -58,32 +202,161 @@ def es_scroll_generator(
     scroll_size = len(docs)
     scroll_id = results["_scroll_id"]
     processed = scroll_size
-    while scroll_size > 0:
-        # Before scroll, process current batch of hits
-        if batch:
-            yield docs
+    try:
+        while scroll_size > 0:
+            # Before scroll, process current batch of hits
+            if batch:
+                yield docs
+            else:
+                for doc in docs:
+                    yield doc
+            results = es.scroll(scroll_id=scroll_id, scroll=scroll, request_timeout=timeout)
+            # Update the scroll ID
+            scroll_id = results["_scroll_id"]
+            # Get the number of results that returned in the last scroll
+            docs = get_hits_from_response(results)
+            scroll_size = len(docs)
+            processed += scroll_size
+            if debug:
+                print(f"Processed : {processed:,} / {n_docs:,} ({100*processed/n_docs:.6f}%)")
+    finally:
+        # Also runs when the consumer closes the generator early, so the scroll context is freed
+        es.clear_scroll(body={"scroll_id": scroll_id})
+
+
+_SLICE_DONE = object()
+
+
+def _put_until_stopped(out, item, stop, poll=1):
+    "Puts `item` on the bounded `out`, giving up once the consumer set `stop`"
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=poll)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _scroll_slice(host, index, body, slice_id, n_slices, timeout, scroll, out, stop):
+    try:
+        slice_body = dict(body, slice={"id": slice_id, "max": n_slices})
+        # Closing the scroll generator clears the scroll context of the slice
+        with contextlib.closing(es_scroll_generator(host, index, slice_body, timeout=timeout, scroll=scroll)) as batches:
+            for docs in batches:
+                if stop.is_set() or not _put_until_stopped(out, docs, stop):
+                    return
+    except Exception as e:
+        _put_until_stopped(out, e, stop)
+    finally:
+        _put_until_stopped(out, _SLICE_DONE, stop)
+
+
+def _slice_documents(out):
+    while True:
+        get_metrics().gauge('scroll.queue_depth', out.qsize())
+        docs = out.get()
+        if docs is _SLICE_DONE:
+            return
+        if isinstance(docs, Exception):
+            raise docs
+        yield from docs
+
+
+def get_sort_key(body):
+    "Key function reproducing the ascending `sort` of a search body on the hits sources"
+    fields = []
+    for sort in body.get('sort', []):
+        field, order = (sort, 'asc') if isinstance(sort, str) else next(iter(sort.items()))
+        order = order['order'] if isinstance(order, dict) else order
+        if order != 'asc':
+            raise ValueError(f"Only ascending sorts can be merged, got `{sort}`")
+        fields.append(field[:-len('.keyword')] if field.endswith('.keyword') else field)
+    return lambda doc: tuple(doc[field] for field in fields)
+
+
+def es_sliced_scroll_generator(
+    host,
+    index,
+    body,
+    slices=ES_SCROLL_SLICES,
+    timeout=60,
+    scroll='1m',
+    batch=True,
+    preserve_order=False,
+    max_queued_batches=4,
+):
+    """Reads `index` as `slices` sliced scrolls running on concurrent threads.
+    Batches come in completion order, unless `preserve_order` merges the
+    slices back into the `sort` order of `body`"""
+    if slices <= 1:
+        yield from es_scroll_generator(host, index, body, timeout=timeout, scroll=scroll, batch=batch)
+        return
+
+    # Clients are shared by the threads, it must exist before they start
+    get_es_client(host)
+    n_queues = slices if preserve_order else 1
+    queues = [queue.Queue(maxsize=max_queued_batches) for _ in range(n_queues)]
+    stop = threading.Event()
+    threads = []
+    for slice_id in range(slices):
+        thread = threading.Thread(
+            target=_scroll_slice,
+            args=(host, index, body, slice_id, slices, timeout, scroll, queues[slice_id % n_queues], stop),
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+
+    if preserve_order:
+        docs = heapq.merge(*[_slice_documents(out) for out in queues], key=get_sort_key(body))
+        batches = batch_iterator(docs, body.get('size', 10))
+    else:
+        batches = _completed_batches(queues[0], slices)
+
+    try:
+        for docs in batches:
+            if batch:
+                yield docs
+            else:
+                yield from docs
+    finally:
+        # The consumer may stop early (a limit, an `islice` or an error): the slices blocked
+        # on a full queue give up, and each one clears its scroll context before exiting
+        stop.set()
+        for thread in threads:
+            thread.join(timeout)
+
+
+def _completed_batches(out, slices):
+    n_done = 0
+    while n_done < slices:
+        get_metrics().gauge('scroll.queue_depth', out.qsize())
+        docs = out.get()
+        if docs is _SLICE_DONE:
+            n_done += 1
+        elif isinstance(docs, Exception):
+            raise docs
         else:
-            for doc in docs:
-                yield doc
-        results = es.scroll(scroll_id=scroll_id, scroll=scroll)
-        # Update the scroll ID
-        scroll_id = results["_scroll_id"]
-        # Get the number of results that returned in the last scroll
-        docs = get_hits_from_response(results)
-        scroll_size = len(docs)
-        processed += scroll_size
-        if debug:
-            print(f"Processed : {processed:,} / {n_docs:,} ({100*processed/n_docs:.6f}%)")
-    es.clear_scroll(body={"scroll_id": scroll_id})
-
-
-def queries_from_index_factory(host, index, limit=None):
+            yield docs
+
+
+def queries_from_index_factory(host, index, limit=None, after=None):
+    "Queries sorted by id, optionally resuming after the `after` query_id"
     body = {'size': 10000, "sort": [{"query_id.keyword": "asc"}],}
+    if after is not None:
+        body["query"] = {"range": {"query_id.keyword": {"gt": after}}}
     yield from documents_from_index_factory(host, index, limit, body)
 
 
-def documents_from_index_factory(host, index, limit=None, body=None):
-    es = elasticsearch.Elasticsearch(host)
+def queries_by_ids_factory(host, index, query_ids):
+    "Queries of `query_ids` sorted by id, searched in chunks below `index.max_terms_count`"
+    body = {'size': 10000, "sort": [{"query_id.keyword": "asc"}]}
+    yield from documents_by_terms_factory(host, index, "query_id.keyword", query_ids, body)
+
+
+def documents_from_index_factory(host, index, limit=None, body=None, slices=ES_SCROLL_SLICES):
+    es = get_es_client(host)
     n_queries = es.count(
         index=index,
         body=clean_search_fields(body),
@@ -91,7 +364,9 @@ def documents_from_index_factory(host, index, limit=None, body=None):
     
     def gen():
         i = 1
-        for batch in es_scroll_generator(host, index, body):
+        # The sorted order is kept for the callers relying on it
+        preserve_order = 'sort' in body
+        for batch in es_sliced_scroll_generator(host, index, body, slices, preserve_order=preserve_order):
             for query_doc in batch:
                 if limit and i > limit:
                     return
@@ -100,3 +375,73 @@ def documents_from_index_factory(host, index, limit=None, body=None):
     
     return n_queries, gen
 
+
+
+def documents_by_terms_factory(host, index, field, values, body=None, chunk_size=TERMS_QUERY_CHUNK_SIZE, workers=TERMS_QUERY_WORKERS):
+    """Same as `documents_from_index_factory` for a `terms` query on `field` over a large
+    list of `values`. The values are deduplicated, sorted and split in chunks below
+    `index.max_terms_count`, scrolled by up to `workers` threads. Chunks are yielded in
+    order, so a body sorted by `field` gives a sorted output"""
+    values = sorted(set(values))
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    body = body or {"size": 10000}
+    es = get_es_client(host)
+
+    def count_chunk(chunk):
+        return es.count(index=index, body={"query": {"terms": {field: chunk}}})["count"]
+
+    def scroll_chunk(chunk):
+        chunk_body = dict(body, query={"terms": {field: chunk}})
+        return [doc for docs in es_scroll_generator(host, index, chunk_body) for doc in docs]
+
+    with ThreadPoolExecutor(workers) as executor:
+        n_docs = sum(executor.map(count_chunk, chunks))
+
+    def gen():
+        with ThreadPoolExecutor(workers) as executor:
+            # At most `workers` chunks are held in memory ahead of the consumer
+            remaining = iter(chunks)
+            pending = deque(executor.submit(scroll_chunk, chunk) for chunk in itertools.islice(remaining, workers))
+            while pending:
+                docs = pending.popleft().result()
+                for chunk in itertools.islice(remaining, 1):
+                    pending.append(executor.submit(scroll_chunk, chunk))
+                yield from docs
+
+    return n_docs, gen
+
+
+def pack_query_features(features, fields=DOCUMENT_FIELDS):
+    """Packs the `{doc_id, query_id, field: score}` records of a single query into one
+    document, with the scores stored as a binary float32 (docs x fields) matrix sorted by doc_id.
+    Missing scores are stored as NaN"""
+    features = sorted(features, key=lambda doc: doc['doc_id'])
+    scores = np.array(
+        [[doc.get(field, np.nan) for field in fields] for doc in features],
+        dtype=np.float32
+    )
+    return {
+        'query_id': features[0]['query_id'],
+        'doc_ids': [doc['doc_id'] for doc in features],
+        'fields': list(fields),
+        'scores': bson.Binary(scores.tobytes()),
+    }
+
+
+def to_storage_documents(batch, storage='rows'):
+    "Converts the features of a batch of queries to the documents written to mongo"
+    if storage == 'packed':
+        return [pack_query_features(features) for features in batch if features]
+    return list(itertools.chain.from_iterable(batch))
+
+
+def unpack_query_features(record, fields=DOCUMENT_FIELDS):
+    "Decodes a packed record into `(query_id, doc_ids, scores)`, with scores columns ordered by `fields`"
+    doc_ids = np.array(record['doc_ids'])
+    stored_fields = record['fields']
+    stored_scores = np.frombuffer(record['scores'], dtype=np.float32).reshape(len(doc_ids), len(stored_fields))
+    scores = np.full((len(doc_ids), len(fields)), np.nan, dtype=np.float32)
+    for j, field in enumerate(fields):
+        if field in stored_fields:
+            scores[:, j] = stored_scores[:, stored_fields.index(field)]
+    return record['query_id'], doc_ids, scores